@@ -2,41 +2,74 @@
 
 import sys
 import argparse
+import time
 from airium import Airium
 
+from concurrent.futures import Future
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, TypeVar
 from gc_licensing.junit import generate_junit_output
 from gc_licensing.logger import setup_logging
-from gc_licensing.sources.bash import bash_from_repo
+from gc_licensing.sources.bash import bash_from_repo, script_dependencies
 
-from gc_licensing.sources.utils import find_requirements_files
+from gc_licensing.sources.utils import discover_files
 
-from .problem_packages import extract_problem_packages
+from .problem_packages import NotEvaluated, extract_problem_packages
 
+from .incremental import ResultsStore, settings_digest
 from .package import AptPackages, CombinedPackages, AptPackages
-from .sources.apt import apt_from_repo
-from .sources.docker import docker_from_repo
+from .sources.apt import apt_from_repo, get_source_copyright
+from .sources.docker import dockerfiles_from_repo
+from .sources.image import image_from_archive
 from .sources.notebook import notebook_from_repo
+from .sources.parse import ParseStage
+from .sources.utils import pip_licenses_future
 from .sources.pip import (
     PipPackages,
     parse_requirements_file,
     pip_from_csv,
     pip_from_repo,
+    requirements_file_includes,
 )
 
+from .plan import (
+    ScanPlan,
+    filter_extra_pip,
+    format_plan,
+    plan_scan,
+    requirements_item,
+)
 from .render import generate_problems_html, render
+from .fail_fast import (
+    FailFast,
+    apt_package_list,
+    combined_package_list,
+    pip_package_list,
+)
+from .scheduler import (
+    ScanStopped,
+    Scheduler,
+    WorkItem,
+    completed,
+    submit_item,
+    unfinished,
+)
+from .timings import TimingHistory
 from .confluence import upload_deps_table
 
 from .config import configs, store_user_config
 from .utils import parse_args
 
 
+T = TypeVar("T")
+
+
 def get_pip_for_file(
     repository: Path,
     relative_path: Path,
     pip_before_install: Optional[Path] = None,
     pip_after_install: Optional[Path] = None,
+    pip_license_texts: Optional[Path] = None,
 ):
     filename = repository / relative_path
     reqs = parse_requirements_file(filename)
@@ -48,142 +81,353 @@ def get_pip_for_file(
             pip_before_install,
             pip_after_install,
             reqs,
+            pip_license_texts,
         )
 
 
-def get_pip(args: argparse.Namespace) -> Dict[str, PipPackages]:
-    output = {}
+def resolve_pip_file(
+    args: argparse.Namespace, results: ResultsStore, r: Path
+) -> PipPackages:
+    packages = get_pip_for_file(
+        args.repository,
+        r,
+        args.pip_before_install,
+        args.pip_after_install,
+        args.pip_license_texts,
+    )
+    results.record("pip", r, requirements_file_includes(args.repository / r), packages)
+    return packages
 
-    if args.find_pip_files:
-        args.pip_requirements_files += find_requirements_files(
-            args.repository, args.find_pip_files_names, args.ignore_paths
-        )
+
+def get_pip(
+    args: argparse.Namespace,
+    plan: ScanPlan,
+    scheduler: Scheduler,
+    results: ResultsStore,
+) -> Dict[str, "Future[PipPackages]"]:
+    output = {}
 
     print(f"Processing pip requirements files: {args.pip_requirements_files}")
     for r in args.pip_requirements_files:
-        pip_direct, pip_transitive = get_pip_for_file(
-            args.repository, r, args.pip_before_install, args.pip_after_install
-        )
-        output[r] = (pip_direct, pip_transitive)
+        packages = results.reuse("pip", r)
+        if packages is None:
+            output[r] = scheduler.submit_item(
+                plan.pip_files[r], resolve_pip_file, args, results, r
+            )
+        else:
+            output[r] = completed(packages)
     return output
 
 
-def get_apt(args: argparse.Namespace) -> Dict[str, AptPackages]:
-    output = {}
+def resolve_apt_file(
+    args: argparse.Namespace, results: ResultsStore, r: Path
+) -> AptPackages:
+    packages = apt_from_repo(
+        args.repository / r, args.apt_no_cache, args.apt_follow_depends
+    )
+    results.record("apt", r, [], packages)
+    return packages
 
-    if args.find_apt_files:
-        args.apt_requirements_files += find_requirements_files(
-            args.repository, args.find_apt_files_names, args.ignore_paths
-        )
+
+def get_apt(
+    args: argparse.Namespace,
+    plan: ScanPlan,
+    scheduler: Scheduler,
+    results: ResultsStore,
+) -> Dict[str, "Future[AptPackages]"]:
+    output = {}
 
     print(f"Processing apt requirements files: {args.apt_requirements_files}")
     for r in args.apt_requirements_files:
-        packages = apt_from_repo(args.repository / r, args.apt_no_cache)
-        output[r] = packages
+        packages = results.reuse("apt", r)
+        if packages is None:
+            output[r] = scheduler.submit_item(
+                plan.apt_files[r], resolve_apt_file, args, results, r
+            )
+        else:
+            output[r] = completed(packages)
     return output
 
 
+def discover_sources(args: argparse.Namespace):
+    """
+    Finds the files of every source that's enabled in a single walk of the repository.
+    """
+    # (enabled, file name patterns, files to process)
+    sources = {
+        "pip": (
+            args.find_pip_files,
+            args.find_pip_files_names,
+            args.pip_requirements_files,
+        ),
+        "apt": (
+            args.find_apt_files,
+            args.find_apt_files_names,
+            args.apt_requirements_files,
+        ),
+        "docker": (
+            args.find_dockerfiles,
+            args.find_dockerfiles_names,
+            args.dockerfiles,
+        ),
+        "bash": (args.find_bash_files, args.find_bash_files_names, args.bash_files),
+        "notebook": (
+            args.find_notebooks,
+            args.find_notebook_names,
+            args.notebook_files,
+        ),
+    }
+    found = discover_files(
+        args.repository,
+        {kind: names for kind, (enabled, names, _) in sources.items() if enabled},
+        args.ignore_paths,
+        args.discovery,
+    )
+    for kind, files in found.items():
+        sources[kind][2].extend(files)
+
+
+def start_parsing(
+    args: argparse.Namespace, parse_stage: ParseStage, results: ResultsStore
+):
+    # Files whose results are reused from the base scan are never parsed
+    for kind, source, files in [
+        ("dockerfile", "docker", args.dockerfiles),
+        ("bash", "bash", args.bash_files),
+        ("notebook", "notebook", args.notebook_files),
+    ]:
+        for f in files:
+            if results.reuse_source(source, f) is None:
+                parse_stage.submit(kind, args.repository / f)
+
+
+# The packages found in a source file, and the requirements files it installs
+SourceResult = Tuple[CombinedPackages, List[Path]]
+
+
+def resolve_dockerfile(
+    args: argparse.Namespace, parse_stage: ParseStage, results: ResultsStore, d: Path
+) -> SourceResult:
+    image_map = {image: args.repository / d for image, d in args.docker_image_map}
+    path = args.repository / d
+    parsed = {
+        p: parse_stage.result("dockerfile", p)
+        for p in [path, *image_map.values()]
+        if p.exists()
+    }
+    resolved = dockerfiles_from_repo(
+        [path],
+        args.apt_no_cache,
+        not args.docker_no_follow_requirements_files,
+        args.apt_follow_depends,
+        image_map,
+        parsed,
+    )
+    packages, req_files = resolved[path]
+    # Stages may be built from any of the mapped Dockerfiles
+    results.record_source("docker", d, image_map.values(), packages, req_files)
+    return packages, req_files
+
+
 def get_dockerfile(
     args: argparse.Namespace,
-) -> Tuple[Dict[str, CombinedPackages], List[Path]]:
+    parse_stage: ParseStage,
+    scheduler: Scheduler,
+    results: ResultsStore,
+) -> Dict[str, "Future[SourceResult]"]:
     output = {}
 
-    if args.find_dockerfiles:
-        args.dockerfiles += find_requirements_files(
-            args.repository, args.find_dockerfiles_names, args.ignore_paths
-        )
-
     print(f"Processing Dockerfiles: {args.dockerfiles}")
-    extra_pip_files = []
+    # Each Dockerfile is resolved on its own, while stages shared between them are only
+    # resolved once
     for d in args.dockerfiles:
-        (pip_packages, apt_packages), extra_pip_files = docker_from_repo(
-            args.repository / d,
-            args.apt_no_cache,
-            not args.docker_no_follow_requirements_files,
-        )
+        reused = results.reuse_source("docker", d)
+        if reused is None:
+            output[d] = scheduler.submit(
+                "sources", resolve_dockerfile, args, parse_stage, results, d
+            )
+        else:
+            output[d] = completed(reused)
+    return output
 
-        output[d] = (pip_packages, apt_packages)
-    return output, extra_pip_files
+
+def resolve_bashfile(
+    args: argparse.Namespace, parse_stage: ParseStage, results: ResultsStore, b: Path
+) -> SourceResult:
+    commands = parse_stage.result("bash", args.repository / b)
+    packages, req_files = bash_from_repo(
+        args.repository / b,
+        args.apt_no_cache,
+        not args.bash_no_follow_requirements_files,
+        args.apt_follow_depends,
+        commands,
+    )
+    results.record_source(
+        "bash",
+        b,
+        script_dependencies(args.repository / b, commands),
+        packages,
+        req_files,
+    )
+    return packages, req_files
 
 
 def get_bashfile(
     args: argparse.Namespace,
-) -> Tuple[Dict[str, CombinedPackages], List[Path]]:
+    parse_stage: ParseStage,
+    scheduler: Scheduler,
+    results: ResultsStore,
+) -> Dict[str, "Future[SourceResult]"]:
     output = {}
 
-    if args.find_bash_files:
-        args.bash_files += find_requirements_files(
-            args.repository, args.find_bash_files_names, args.ignore_paths
-        )
-
     print(f"Processing bash files: {args.bash_files}")
-    extra_pip_files = []
     for b in args.bash_files:
-        print()
-        print(f"Processing bash file {b}")
-        (pip_packages, apt_packages), extra_pip_files = bash_from_repo(
-            args.repository / b,
-            args.apt_no_cache,
-            not args.bash_no_follow_requirements_files,
-        )
+        reused = results.reuse_source("bash", b)
+        if reused is None:
+            output[b] = scheduler.submit(
+                "sources", resolve_bashfile, args, parse_stage, results, b
+            )
+        else:
+            output[b] = completed(reused)
+    return output
+
 
-        output[b] = (pip_packages, apt_packages)
-    return output, extra_pip_files
+def resolve_notebook(
+    args: argparse.Namespace, parse_stage: ParseStage, results: ResultsStore, n: Path
+) -> SourceResult:
+    packages, req_files = notebook_from_repo(
+        args.repository / n,
+        args.apt_no_cache,
+        not args.notebook_no_follow_requirements_files,
+        args.apt_follow_depends,
+        parse_stage.result("notebook", args.repository / n),
+    )
+    results.record_source("notebook", n, [], packages, req_files)
+    return packages, req_files
 
 
 def get_notebook(
     args: argparse.Namespace,
-) -> Tuple[Dict[str, CombinedPackages], List[Path]]:
+    parse_stage: ParseStage,
+    scheduler: Scheduler,
+    results: ResultsStore,
+) -> Dict[str, "Future[SourceResult]"]:
     output = {}
 
-    if args.find_notebooks:
-        args.notebook_files += find_requirements_files(
-            args.repository, args.find_notebook_names, args.ignore_paths
-        )
-
     print(f"Processing Jupyter Notebook files: {args.notebook_files}")
-    extra_pip_files = []
-    for b in args.notebook_files:
-        print()
-        print(f"Processing Jupyter Notebook {b}")
-        (pip_packages, apt_packages), extra_pip_files = notebook_from_repo(
-            args.repository / b,
-            args.apt_no_cache,
-            not args.notebook_no_follow_requirements_files,
-        )
-
-        output[b] = (pip_packages, apt_packages)
-    return output, extra_pip_files
-
-
-def filter_extra_pip(
-    repo_path: Path, already_processed: List[str], discovered_files: List[Path]
-) -> List[Path]:
-    already_processed = [(repo_path / a).resolve() for a in already_processed]
+    for n in args.notebook_files:
+        reused = results.reuse_source("notebook", n)
+        if reused is None:
+            output[n] = scheduler.submit(
+                "sources", resolve_notebook, args, parse_stage, results, n
+            )
+        else:
+            output[n] = completed(reused)
+    return output
 
-    def safe_relative_to(d):
-        try:
-            return d.relative_to(repo_path.resolve())
-        except ValueError:
-            return None
 
-    relative_paths = [
-        safe_relative_to(d)
-        for d in set(discovered_files)
-        if d.resolve() not in already_processed
-    ]
-    return [p for p in relative_paths if p is not None]
+def get_images(
+    args: argparse.Namespace, plan: ScanPlan, scheduler: Scheduler
+) -> Dict[str, "Future[CombinedPackages]"]:
+    print(f"Processing container images: {args.container_images}")
+    return {
+        i: scheduler.submit_item(
+            plan.images[i], image_from_archive, i, args.apt_no_cache
+        )
+        for i in args.container_images
+    }
+
+
+def submit_plan(args: argparse.Namespace, plan: ScanPlan):
+    """
+    Starts the work items shared between files: each distinct set of pip packages
+    installed by commands, and the copyright file of each apt source package. Files
+    installing them wait for these rather than resolving them again.
+    """
+    for key in plan.requirement_sets:
+        pip_licenses_future(key)
+    for key, item in plan.apt_sources.items():
+        submit_item(
+            item, get_source_copyright, plan.apt_versions[key], args.apt_no_cache
+        )
 
 
-def get_extra_pip(repo_path: Path, files: List[Path]) -> Dict[str, PipPackages]:
+def resolve_extra_pip(repo_path: Path, results: ResultsStore, r: Path) -> PipPackages:
+    reqs = parse_requirements_file(repo_path / r)
+    packages = pip_from_repo(repo_path, r, reqs)
+    results.record("extra-pip", r, requirements_file_includes(repo_path / r), packages)
+    return packages
+
+
+def submit_extra_pip(
+    repo_path: Path, item: WorkItem, scheduler: Scheduler, results: ResultsStore
+) -> "Future[PipPackages]":
+    r = Path(item.name)
+    packages = results.reuse("extra-pip", r)
+    if packages is not None:
+        return completed(packages)
+    return scheduler.submit_item(item, resolve_extra_pip, repo_path, results, r)
+
+
+def submit_planned_extra_pip(
+    repo_path: Path, plan: ScanPlan, scheduler: Scheduler, results: ResultsStore
+) -> Dict[Path, "Future[PipPackages]"]:
+    return {
+        r: submit_extra_pip(repo_path, item, scheduler, results)
+        for r, item in plan.extra_pip_files.items()
+    }
+
+
+def get_extra_pip(
+    repo_path: Path,
+    already_processed: List[str],
+    sources: List["Future[SourceResult]"],
+    submitted: Dict[Path, "Future[PipPackages]"],
+    scheduler: Scheduler,
+    results: ResultsStore,
+    fail_fast: Optional[FailFast] = None,
+) -> Dict[str, "Future[PipPackages]"]:
+    """
+    Resolves the requirements files installed by Dockerfiles, scripts and notebooks: those
+    in the plan have already been `submitted`, and any others are added to it as soon as
+    the first source installing them has been resolved, so that it holds every file
+    submitted even if the scan is stopped.
+    """
+    for source in scheduler.as_completed(sources):
+        # Sources waiting for work which ran out of time aren't evaluated
+        if unfinished(source):
+            continue
+        _, req_files = source.result()
+        for r in filter_extra_pip(repo_path, already_processed, req_files):
+            if r not in submitted:
+                item = requirements_item("extra-pip", repo_path, r)
+                submitted[r] = submit_extra_pip(repo_path, item, scheduler, results)
+                if fail_fast is not None:
+                    submitted[r] = fail_fast.watch(
+                        str(r), submitted[r], pip_package_list
+                    )
+
+    # In the order of the sources installing them, whichever finished first
     output = {}
-    for r in files:
-        reqs = parse_requirements_file(repo_path / r)
-        pip_direct, pip_transitive = pip_from_repo(repo_path, r, reqs)
-        output[r] = (pip_direct, pip_transitive)
+    for source in sources:
+        if unfinished(source):
+            continue
+        _, req_files = source.result()
+        for r in filter_extra_pip(repo_path, already_processed, req_files):
+            output.setdefault(r, submitted[r])
     return output
 
 
+def results_of(futures: Dict[str, "Future[T]"], partial: bool = False) -> Dict[str, T]:
+    """
+    The results of the futures or, if `partial`, of those which finished (the rest were
+    cancelled when the scan was stopped early, or ran out of time).
+    """
+    return {
+        k: f.result() for k, f in futures.items() if not partial or not unfinished(f)
+    }
+
+
 def setup(args: argparse.Namespace):
     print("Setting up user credentials for Confluence.")
     print(f"Configuration will be stored in: {args.user_config.absolute()}")
@@ -196,6 +440,7 @@ def setup(args: argparse.Namespace):
 
 
 def main():
+    start = time.monotonic()
     setup_logging()
     args = parse_args()
     if args.setup:
@@ -203,25 +448,138 @@ def main():
         return
 
     configs.load(args.config, args.user_config)
+    configs.override_apt_index(args)
 
     configs.add_ignored_to_allowlist(args.repository)
+    results = ResultsStore(
+        args.repository, settings_digest(args), args.incremental_base, args.resume
+    )
+
+    # Every file is a work item: Dockerfiles, scripts and notebooks are parsed on a pool of
+    # processes, and the packages of every file resolved as soon as they can be, with
+    # venvs being built for pip requirements while apt packages are looked up.
+    discover_sources(args)
+    history = TimingHistory.in_cache(configs.app.apt.cache_path)
+    deadline = start + args.time_budget if args.time_budget is not None else None
+    with ParseStage(args.parse_workers) as parse_stage, Scheduler(
+        args.network_workers, args.venv_workers, history, deadline
+    ) as scheduler:
+        start_parsing(args, parse_stage, results)
+        plan = plan_scan(args, parse_stage, results)
+        if args.plan:
+            print(format_plan(plan, history, scheduler.limits))
+            return
+
+        # Everything planned is queued before any of it starts, so that each pool starts
+        # the items which took longest in previous runs first
+        with scheduler.held():
+            pip_pending = get_pip(args, plan, scheduler, results)
+            apt_pending = get_apt(args, plan, scheduler, results)
+            submit_plan(args, plan)
+            extra_submitted = submit_planned_extra_pip(
+                args.repository, plan, scheduler, results
+            )
+            docker_pending = get_dockerfile(args, parse_stage, scheduler, results)
+            bash_pending = get_bashfile(args, parse_stage, scheduler, results)
+            notebook_pending = get_notebook(args, parse_stage, scheduler, results)
+            image_pending = get_images(args, plan, scheduler)
+
+        # Each file's packages are checked as soon as it's resolved, stopping at the first
+        # which fails
+        fail_fast = None
+        if args.fail_fast:
+            fail_fast = FailFast(scheduler, args.fail_on_transitive)
+            pip_pending = fail_fast.watch_all(pip_pending, pip_package_list)
+            extra_submitted = fail_fast.watch_all(extra_submitted, pip_package_list)
+            apt_pending = fail_fast.watch_all(apt_pending, apt_package_list)
+            docker_pending, bash_pending, notebook_pending = (
+                fail_fast.watch_all(
+                    pending, lambda result: combined_package_list(result[0])
+                )
+                for pending in [docker_pending, bash_pending, notebook_pending]
+            )
+            image_pending = fail_fast.watch_all(image_pending, combined_package_list)
+
+        sources = [
+            *docker_pending.values(),
+            *bash_pending.values(),
+            *notebook_pending.values(),
+        ]
+        stopped = None
+        try:
+            extra_pending = get_extra_pip(
+                args.repository,
+                list(pip_pending.keys()),
+                sources,
+                extra_submitted,
+                scheduler,
+                results,
+                fail_fast,
+            )
+            scheduler.wait(
+                [
+                    *pip_pending.values(),
+                    *extra_pending.values(),
+                    *apt_pending.values(),
+                    *sources,
+                    *image_pending.values(),
+                ]
+            )
+        except ScanStopped as err:
+            stopped = str(err)
+            # Including those submitted by `get_extra_pip` before it was stopped
+            extra_pending = extra_submitted
+
+        # Files left unfinished when the scan was stopped, or which wouldn't have finished
+        # within the time budget, are reported as not evaluated
+        partial = stopped is not None or args.time_budget is not None
+        not_evaluated = None
+        if partial:
+            not_evaluated = NotEvaluated(
+                stopped or "they wouldn't have been resolved within the time budget",
+                {
+                    source: [str(k) for k, f in pending.items() if unfinished(f)]
+                    for source, pending in [
+                        ("pip", {**pip_pending, **extra_pending}),
+                        ("apt", apt_pending),
+                        ("Docker", docker_pending),
+                        ("Bash", bash_pending),
+                        ("Notebook", notebook_pending),
+                        ("Image", image_pending),
+                    ]
+                },
+            )
+        pip_requirements = {
+            **results_of(pip_pending, partial),
+            **results_of(extra_pending, partial),
+        }
+        apt_requirements = results_of(apt_pending, partial)
+        docker_requirements, bash_requirements, notebook_requirements = (
+            {k: packages for k, (packages, _) in results_of(pending, partial).items()}
+            for pending in [docker_pending, bash_pending, notebook_pending]
+        )
+        image_requirements = results_of(image_pending, partial)
 
-    pip_requirements = get_pip(args)
-    apt_requirements = get_apt(args)
-    docker_requirements, extra_pip_files_docker = get_dockerfile(args)
-    bash_requirements, extra_pip_files_bash = get_bashfile(args)
-    notebook_requirements, extra_pip_files_notebook = get_notebook(args)
+        # Nothing else will be parsed once the scan's stopped
+        if scheduler.stopped.done():
+            parse_stage.shutdown(wait=False)
+    history.save()
 
-    extra_pip_files = (
-        extra_pip_files_docker + extra_pip_files_bash + extra_pip_files_notebook
+    if stopped is not None:
+        print(f"Stopped early, as {stopped}.")
+    incomplete = stopped is not None or (
+        not_evaluated is not None and not not_evaluated.is_empty
     )
+    if not_evaluated is not None and not not_evaluated.is_empty:
+        count = sum(len(files) for files in not_evaluated.files.values())
+        print(f"{count} files weren't evaluated, as {not_evaluated.reason}.")
 
-    if extra_pip_files:
-        extra_pip_files = filter_extra_pip(
-            args.repository, list(pip_requirements.keys()), extra_pip_files
+    if args.incremental_base:
+        print(
+            f"Reused the results of {results.reused} files from {args.incremental_base}"
         )
-        extra_requirements = get_extra_pip(args.repository, extra_pip_files)
-        pip_requirements = {**pip_requirements, **extra_requirements}
+    if args.resume:
+        print(f"Resumed the results of {results.resumed} files from the checkpoint")
 
     problem_packages = extract_problem_packages(
         pip_requirements,
@@ -229,6 +587,7 @@ def main():
         docker_requirements,
         bash_requirements,
         notebook_requirements,
+        image_requirements,
     )
 
     full_html = render(
@@ -238,6 +597,8 @@ def main():
         docker_requirements,
         bash_requirements,
         notebook_requirements,
+        image_requirements,
+        not_evaluated,
     )
 
     if args.output_path:
@@ -245,7 +606,9 @@ def main():
         with open(args.output_path, "w") as fh:
             fh.write(full_html)
 
-    if args.upload_page_id:
+    if args.upload_page_id and incomplete:
+        print("Not uploading the dependencies of an incomplete scan.")
+    elif args.upload_page_id:
         if not configs.user:
             raise ValueError(
                 "Confluence user has not been configured. Please run using --setup to do so."
@@ -278,12 +641,17 @@ def main():
             bash_requirements,
             notebook_requirements,
             args.fail_on_transitive,
+            image_requirements,
+            not_evaluated,
         )
 
         with open(args.junit_path, "w") as fh:
             fh.write(xml_report)
 
-        sys.exit(int(not all_passed))
+        sys.exit(int(not all_passed or incomplete))
+
+    if incomplete:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
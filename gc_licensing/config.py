@@ -1,5 +1,6 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+from argparse import Namespace
 from pathlib import Path
 
 from box import Box
@@ -46,6 +47,15 @@ class Config:
                 "To enable, please run `$ python3 -m gc_licensing --configure`"
             )
 
+    def override_apt_index(self, args: Namespace):
+        """
+        Command line arguments take precedence over the `apt` section of the config file.
+        """
+        for key in ["backend", "release", "architecture", "mirror", "index_files"]:
+            value = getattr(args, f"apt_{key}", None)
+            if value:
+                self.app.apt[key] = value
+
     def add_ignored_to_allowlist(
         self, repo_root: Path, ignore_file: str = ".gclicense-ignore.yml"
     ):
@@ -59,7 +69,7 @@ class Config:
                 if src not in ignore_pkgs:
                     continue
 
-                self.app[src].allowlist = list(
+                self.app[src].allowlist = sorted(
                     set(self.app[src].allowlist + ignore_pkgs[src])
                 )
 
@@ -0,0 +1,71 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, TypeVar
+
+from .junit import failing_licenses
+from .package import AnyPackage, AptPackages, CombinedPackages, PipPackages
+from .scheduler import Scheduler, then
+
+
+K = TypeVar("K")
+T = TypeVar("T")
+
+
+def pip_package_list(packages: PipPackages) -> List[AnyPackage]:
+    direct, transitive = packages
+    return direct + transitive
+
+
+def apt_package_list(packages: AptPackages) -> List[AnyPackage]:
+    return list(packages)
+
+
+def combined_package_list(packages: CombinedPackages) -> List[AnyPackage]:
+    pip, apt = packages
+    return pip_package_list(pip) + apt_package_list(apt)
+
+
+class FailFast:
+    """
+    Checks the packages found in each file as soon as it's resolved, rather than once the
+    whole scan has finished, and stops the scan at the first package failing the check
+    (i.e. one which would fail its JUnit test case).
+    """
+
+    def __init__(self, scheduler: Scheduler, fail_on_transitive: bool):
+        self.scheduler = scheduler
+        self.fail_on_transitive = fail_on_transitive
+
+    def watch(
+        self,
+        name: str,
+        future: "Future[T]",
+        packages_of: Callable[[T], Iterable[AnyPackage]],
+    ) -> "Future[T]":
+        """
+        A future for the result of `future`, once its packages have been checked.
+        """
+
+        def check(result: T) -> T:
+            for p in packages_of(result):
+                licenses = failing_licenses(p, self.fail_on_transitive)
+                if licenses:
+                    reasons = "; ".join(str(l.reason_string) for l in licenses)
+                    self.scheduler.stop(
+                        f"{p.name_version} in {name} failed the check [{reasons}]"
+                    )
+                    break
+            return result
+
+        return then(future, check)
+
+    def watch_all(
+        self,
+        futures: Dict[K, "Future[T]"],
+        packages_of: Callable[[T], Iterable[AnyPackage]],
+    ) -> Dict[K, "Future[T]"]:
+        return {
+            name: self.watch(str(name), future, packages_of)
+            for name, future in futures.items()
+        }
@@ -0,0 +1,197 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import argparse
+import hashlib
+import logging
+import mmap
+import re
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .config import configs
+from .license_index import match_license
+
+
+# <magic> <number of records> <length of the names table>
+HEADER = struct.Struct(">8sII")
+MAGIC = b"GCLFP\x00\x00\x01"
+
+# <fingerprint of normalized text> <index into the names table>, sorted by fingerprint
+RECORD = struct.Struct(">16sH")
+
+COPYRIGHT_LINE = re.compile(
+    r"^\s*(?:copyright\s*(?:\(c\)|©|\d)|\(c\)|©|all rights reserved)", re.IGNORECASE
+)
+
+
+def normalize_license_text(text: str) -> str:
+    """
+    Reduces a license text to the words that make up the license itself, so that it
+    fingerprints the same regardless of copyright holders, title, wrapping, case and
+    punctuation.
+    """
+    lines = [l for l in text.splitlines() if not COPYRIGHT_LINE.match(l)]
+    lines = [l for l in lines if l.strip()]
+
+    # Drop a title line (e.g. `MIT License`), which only some copies include.
+    if lines and "licen" in lines[0].lower() and not re.search(r"[.,;:]", lines[0]):
+        lines = lines[1:]
+
+    text = " ".join(lines).lower().replace("licence", "license")
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+def fingerprint(text: str) -> bytes:
+    return hashlib.blake2b(
+        normalize_license_text(text).encode(), digest_size=16
+    ).digest()
+
+
+@dataclass(frozen=True)
+class DetectedLicense:
+    name: str
+    evidence: str
+
+
+class FingerprintIndex:
+    """
+    Read-only view of an index built by `build_fingerprint_index`. The file is
+    memory-mapped and the sorted fixed size records binary searched, so opening it and
+    looking up a fingerprint are both independent of the number of known texts.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count, names_size = HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a license fingerprint index")
+
+        names_offset = HEADER.size + self._count * RECORD.size
+        names = self._data[names_offset : names_offset + names_size]
+        self._names = names.decode().split("\n")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _record(self, i: int) -> Tuple[bytes, int]:
+        return RECORD.unpack_from(self._data, HEADER.size + i * RECORD.size)
+
+    def lookup_fingerprint(self, digest: bytes) -> Optional[str]:
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_digest, name_index = self._record(mid)
+            if mid_digest == digest:
+                return self._names[name_index]
+            if mid_digest < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def detect(self, text: str) -> Optional[DetectedLicense]:
+        digest = fingerprint(text)
+        name = self.lookup_fingerprint(digest)
+        if name is None:
+            return None
+        return DetectedLicense(
+            name, f"License file text matches {name} (fingerprint {digest.hex()[:12]})"
+        )
+
+
+def build_fingerprint_index(texts: Iterable[Tuple[str, str]], output_path: Path):
+    """
+    Writes an index of the fingerprints of (license name, license text) pairs.
+    """
+    names: List[str] = []
+    name_indices: Dict[str, int] = {}
+    records: Dict[bytes, int] = {}
+    for name, text in texts:
+        if name not in name_indices:
+            name_indices[name] = len(names)
+            names.append(name)
+
+        digest = fingerprint(text)
+        if digest in records and names[records[digest]] != name:
+            logging.warning(
+                f"{name} has the same text as {names[records[digest]]}, keeping the first"
+            )
+            continue
+        records[digest] = name_indices[name]
+
+    names_table = "\n".join(names).encode()
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(output_path, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, len(records), len(names_table)))
+        for digest in sorted(records):
+            fh.write(RECORD.pack(digest, records[digest]))
+        fh.write(names_table)
+
+
+def license_texts_from_paths(paths: List[Path]) -> Iterable[Tuple[str, str]]:
+    """
+    Reads license texts named by their file stem, e.g. SPDX's `license-list-data/text/MIT.txt`
+    or Debian's `/usr/share/common-licenses/GPL-2`. Names with a canonical identifier are
+    stored under it.
+    """
+    for path in paths:
+        files = (
+            sorted(f for f in path.rglob("*") if f.is_file() and not f.is_symlink())
+            if path.is_dir()
+            else [path]
+        )
+        for f in files:
+            stem = f.stem if f.suffix == ".txt" else f.name
+            match = match_license(stem)
+            name = match.canonical if match and match.confidence == 1.0 else stem
+            yield name, f.read_text(errors="replace")
+
+
+_fingerprint_indexes: Dict[Path, Optional[FingerprintIndex]] = {}
+
+
+def fingerprint_index() -> Optional[FingerprintIndex]:
+    """
+    The index configured by `license.fingerprint_index`, opened once per run.
+    """
+    path = configs.app.license.get("fingerprint_index")
+    if not path:
+        return None
+
+    path = Path(path)
+    if path not in _fingerprint_indexes:
+        try:
+            _fingerprint_indexes[path] = FingerprintIndex(path)
+        except (OSError, ValueError) as err:
+            logging.warning(f"Couldn't open license fingerprint index {path}: {err}")
+            _fingerprint_indexes[path] = None
+    return _fingerprint_indexes[path]
+
+
+def detect_license(text: Optional[str]) -> Optional[DetectedLicense]:
+    index = fingerprint_index()
+    if index is None or not text:
+        return None
+    return index.detect(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a license fingerprint index from files of known license texts."
+    )
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument(
+        "paths",
+        type=Path,
+        nargs="+",
+        help="License text files, or directories of them, named by license.",
+    )
+    args = parser.parse_args()
+
+    build_fingerprint_index(license_texts_from_paths(args.paths), args.output)
+    print(f"Wrote {len(FingerprintIndex(args.output))} fingerprints to {args.output}")
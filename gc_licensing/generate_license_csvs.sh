@@ -62,6 +62,9 @@ pip install -r $APP_REQUIREMENTS
 
 pip-licenses -f csv --output-file ${APP_ROOT_DIRECTORY}/${APP_NAME}-after.csv
 
+# License file contents, to identify packages whose metadata doesn't name their license
+pip-licenses -f json --with-license-file --no-license-path --output-file ${APP_ROOT_DIRECTORY}/${APP_NAME}-license-texts.json
+
 # pip install pipdeptree
 # pipdeptree > ${SCRIPT_ROOT}/../${APP_NAME}-tree.txt
 
@@ -0,0 +1,353 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import argparse
+import hashlib
+import json
+import logging
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import __version__
+from .config import configs
+from .package import (
+    AptPackage,
+    AptPackages,
+    CombinedPackages,
+    PipPackage,
+    PipPackages,
+)
+from .store import PackStore
+
+
+# Bump when the results stored for each file change, to invalidate stored results
+RESULTS_VERSION = 2
+
+# Arguments which change the results found for a file
+RESULT_ARGUMENTS = [
+    "apt_follow_depends",
+    "apt_backend",
+    "apt_release",
+    "apt_architecture",
+    "apt_mirror",
+    "apt_index_files",
+    "bash_no_follow_requirements_files",
+    "docker_no_follow_requirements_files",
+    "notebook_no_follow_requirements_files",
+    "docker_image_map",
+]
+# Arguments naming files whose contents change the results found for a file
+RESULT_FILE_ARGUMENTS = ["pip_before_install", "pip_after_install", "pip_license_texts"]
+
+
+def _git(repository: Path, *args: str) -> Optional[bytes]:
+    try:
+        result = subprocess.run(
+            ["git", "-C", str(repository), *args], capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout
+
+
+def _git_paths(repository: Path, *args: str) -> Optional[Set[str]]:
+    output = _git(repository, *args)
+    if output is None:
+        return None
+    return {p for p in output.decode(errors="surrogateescape").split("\0") if p}
+
+
+def _file_digest(path: Path) -> str:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return "missing"
+
+
+def _pip_to_json(packages: PipPackages) -> List[List[Dict[str, Any]]]:
+    return [[p.to_dict() for p in group] for group in packages]
+
+
+def _pip_from_json(packages: List[List[Dict[str, Any]]]) -> PipPackages:
+    direct, transitive = packages
+    return (
+        [PipPackage.from_dict(p) for p in direct],
+        [PipPackage.from_dict(p) for p in transitive],
+    )
+
+
+def result_to_json(kind: str, result: Any) -> Any:
+    """
+    The data of a file's result, as stored: only the fields of its packages, so that
+    reading results never runs any code (which a poisoned shared cache could provide).
+    """
+    if kind in ("pip", "extra-pip"):
+        return _pip_to_json(result)
+    if kind == "apt":
+        return [p.to_dict() for p in result]
+    # The packages of a Dockerfile, script or notebook, and the requirements files it installs
+    (pip, apt), requirements_files = result
+    return {
+        "pip": _pip_to_json(pip),
+        "apt": [p.to_dict() for p in apt],
+        "requirements_files": requirements_files,
+    }
+
+
+def result_from_json(kind: str, data: Any) -> Any:
+    if kind in ("pip", "extra-pip"):
+        return _pip_from_json(data)
+    if kind == "apt":
+        return [AptPackage.from_dict(p) for p in data]
+    packages: CombinedPackages = (
+        _pip_from_json(data["pip"]),
+        [AptPackage.from_dict(p) for p in data["apt"]],
+    )
+    return packages, [str(f) for f in data["requirements_files"]]
+
+
+def settings_digest(args: argparse.Namespace) -> str:
+    """
+    Identifies everything other than the repository's files that a file's results depend
+    on: the config (including the repository's ignore file), the arguments that change what
+    is resolved and this version of the tool.
+    """
+    settings = {
+        "version": [__version__, RESULTS_VERSION],
+        "config": configs.app.to_dict(),
+        "args": {a: getattr(args, a, None) for a in RESULT_ARGUMENTS},
+        "files": {},
+    }
+    for a in RESULT_FILE_ARGUMENTS:
+        path = getattr(args, a, None)
+        if path:
+            settings["files"][a] = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+class ResultsStore:
+    """
+    Stores the results found for each file against the commit they were found at, so that
+    an incremental scan against a base commit only re-resolves the files that changed since
+    it: those that differ themselves, or whose dependencies (e.g. `-r` includes, sourced
+    scripts, requirements files copied into Dockerfiles) differ.
+
+    Results are only stored when all of a file's dependencies match the commit checked out,
+    so uncommitted changes never end up stored against it. Outside a git repository nothing
+    is stored or reused.
+
+    With `resume`, every result is also checkpointed as soon as it's found, git repository
+    or not, along with the digests of the contents of the file and its dependencies, and
+    the checkpointed results of the files whose contents are unchanged are reused, e.g. to
+    carry on from a scan which crashed or was preempted. Checkpoints are only written when
+    resuming, as every one is appended to the store.
+    """
+
+    def __init__(
+        self,
+        repository: Path,
+        settings: str,
+        base_ref: Optional[str] = None,
+        resume: bool = False,
+    ):
+        self.repository = repository.resolve()
+        self.settings = settings
+        self.resume = resume
+        self.store = PackStore(Path(configs.app.apt.cache_path), "results")
+
+        self.head = self._rev_parse("HEAD")
+        self.dirty = self._changed_since(self.head) if self.head else None
+
+        self.base: Optional[str] = None
+        self.changed: Optional[Set[str]] = None
+        if base_ref:
+            self.base = self._rev_parse(base_ref)
+            self.changed = self._changed_since(self.base) if self.base else None
+            if self.changed is None:
+                logging.warning(
+                    f"Couldn't compare {repository} with {base_ref}, scanning everything."
+                )
+                self.base = None
+            else:
+                print(
+                    f"Incremental scan: {len(self.changed)} files changed since {base_ref}"
+                )
+
+        self._reused: Set[Tuple[str, str]] = set()
+        self._resumed: Set[Tuple[str, str]] = set()
+        # (kind, path): where the result was reused from ("base" or "checkpoint") and it
+        self._entries: Dict[Tuple[str, str], Optional[Tuple[str, Any]]] = {}
+
+    @property
+    def reused(self) -> int:
+        """
+        How many files' results have been reused from the base scan.
+        """
+        return len(self._reused)
+
+    @property
+    def resumed(self) -> int:
+        """
+        How many files' results have been reused from the checkpoint.
+        """
+        return len(self._resumed)
+
+    def _rev_parse(self, ref: str) -> Optional[str]:
+        output = _git(
+            self.repository, "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}"
+        )
+        return output.decode().strip() if output else None
+
+    def _changed_since(self, commit: str) -> Optional[Set[str]]:
+        """
+        The files (relative to the repository) that differ from `commit` in the working
+        tree, whether committed, staged, modified or untracked.
+        """
+        changed = _git_paths(
+            self.repository,
+            "diff",
+            "--name-only",
+            "--relative",
+            "--no-renames",
+            "-z",
+            commit,
+        )
+        untracked = _git_paths(
+            self.repository, "ls-files", "--others", "--exclude-standard", "-z"
+        )
+        if changed is None or untracked is None:
+            return None
+        return changed | untracked
+
+    def _relative(self, path: Path) -> Optional[str]:
+        if not path.is_absolute():
+            return path.as_posix()
+        try:
+            return path.resolve().relative_to(self.repository).as_posix()
+        except ValueError:
+            return None
+
+    def _key(self, commit: str, kind: str, path: Path) -> str:
+        name = self._relative(path) or path.as_posix()
+        return f"results-v{RESULTS_VERSION}/{commit}/{self.settings}/{kind}/{name}"
+
+    def _checkpoint_key(self, kind: str, path: Path) -> str:
+        name = self._relative(path) or path.as_posix()
+        return f"checkpoint-v{RESULTS_VERSION}/{self.settings}/{kind}/{name}"
+
+    def _load(self, key: str, kind: str, path: Path) -> Optional[Tuple[Any, Any]]:
+        """
+        The file's dependencies (or their digests, for a checkpoint) and result stored under
+        `key`, if any.
+        """
+        data = self.store.get(key)
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+            return entry["dependencies"], result_from_json(kind, entry["result"])
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            logging.warning(f"Ignoring unreadable results for {path}: {err!r}")
+            return None
+
+    def _put_entry(self, key: str, kind: str, dependencies: Any, result: Any):
+        entry = {"dependencies": dependencies, "result": result_to_json(kind, result)}
+        self.store.put_text(key, json.dumps(entry, sort_keys=True))
+
+    def _put(self, kind: str, path: Path, dependencies: List[str], result: Any):
+        # Without knowing what changed since HEAD, nothing can be stored against it
+        if (
+            self.head is None
+            or self.dirty is None
+            or any(d in self.dirty for d in dependencies)
+        ):
+            return
+        self._put_entry(self._key(self.head, kind, path), kind, dependencies, result)
+
+    def _reuse_base(self, kind: str, path: Path) -> Optional[Any]:
+        if self.base is None:
+            return None
+        entry = self._load(self._key(self.base, kind, path), kind, path)
+        if entry is None or any(d in self.changed for d in entry[0]):
+            return None
+        # Carry the result forward, for scans based on this commit
+        self._put(kind, path, *entry)
+        return entry[1]
+
+    def _reuse_checkpoint(self, kind: str, path: Path) -> Optional[Any]:
+        if not self.resume:
+            return None
+        entry = self._load(self._checkpoint_key(kind, path), kind, path)
+        if entry is None:
+            return None
+        digests, result = entry
+        if any(_file_digest(self.repository / d) != v for d, v in digests.items()):
+            return None
+        self._put(kind, path, sorted(digests), result)
+        return result
+
+    def reuse(self, kind: str, path: Path) -> Optional[Any]:
+        """
+        The result found for a file by the base scan, if none of its dependencies changed,
+        or with `resume` the result checkpointed for the same contents.
+        """
+        entry_key = (kind, path.as_posix())
+        if entry_key not in self._entries:
+            entry = None
+            result = self._reuse_base(kind, path)
+            if result is not None:
+                entry = ("base", result)
+            else:
+                result = self._reuse_checkpoint(kind, path)
+                if result is not None:
+                    entry = ("checkpoint", result)
+            self._entries[entry_key] = entry
+
+        entry = self._entries[entry_key]
+        if entry is None:
+            return None
+        origin, result = entry
+        (self._reused if origin == "base" else self._resumed).add(entry_key)
+        return result
+
+    def record(self, kind: str, path: Path, dependencies: Iterable[Path], result: Any):
+        relative = [self._relative(d) for d in [path, *dependencies]]
+        names = sorted(set(d for d in relative if d is not None))
+        self._put(kind, path, names, result)
+        if not self.resume:
+            return
+        digests = {d: _file_digest(self.repository / d) for d in names}
+        self._put_entry(self._checkpoint_key(kind, path), kind, digests, result)
+
+    def reuse_source(
+        self, kind: str, path: Path
+    ) -> Optional[Tuple[CombinedPackages, List[Path]]]:
+        """
+        The packages found in a Dockerfile, script or notebook by the base scan, and the
+        requirements files it installs.
+        """
+        entry = self.reuse(kind, path)
+        if entry is None:
+            return None
+        packages, requirements_files = entry
+        return packages, [self.repository / f for f in requirements_files]
+
+    def record_source(
+        self,
+        kind: str,
+        path: Path,
+        dependencies: Iterable[Path],
+        packages: CombinedPackages,
+        requirements_files: List[Path],
+    ):
+        # Requirements files are stored relative to the repository, as it may be checked
+        # out somewhere else when they're reused
+        relative = [self._relative(f) for f in requirements_files]
+        self.record(
+            kind,
+            path,
+            [*dependencies, *requirements_files],
+            (packages, [f for f in relative if f is not None]),
+        )
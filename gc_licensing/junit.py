@@ -3,6 +3,7 @@
 from typing import Dict, List, Optional, Tuple, Union
 from junit_xml import TestCase, TestSuite, to_xml_report_string
 
+from .license import License
 from .package import (
     AnyPackage,
     PipPackage,
@@ -12,9 +13,23 @@ from .package import (
     CombinedPackages,
 )
 
+from .problem_packages import NotEvaluated
+
 import logging
 
 
+def failing_licenses(p: AnyPackage, fail_on_transitive: bool) -> List[License]:
+    """
+    The licenses of a package which fail its test case: those of direct dependencies (and
+    of transitive ones too with `fail_on_transitive`) which aren't allowed.
+    """
+    if not (p.is_direct or fail_on_transitive):
+        return []
+    if isinstance(p, AptPackage):
+        return p.problem_licenses(include_transitive=fail_on_transitive)
+    return p.problem_licenses()
+
+
 def suite_for_file(
     filename: str,
     fail_on_transitive: bool,
@@ -48,15 +63,9 @@ def suite_for_file(
             s.test_cases.append(c)
             return
 
-        pl_args = (
-            {"include_transitive": fail_on_transitive}
-            if isinstance(p, AptPackage)
-            else {}
-        )
-
-        problem_licenses = p.problem_licenses(**pl_args)
+        problem_licenses = failing_licenses(p, fail_on_transitive)
 
-        if problem_licenses and (p.is_direct or fail_on_transitive):
+        if problem_licenses:
             invalid_license_names = "; ".join(
                 str(l.reason_string) for l in problem_licenses
             )
@@ -124,6 +133,22 @@ def append_suites_combined(
         )
 
 
+def append_suites_not_evaluated(
+    suites=List[TestSuite], not_evaluated: Optional[NotEvaluated] = None
+):
+    if not not_evaluated:
+        return
+
+    for source, files in not_evaluated.files.items():
+        for fn in files:
+            c = TestCase("not evaluated", classname=fn)
+            c.add_error_info(
+                message=f"Not evaluated, as {not_evaluated.reason}",
+                error_type="not evaluated",
+            )
+            suites.append(TestSuite(fn, [c], properties={"source": source}))
+
+
 def generate_junit_output(
     pip_requirements: Optional[Dict[str, PipPackages]] = None,
     apt_requirements: Optional[Dict[str, AptPackages]] = None,
@@ -131,6 +156,8 @@ def generate_junit_output(
     bash_requirements: Optional[Dict[str, CombinedPackages]] = None,
     notebook_requirements: Optional[Dict[str, CombinedPackages]] = None,
     fail_on_transitive: bool = False,
+    image_requirements: Optional[Dict[str, CombinedPackages]] = None,
+    not_evaluated: Optional[NotEvaluated] = None,
 ) -> Tuple[str, bool]:
     suites = []
 
@@ -139,6 +166,8 @@ def generate_junit_output(
     append_suites_combined(suites, dockerfile_requirements, fail_on_transitive)
     append_suites_combined(suites, bash_requirements, fail_on_transitive)
     append_suites_combined(suites, notebook_requirements, fail_on_transitive)
+    append_suites_combined(suites, image_requirements, fail_on_transitive)
+    append_suites_not_evaluated(suites, not_evaluated)
 
     all_passed = len(suites) == 0
 
@@ -2,16 +2,45 @@
 
 import re
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from airium import Airium
 
 from .config import configs
+from .license_index import EXCEPTION, match_license
+from .lookup import lookups
 
+# Minimum confidence for a fuzzy license match to be checked against the allowlist
+DEFAULT_FUZZY_THRESHOLD = 0.85
 
-def in_license_list(license_name: str, license_list: List[str]) -> bool:
+
+def in_license_list(
+    license_name: str, license_list: List[str], exact: bool = False
+) -> bool:
+    match = re.fullmatch if exact else re.match
+    return any(
+        [match(l, license_name, re.IGNORECASE) is not None for l in license_list]
+    )
+
+
+def license_allowed(
+    license_name: str, allowlist: Tuple[str, ...], threshold: float
+) -> bool:
+    # A license `with` an exception or anything else must be allowed as a whole, rather
+    # than by the license it modifies (e.g. `MIT with non-commercial restriction`).
+    if in_license_list(
+        license_name, allowlist, exact=EXCEPTION.search(license_name) is not None
+    ):
+        return True
+
+    # Non-standard names (e.g. `Expat`, `GPLv2+`, `BSD-3-clause~with-exception`) are
+    # checked by their canonical identifiers instead.
+    match = match_license(license_name)
+    if match is None or match.confidence < threshold:
+        return False
     return any(
-        [re.match(l, license_name, re.IGNORECASE) is not None for l in license_list]
+        all(in_license_list(l, allowlist, exact=" WITH " in l) for l in option)
+        for option in match.options
     )
 
 
@@ -24,7 +53,14 @@ class License:
     def ok(self):
         if self.override_license is not None:
             return self.override_license
-        return in_license_list(self.name, configs.app.license.allowlist)
+
+        # Every package with the same license shares a single evaluation
+        allowlist = tuple(configs.app.license.allowlist)
+        threshold = configs.app.license.get("fuzzy_threshold", DEFAULT_FUZZY_THRESHOLD)
+        return lookups.get(
+            ("license", self.name, allowlist, threshold),
+            lambda: license_allowed(self.name, allowlist, threshold),
+        )
 
     def render(self, a: Airium, suffix: str = ""):
         a.div(
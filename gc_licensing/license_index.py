@@ -0,0 +1,330 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+# Canonical (SPDX style) identifiers and some of the many ways they get written in
+# Debian copyright files and Python package metadata. Only the canonical names need to be
+# matched by the allowlist in config.yml.
+KNOWN_LICENSES: Dict[str, List[str]] = {
+    "MIT": ["MIT", "MIT License", "Expat", "Expat License", "MIT/Expat"],
+    "MIT-0": ["MIT-0", "MIT No Attribution"],
+    "X11": ["X11", "X11 License", "MIT/X11", "X Consortium"],
+    "ISC": ["ISC", "ISC License", "ISC License (ISCL)", "ISCL"],
+    "0BSD": ["0BSD", "Zero-Clause BSD", "BSD Zero Clause"],
+    "BSD-2-Clause": [
+        "BSD-2-Clause",
+        "BSD 2-Clause",
+        "2-Clause BSD",
+        "Simplified BSD",
+        "FreeBSD",
+        "BSD-2",
+    ],
+    "BSD-3-Clause": [
+        "BSD-3-Clause",
+        "BSD 3-Clause",
+        "3-Clause BSD",
+        "New BSD",
+        "Modified BSD",
+        "Revised BSD",
+        "BSD-3",
+    ],
+    "BSD-4-Clause": ["BSD-4-Clause", "BSD 4-Clause", "Original BSD", "BSD-4"],
+    "Apache-1.1": ["Apache-1.1", "Apache License 1.1"],
+    "Apache-2.0": [
+        "Apache-2.0",
+        "Apache 2",
+        "Apache License 2.0",
+        "Apache License, Version 2.0",
+        "Apache Software License",
+        "Apache Software License 2.0",
+        "ASL 2.0",
+    ],
+    "GPL-1.0-or-later": ["GPL-1+", "GPLv1+", "GPL-1.0+"],
+    "GPL-2.0-only": ["GPL-2", "GPLv2", "GPL-2.0", "GNU General Public License v2"],
+    "GPL-2.0-or-later": ["GPL-2+", "GPLv2+", "GPL-2.0+", "GPL-2 or later"],
+    "GPL-3.0-only": ["GPL-3", "GPLv3", "GPL-3.0", "GNU General Public License v3"],
+    "GPL-3.0-or-later": ["GPL-3+", "GPLv3+", "GPL-3.0+", "GPL-3 or later"],
+    "LGPL-2.0-only": ["LGPL-2", "LGPLv2", "LGPL-2.0"],
+    "LGPL-2.0-or-later": ["LGPL-2+", "LGPLv2+", "LGPL-2.0+"],
+    "LGPL-2.1-only": ["LGPL-2.1", "LGPLv2.1", "GNU Lesser General Public License v2.1"],
+    "LGPL-2.1-or-later": ["LGPL-2.1+", "LGPLv2.1+"],
+    "LGPL-3.0-only": ["LGPL-3", "LGPLv3", "LGPL-3.0"],
+    "LGPL-3.0-or-later": ["LGPL-3+", "LGPLv3+", "LGPL-3.0+"],
+    "AGPL-3.0-only": ["AGPL-3", "AGPLv3", "AGPL-3.0"],
+    "AGPL-3.0-or-later": ["AGPL-3+", "AGPLv3+", "AGPL-3.0+"],
+    "GFDL-1.2": ["GFDL-1.2", "GFDL-1.2+"],
+    "GFDL-1.3": ["GFDL-1.3", "GFDL-1.3+"],
+    "MPL-1.1": ["MPL-1.1", "Mozilla Public License 1.1"],
+    "MPL-2.0": ["MPL-2.0", "MPL 2", "Mozilla Public License 2.0"],
+    "EPL-1.0": ["EPL-1.0", "Eclipse Public License 1.0"],
+    "EPL-2.0": ["EPL-2.0", "Eclipse Public License 2.0"],
+    "CDDL-1.0": ["CDDL-1.0", "CDDL"],
+    "PSF-2.0": [
+        "PSF-2.0",
+        "PSF",
+        "PSF-2",
+        "Python",
+        "Python Software Foundation License",
+        "Python-2.0",
+    ],
+    "Zlib": ["Zlib", "zlib License", "zlib/libpng"],
+    "Libpng": ["Libpng", "libpng License"],
+    "BSL-1.0": ["BSL-1.0", "BSL-1", "Boost Software License", "Boost"],
+    "Artistic-1.0": ["Artistic", "Artistic-1", "Artistic License"],
+    "Artistic-2.0": ["Artistic-2", "Artistic License 2.0"],
+    "Unlicense": ["Unlicense", "The Unlicense"],
+    "CC0-1.0": ["CC0", "CC0-1.0", "Creative Commons Zero"],
+    "CC-BY-3.0": ["CC-BY-3.0", "CC-BY-3"],
+    "CC-BY-4.0": ["CC-BY-4.0", "CC-BY-4"],
+    "CC-BY-SA-3.0": ["CC-BY-SA-3.0", "CC-BY-SA-3"],
+    "CC-BY-SA-4.0": ["CC-BY-SA-4.0", "CC-BY-SA-4"],
+    "OFL-1.1": ["OFL-1.1", "SIL Open Font License 1.1", "SIL-OFL-1.1"],
+    "OpenSSL": ["OpenSSL", "OpenSSL License"],
+    "curl": ["curl", "curl License"],
+    "FTL": ["FTL", "FreeType License", "FreeType"],
+    "IJG": ["IJG", "Independent JPEG Group"],
+    "WTFPL": ["WTFPL"],
+    "public-domain": ["public-domain", "Public Domain", "PD"],
+}
+
+# SPDX license exceptions, which are only recognised in `<license> with <exception>` by
+# these names, or if they're called an exception: any other `with` clause (e.g. `with
+# advertising clause`) may restrict the license, so the name isn't matched at all.
+KNOWN_EXCEPTIONS: Dict[str, List[str]] = {
+    "OpenSSL-exception": ["OpenSSL", "OpenSSL linking"],
+    "LLVM-exception": ["LLVM"],
+    "GCC-exception-2.0": ["GCC-2.0", "GCC runtime library 2.0"],
+    "GCC-exception-3.1": [
+        "GCC-3.1",
+        "GCC runtime library 3.1",
+        "GCC runtime library",
+        "GCC runtime",
+    ],
+    "Classpath-exception-2.0": ["Classpath", "Classpath-2.0", "GNU Classpath"],
+    "Autoconf-exception-2.0": ["Autoconf-2.0"],
+    "Autoconf-exception-3.0": ["Autoconf-3.0"],
+    "Bison-exception-2.2": ["Bison", "Bison-2.2"],
+    "Font-exception-2.0": ["Font", "Font-2.0"],
+    "Libtool-exception": ["Libtool"],
+    "Linux-syscall-note": ["Linux syscall", "Linux syscall note"],
+    "Qt-LGPL-exception-1.1": ["Qt LGPL 1.1", "Qt LGPL"],
+    "WxWindows-exception-3.1": ["wxWindows", "wxWindows 3.1"],
+    "eCos-exception-2.0": ["eCos", "eCos-2.0"],
+    "u-boot-exception-2.0": ["u-boot", "u-boot-2.0"],
+}
+
+OR_LATER = (
+    r"\bor[\s\-~]+(?:\(at\s+your\s+option\)\s+)?(?:any[\s\-~]+)?"
+    r"(?:later|newer|greater)(?:[\s\-~]+versions?)?\b"
+)
+
+# Phrases rewritten into the short forms used by the aliases before tokenizing
+PHRASES = [
+    (r"\blicen[cs]e[sd]?\b", " license "),
+    (r"\bgnu\b", " "),
+    (r"\b(?:lesser|library)\s+general\s+public\b", " lgpl "),
+    (r"\baffero\s+general\s+public\b", " agpl "),
+    (r"\bgeneral\s+public\b", " gpl "),
+    (OR_LATER, " orlater "),
+    (r"\+", " orlater "),
+    (r"(?<=[a-z])v(?=\d)", " "),
+]
+STOPWORDS = {"license", "the", "version", "only", "v", "of", "terms"}
+
+EXCEPTION = re.compile(r"[\s~\-]+with[\s~\-]+(.+?)\s*$", re.IGNORECASE)
+OR_SPLIT = re.compile(r"\s+or\s+|\s*\|\s*", re.IGNORECASE)
+AND_SPLIT = re.compile(r"\s+and\s+|\s*,(?!\s*version)\s*|\s*&\s*", re.IGNORECASE)
+TOKEN = re.compile(r"[a-z]+|\d+(?:\.\d+)*")
+
+
+def _normalize_version(token: str) -> str:
+    # `2.0` and `2` are the same version
+    while token.endswith(".0"):
+        token = token[:-2]
+    return token
+
+
+def license_tokens(name: str) -> Tuple[str, ...]:
+    """
+    Normalizes a single license name into a sorted tuple of tokens, so that different
+    spellings of the same license (`GPLv2+`, `GPL-2.0+`, `GNU General Public License v2
+    or later`) end up with the same tokens.
+    """
+    name = name.lower()
+    for pattern, replacement in PHRASES:
+        name = re.sub(pattern, replacement, name)
+    tokens = [_normalize_version(t) for t in TOKEN.findall(name)]
+    return tuple(sorted(set(t for t in tokens if t not in STOPWORDS)))
+
+
+def exception_tokens(name: str) -> Tuple[str, ...]:
+    return tuple(t for t in license_tokens(name) if t != "exception")
+
+
+def _trigrams(key: str) -> Set[str]:
+    key = f"  {key} "
+    return {key[i : i + 3] for i in range(len(key) - 2)}
+
+
+def _inflection(token: str, candidate: Tuple[str, ...]) -> bool:
+    # e.g. `clauses` for `clause`, but not `s` for `sa`
+    return any(
+        min(len(token), len(t)) >= 3 and (token.startswith(t) or t.startswith(token))
+        for t in candidate
+    )
+
+
+def _compatible(query: Tuple[str, ...], candidate: Tuple[str, ...]) -> bool:
+    """
+    Fuzzy matches must never change the version or the "or later" part of a license, nor
+    drop any of its words: those are often restrictions (`NC`, `ND`, `UC`, `no-nuclear`)
+    which make it a different, less permissive license.
+    """
+
+    def versioned(tokens: Tuple[str, ...]) -> Set[str]:
+        return {t for t in tokens if t[0].isdigit() or t == "orlater"}
+
+    if versioned(query) != versioned(candidate):
+        return False
+    return all(
+        t in candidate or _inflection(t, candidate)
+        for t in query
+        if not t[0].isdigit() and t != "orlater"
+    )
+
+
+@dataclass(frozen=True)
+class LicenseMatch:
+    """
+    The canonical form of a free-form license name. `options` is the license expression
+    in disjunctive form, i.e. the package can be used under any one of the options, each
+    of which requires all of its licenses.
+    """
+
+    name: str
+    options: Tuple[Tuple[str, ...], ...]
+    confidence: float
+
+    @property
+    def canonical(self) -> str:
+        return " OR ".join(" AND ".join(o) for o in self.options)
+
+
+class LicenseIndex:
+    """
+    Maps free-form license names to canonical identifiers. Exact matches are found by their
+    normalized tokens, anything else falls back to the character trigram similarity of the
+    tokens (Dice coefficient), looked up through an inverted trigram index.
+    """
+
+    def __init__(
+        self,
+        licenses: Dict[str, List[str]],
+        exceptions: Optional[Dict[str, List[str]]] = None,
+    ):
+        self._exact: Dict[Tuple[str, ...], str] = {}
+        self._exceptions: Dict[Tuple[str, ...], str] = {}
+        self._keys: List[Tuple[Tuple[str, ...], str, int]] = []
+        self._trigram_index: Dict[str, List[int]] = defaultdict(list)
+        self._matches: Dict[str, Optional[LicenseMatch]] = {}
+
+        for canonical, aliases in licenses.items():
+            for alias in [canonical] + aliases:
+                tokens = license_tokens(alias)
+                if tokens in self._exact:
+                    continue
+                self._exact[tokens] = canonical
+
+                trigrams = _trigrams(" ".join(tokens))
+                for t in trigrams:
+                    self._trigram_index[t].append(len(self._keys))
+                self._keys.append((tokens, canonical, len(trigrams)))
+
+        for canonical, aliases in (exceptions or {}).items():
+            for alias in [canonical] + aliases:
+                self._exceptions.setdefault(exception_tokens(alias), canonical)
+
+    def match_exception(self, clause: str) -> Optional[str]:
+        """
+        The SPDX exception named by the clause of `<license> with <clause>`, or the clause
+        itself if it's called an exception. Anything else isn't an exception.
+        """
+        known = self._exceptions.get(exception_tokens(clause))
+        if known is not None:
+            return known
+        if not re.search(r"exception$", clause, re.IGNORECASE):
+            return None
+        return re.sub(r"[\s~]+", "-", clause)
+
+    def match_single(self, name: str) -> Tuple[Optional[str], float]:
+        exception = None
+        clause = EXCEPTION.search(name)
+        if clause:
+            exception = self.match_exception(clause[1])
+            if exception is None:
+                return None, 0.0
+            name = name[: clause.start()]
+
+        tokens = license_tokens(name)
+        canonical, confidence = self._exact.get(tokens), 1.0
+        if canonical is None and tokens:
+            trigrams = _trigrams(" ".join(tokens))
+            overlaps = Counter(
+                i for t in trigrams for i in self._trigram_index.get(t, [])
+            )
+            confidence = 0.0
+            for i, overlap in overlaps.most_common():
+                key_tokens, key_canonical, key_size = self._keys[i]
+                score = 2 * overlap / (len(trigrams) + key_size)
+                if score > confidence and _compatible(tokens, key_tokens):
+                    canonical, confidence = key_canonical, score
+
+        if canonical is not None and exception is not None:
+            canonical = f"{canonical} WITH {exception}"
+        return canonical, confidence
+
+    def match(self, name: str) -> Optional[LicenseMatch]:
+        if name in self._matches:
+            return self._matches[name]
+
+        options = []
+        confidence = 1.0
+        # Normalize "or later" first, so that it isn't mistaken for a choice of licenses.
+        expression = re.sub(OR_LATER, "+", name.strip("() "), flags=re.IGNORECASE)
+        for option in OR_SPLIT.split(expression):
+            licenses = []
+            for part in AND_SPLIT.split(option.strip("() ")):
+                canonical, part_confidence = self.match_single(part)
+                if canonical is None:
+                    self._matches[name] = None
+                    return None
+                licenses.append(canonical)
+                confidence = min(confidence, part_confidence)
+            options.append(tuple(licenses))
+
+        self._matches[name] = LicenseMatch(name, tuple(options), confidence)
+        return self._matches[name]
+
+    def classify(self, names: Iterable[str]) -> Dict[str, Optional[LicenseMatch]]:
+        return {n: self.match(n) for n in set(names)}
+
+
+@lru_cache(maxsize=None)
+def license_index() -> LicenseIndex:
+    """
+    The index is built once and shared for the rest of the run.
+    """
+    return LicenseIndex(KNOWN_LICENSES, KNOWN_EXCEPTIONS)
+
+
+def match_license(name: str) -> Optional[LicenseMatch]:
+    return license_index().match(name)
+
+
+def classify_licenses(names: Iterable[str]) -> Dict[str, Optional[LicenseMatch]]:
+    return license_index().classify(names)
@@ -0,0 +1,85 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import copy
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, TypeVar
+
+if TYPE_CHECKING:
+    from .package import Package
+
+
+T = TypeVar("T")
+P = TypeVar("P", bound="Package")
+
+
+class Lookups:
+    """
+    Memoizes lookups for the rest of the run, e.g. the license of each apt or pip package
+    version, so every file that references the same thing shares a single lookup.
+
+    Safe to use from several threads: each key is only ever computed once, by the first
+    thread to ask for it, and any other thread asking for it meanwhile waits for that
+    result rather than computing it again. Failed lookups aren't memoized.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results: Dict[Hashable, "Future"] = {}
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if owner:
+                future = self._results[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(compute())
+            except BaseException as err:
+                with self._lock:
+                    del self._results[key]
+                future.set_exception(err)
+        return future.result()
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        The result of `key` if it has already been looked up, without waiting for it or
+        computing it.
+        """
+        with self._lock:
+            future = self._results.get(key)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+
+lookups = Lookups()
+
+
+def shared_package(
+    ecosystem: str,
+    name: str,
+    version: Optional[str],
+    build: Callable[[], P],
+    is_direct: bool,
+    *extra_key: Hashable,
+) -> P:
+    """
+    The package `build` returns for a package version, built (and its licenses evaluated)
+    once per run. Whether it's a direct dependency differs from file to file, so files
+    which don't install it directly get their own shallow copy.
+    """
+    package = lookups.get((ecosystem, name, version, *extra_key), build)
+    if package.is_direct != is_direct:
+        package = copy.copy(package)
+        package.is_direct = is_direct
+    return package
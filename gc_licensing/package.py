@@ -1,9 +1,10 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from .license import License
 from .config import configs, NOTE_STRINGS
+from .fingerprint import detect_license
 
 
 class Package:
@@ -64,8 +65,9 @@ class AptPackage(Package):
         direct_license: str,
         transitive_licenses: Dict[str, List[str]],
         uri: str,
+        is_direct: bool = True,
     ):
-        super().__init__(name, version, None, uri, True)
+        super().__init__(name, version, None, uri, is_direct)
 
         self.licenses = [License(direct_license, self._should_override)]
         self.transitive_licenses = {
@@ -79,6 +81,29 @@ class AptPackage(Package):
             not_ok += [l for l in self.transitive_licenses if not l.ok]
         return not_ok
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "version": self.version,
+            "license": self.licenses[0].name,
+            "transitive_licenses": {
+                l.name: files for l, files in self.transitive_licenses.items()
+            },
+            "uri": self.uri,
+            "is_direct": self.is_direct,
+        }
+
+    @classmethod
+    def from_dict(cls, package: Dict[str, Any]) -> "AptPackage":
+        return cls(
+            package["name"],
+            package["version"],
+            package["license"],
+            package["transitive_licenses"],
+            package["uri"],
+            package["is_direct"],
+        )
+
     @property
     def _should_override(self) -> Optional[bool]:
         if self.name in configs.app.apt.allowlist:
@@ -100,6 +125,7 @@ class PipPackage(Package):
         license_str: str,
         uri: Optional[str],
         is_direct: bool,
+        license_text: Optional[str] = None,
     ):
         super().__init__(
             name,
@@ -113,6 +139,37 @@ class PipPackage(Package):
             License(l.strip(), self._should_override) for l in license_str.split(";")
         ]
 
+        # Packages without license metadata may still ship a well known license text.
+        self.license_evidence: Optional[str] = None
+        if all(l.name == "UNKNOWN" for l in self.licenses):
+            detected = detect_license(license_text)
+            if detected is not None:
+                self.licenses = [License(detected.name, self._should_override)]
+                self.license_evidence = detected.evidence
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "version": self.version,
+            "licenses": [l.name for l in self.licenses],
+            "uri": self.uri,
+            "is_direct": self.is_direct,
+            "license_evidence": self.license_evidence,
+        }
+
+    @classmethod
+    def from_dict(cls, package: Dict[str, Any]) -> "PipPackage":
+        # The licenses are those detected from its license text, if it had any
+        output = cls(
+            package["name"],
+            package["version"],
+            ";".join(package["licenses"]),
+            package["uri"],
+            package["is_direct"],
+        )
+        output.license_evidence = package["license_evidence"]
+        return output
+
     @property
     def _should_override(self) -> Optional[bool]:
         if self.name in configs.app.pip.allowlist:
@@ -0,0 +1,411 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import argparse
+import hashlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .incremental import ResultsStore
+from .scheduler import Resource, WorkItem, estimate_cost
+from .sources.apt import (
+    AptVersion,
+    dependency_closure,
+    get_apt_cache,
+    read_apt_requirements,
+    source_copyright_cached,
+)
+from .sources.bash import bash_commands, script_dependencies
+from .sources.commands import Command, extract_installs
+from .sources.docker import StageGraph, StageKey, extract_instruction_commands
+from .sources.parse import ParseStage
+from .sources.pip import requirements_file_includes
+from .sources.utils import (
+    RequirementSet,
+    handle_copied_requirement_files,
+    requirement_set,
+)
+from .timings import TimingHistory
+
+
+@dataclass
+class CommandList:
+    """
+    Commands which are resolved together, i.e. those of a Dockerfile stage, a script or a
+    notebook, and the file they're from.
+    """
+
+    path: Path
+    commands: List[Command]
+    copy_commands: Optional[List[str]] = None
+
+
+@dataclass
+class ScanPlan:
+    """
+    Every work item of a scan, enumerated before any of them are run: the files to resolve,
+    the distinct sets of pip packages installed by commands (each installed into a single
+    venv, however many files install it) and the apt source packages whose copyright files
+    cover the apt packages installed.
+    """
+
+    pip_files: Dict[Path, WorkItem] = field(default_factory=dict)
+    apt_files: Dict[Path, WorkItem] = field(default_factory=dict)
+    dockerfiles: Dict[Path, WorkItem] = field(default_factory=dict)
+    bash_files: Dict[Path, WorkItem] = field(default_factory=dict)
+    notebooks: Dict[Path, WorkItem] = field(default_factory=dict)
+    images: Dict[Path, WorkItem] = field(default_factory=dict)
+    # Requirements files installed by Dockerfiles, scripts and notebooks
+    extra_pip_files: Dict[Path, WorkItem] = field(default_factory=dict)
+    requirement_sets: Dict[RequirementSet, WorkItem] = field(default_factory=dict)
+    apt_sources: Dict[Tuple[str, str], WorkItem] = field(default_factory=dict)
+    apt_versions: Dict[Tuple[str, str], AptVersion] = field(default_factory=dict)
+
+    # How many times pip and apt packages are installed, before deduplication
+    pip_installs: int = 0
+    apt_packages: int = 0
+
+    def sections(self) -> List[Tuple[str, Dict]]:
+        return [
+            ("pip requirements files", self.pip_files),
+            ("apt requirements files", self.apt_files),
+            ("Dockerfiles", self.dockerfiles),
+            ("bash scripts", self.bash_files),
+            ("Jupyter notebooks", self.notebooks),
+            ("container images", self.images),
+            ("requirements files installed by commands", self.extra_pip_files),
+            ("pip packages installed by commands", self.requirement_sets),
+            ("apt source packages", self.apt_sources),
+        ]
+
+    def items(self) -> Iterable[WorkItem]:
+        for _, items in self.sections():
+            yield from items.values()
+
+
+def filter_extra_pip(
+    repo_path: Path, already_processed: List[str], discovered_files: List[Path]
+) -> List[Path]:
+    already_processed = [(repo_path / a).resolve() for a in already_processed]
+
+    def safe_relative_to(d):
+        try:
+            return d.relative_to(repo_path.resolve())
+        except ValueError:
+            return None
+
+    relative_paths = [
+        safe_relative_to(d)
+        for d in dict.fromkeys(discovered_files)
+        if d.resolve() not in already_processed
+    ]
+    return [p for p in relative_paths if p is not None]
+
+
+def content_digest(paths: Iterable[Path]) -> str:
+    """
+    A digest of the contents of files (or of their absence).
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            digest.update(path.read_bytes())
+        except OSError:
+            digest.update(b"missing")
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def _requirement_count(paths: Iterable[Path]) -> int:
+    count = 0
+    for path in paths:
+        try:
+            lines = path.read_text().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            line = line.split(" #", 1)[0].strip()
+            if line.startswith(("-e", "--editable")) or (
+                line and not line.startswith(("#", "-"))
+            ):
+                count += 1
+    return count
+
+
+def requirements_item(kind: str, repository: Path, r: Path) -> WorkItem:
+    """
+    The work item of installing a requirements file into a venv, sized and timed by the
+    contents of it and the files it includes.
+    """
+    paths = [repository / r] + requirements_file_includes(repository / r)
+    return WorkItem(
+        kind,
+        r.as_posix(),
+        "venv",
+        digest=content_digest(paths),
+        size=_requirement_count(paths),
+    )
+
+
+def _stage_keys(graph: StageGraph, dockerfiles: List[Path]) -> List[StageKey]:
+    """
+    Every stage resolved for the Dockerfiles, including those they're built from.
+    """
+    keys: List[StageKey] = []
+    pending = [key for d in dockerfiles for key in graph.add(d)]
+    while pending:
+        key = pending.pop(0)
+        if key not in keys:
+            keys.append(key)
+            pending += graph.parents(key)
+    return keys
+
+
+def _plan_commands(
+    args: argparse.Namespace,
+    plan: ScanPlan,
+    item: WorkItem,
+    command_lists: List[CommandList],
+    find_requirements: bool,
+) -> List[str]:
+    """
+    Plans the pip installs and requirements files of a source, returning the apt packages
+    it installs.
+    """
+    commands = pip_packages = 0
+    apt_packages: List[str] = []
+    for command_list in command_lists:
+        installs = extract_installs(command_list.commands)
+        commands += len(command_list.commands)
+        pip_packages += len(installs.pip_packages)
+        apt_packages += installs.apt_packages
+
+        if installs.pip_packages:
+            plan.pip_installs += 1
+            key = requirement_set(installs.pip_packages)
+            if key not in plan.requirement_sets:
+                plan.requirement_sets[key] = WorkItem(
+                    "requirements", " ".join(key), "venv", size=len(key)
+                )
+
+        if find_requirements:
+            req_files = handle_copied_requirement_files(
+                installs.requirement_files, command_list.copy_commands
+            )
+            _plan_extra_pip(
+                args,
+                plan,
+                [(command_list.path.parent / r).resolve() for r in req_files],
+            )
+
+    item.detail = (
+        f"{commands} commands installing {pip_packages} pip "
+        f"and {len(apt_packages)} apt packages"
+    )
+    return apt_packages
+
+
+def _plan_extra_pip(args: argparse.Namespace, plan: ScanPlan, req_files: List[Path]):
+    for r in filter_extra_pip(args.repository, args.pip_requirements_files, req_files):
+        if r not in plan.extra_pip_files:
+            plan.extra_pip_files[r] = requirements_item("extra-pip", args.repository, r)
+
+
+def _plan_apt_sources(
+    plan: ScanPlan, package_names: List[str], no_cache: bool, follow_depends: bool
+):
+    """
+    Groups the apt packages by the source package whose copyright file covers them, e.g.
+    all of the `libboost-*` packages share one.
+    """
+    if not package_names:
+        return
+
+    apt_cache = get_apt_cache()
+    names = list(dict.fromkeys(package_names))
+    if follow_depends:
+        for name in list(names):
+            names += sorted(dependency_closure(apt_cache, name) - set(names))
+
+    for name in names:
+        try:
+            versions = apt_cache[name].versions
+        except KeyError:
+            continue
+        if not versions:
+            continue
+
+        plan.apt_packages += 1
+        vrs = versions[0]
+        key = (vrs.source_name, vrs.version)
+        if key not in plan.apt_sources:
+            cached = not no_cache and source_copyright_cached(vrs)
+            plan.apt_sources[key] = WorkItem(
+                "apt-source", f"{key[0]}_{key[1]}", "network", cached
+            )
+            plan.apt_versions[key] = vrs
+
+
+def plan_scan(
+    args: argparse.Namespace, parse_stage: ParseStage, results: ResultsStore
+) -> ScanPlan:
+    """
+    Enumerates the work items of a scan of the files discovered, once they're parsed.
+    Files whose results are reused from the base of an incremental scan are planned as
+    cached, along with everything only they install.
+    """
+    plan = ScanPlan()
+    apt_packages: List[str] = []
+
+    for r in args.pip_requirements_files:
+        item = requirements_item("pip", args.repository, r)
+        item.cached = results.reuse("pip", r) is not None
+        plan.pip_files[r] = item
+
+    for r in args.apt_requirements_files:
+        cached = results.reuse("apt", r) is not None
+        names = read_apt_requirements(args.repository / r)
+        plan.apt_files[r] = WorkItem(
+            "apt",
+            r.as_posix(),
+            "network",
+            cached,
+            f"{len(names)} packages",
+            content_digest([args.repository / r]),
+            len(names),
+        )
+        if not cached:
+            apt_packages += names
+
+    for kind, files, items in [
+        ("docker", args.dockerfiles, plan.dockerfiles),
+        ("bash", args.bash_files, plan.bash_files),
+        ("notebook", args.notebook_files, plan.notebooks),
+    ]:
+        for f in files:
+            reused = results.reuse_source(kind, f)
+            items[f] = WorkItem(kind, f.as_posix(), "sources", reused is not None)
+            if reused is not None:
+                _plan_extra_pip(args, plan, reused[1])
+
+    # Every stage is resolved once, however many Dockerfiles are built from it
+    pending = [d for d, item in plan.dockerfiles.items() if not item.cached]
+    if pending:
+        image_map = {image: args.repository / d for image, d in args.docker_image_map}
+        dockerfile_paths = [args.repository / d for d in pending]
+        graph = StageGraph(
+            dockerfile_paths,
+            image_map,
+            {d: parse_stage.result("dockerfile", d) for d in dockerfile_paths},
+        )
+        for d in pending:
+            command_lists = []
+            for key in _stage_keys(graph, [args.repository / d]):
+                stage = graph.stages[key]
+                # `COPY --from` copies from another stage rather than the build context
+                run_commands, copy_commands = extract_instruction_commands(
+                    i for i in stage.instructions if "from" not in i.flags
+                )
+                command_lists.append(
+                    CommandList(stage.dockerfile, run_commands, copy_commands)
+                )
+            apt_packages += _plan_commands(
+                args,
+                plan,
+                plan.dockerfiles[d],
+                command_lists,
+                not args.docker_no_follow_requirements_files,
+            )
+
+    for b, item in plan.bash_files.items():
+        if item.cached:
+            continue
+        path = args.repository / b
+        commands = parse_stage.result("bash", path)
+        command_lists = [CommandList(path, commands)] + [
+            CommandList(s, bash_commands(s))
+            for s in script_dependencies(path, commands)
+        ]
+        apt_packages += _plan_commands(
+            args, plan, item, command_lists, not args.bash_no_follow_requirements_files
+        )
+
+    for n, item in plan.notebooks.items():
+        if item.cached:
+            continue
+        path = args.repository / n
+        apt_packages += _plan_commands(
+            args,
+            plan,
+            item,
+            [CommandList(path, parse_stage.result("notebook", path))],
+            not args.notebook_no_follow_requirements_files,
+        )
+
+    for i in args.container_images:
+        try:
+            size = i.stat().st_size >> 20
+        except OSError:
+            size = 0
+        plan.images[i] = WorkItem("image", str(i), "sources", size=size)
+
+    for r, item in plan.extra_pip_files.items():
+        item.cached = results.reuse("extra-pip", r) is not None
+
+    _plan_apt_sources(plan, apt_packages, args.apt_no_cache, args.apt_follow_depends)
+    return plan
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s" if seconds < 10 else f"{seconds:.0f}s"
+    minutes, seconds = divmod(round(seconds), 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
+
+
+def format_plan(
+    plan: ScanPlan,
+    history: Optional[TimingHistory],
+    limits: Dict[Resource, int],
+) -> str:
+    lines = ["Scan plan:"]
+    totals: Dict[str, float] = {}
+    for title, items in plan.sections():
+        if not items:
+            continue
+        cached = sum(1 for i in items.values() if i.cached)
+        summary = f"{len(items)}, {cached} cached" if cached else f"{len(items)}"
+        lines += ["", f"{title} ({summary}):"]
+        if items is plan.requirement_sets:
+            lines.append(f"  {plan.pip_installs} installs, deduplicated to:")
+        if items is plan.apt_sources:
+            lines.append(f"  covering {plan.apt_packages} apt packages")
+
+        for item in items.values():
+            cost = estimate_cost(item, history)
+            totals[item.resource] = totals.get(item.resource, 0.0) + cost
+            status = (
+                "cached" if item.cached else (format_duration(cost) if cost else "")
+            )
+            detail = f" ({item.detail})" if item.detail else ""
+            lines.append(f"  {item.name}{detail}  {status}".rstrip())
+
+    lines.append("")
+    if not totals:
+        lines.append("Nothing to do.")
+        return "\n".join(lines)
+
+    # Each pool runs its items in parallel, and the pools run alongside each other
+    elapsed = {r: total / limits.get(r, 1) for r, total in totals.items()}
+    for resource, total in sorted(totals.items()):
+        if total:
+            lines.append(
+                f"Estimated {resource} time: {format_duration(total)} "
+                f"({format_duration(elapsed[resource])} over "
+                f"{limits.get(resource, 1)} workers)"
+            )
+    lines.append(f"Estimated total: {format_duration(max(elapsed.values()))}")
+    return "\n".join(lines)
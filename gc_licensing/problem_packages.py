@@ -2,7 +2,7 @@
 
 from enum import Enum
 from dataclasses import dataclass, field
-from typing import Dict, List, Union, Literal
+from typing import Dict, List, Optional, Union, Literal
 
 from .license import License
 from .package import Package, PipPackages, AptPackages, CombinedPackages
@@ -17,6 +17,8 @@ class PackageSource(Enum):
     BASH_APT = "Bash [apt]"
     NOTEBOOK_PIP = "Notebook [pip]"
     NOTEBOOK_APT = "Notebook [apt]"
+    IMAGE_PIP = "Image [pip]"
+    IMAGE_APT = "Image [apt]"
 
 
 @dataclass
@@ -68,6 +70,7 @@ class ProblemPackages:
     docker: CombinedProblemPackages = field(default_factory=CombinedProblemPackages)
     bash: CombinedProblemPackages = field(default_factory=CombinedProblemPackages)
     notebook: CombinedProblemPackages = field(default_factory=CombinedProblemPackages)
+    image: CombinedProblemPackages = field(default_factory=CombinedProblemPackages)
 
     def __getitem__(
         self, key: str
@@ -77,7 +80,7 @@ class ProblemPackages:
     def add_combined_packages(
         self,
         reqs: Dict[str, CombinedPackages],
-        type: Literal["bash", "docker", "notebook"],
+        type: Literal["bash", "docker", "notebook", "image"],
         pip_src: PackageSource,
         apt_src: PackageSource,
     ):
@@ -111,15 +114,33 @@ class ProblemPackages:
             and self.docker.is_empty
             and self.bash.is_empty
             and self.notebook.is_empty
+            and self.image.is_empty
         )
 
 
+@dataclass
+class NotEvaluated:
+    """
+    The files whose packages weren't evaluated, as the scan was stopped before they were
+    resolved (e.g. at the first failure with `--fail-fast`, or when `--time-budget` ran
+    out), by the kind of file (e.g. `pip`, `Docker`).
+    """
+
+    reason: str
+    files: Dict[str, List[str]] = field(default_factory=dict)
+
+    @property
+    def is_empty(self) -> bool:
+        return not any(self.files.values())
+
+
 def extract_problem_packages(
     pip_requirements: Dict[str, PipPackages],
     apt_requirements: Dict[str, AptPackages],
     dockerfile_requirements: Dict[str, CombinedPackages],
     bash_requirements: Dict[str, CombinedPackages],
     notebook_requirements: Dict[str, CombinedPackages],
+    image_requirements: Optional[Dict[str, CombinedPackages]] = None,
 ) -> ProblemPackages:
     problems = ProblemPackages()
     problems.add_pip_packages(pip_requirements)
@@ -139,4 +160,10 @@ def extract_problem_packages(
         PackageSource.NOTEBOOK_PIP,
         PackageSource.NOTEBOOK_APT,
     )
+    problems.add_combined_packages(
+        image_requirements or {},
+        "image",
+        PackageSource.IMAGE_PIP,
+        PackageSource.IMAGE_APT,
+    )
     return problems
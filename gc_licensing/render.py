@@ -4,7 +4,7 @@ import logging
 from typing import Dict, List, Optional
 from airium import Airium
 
-from .problem_packages import ProblemPackage, ProblemPackages
+from .problem_packages import NotEvaluated, ProblemPackage, ProblemPackages
 
 from .package import (
     PipPackage,
@@ -37,6 +37,8 @@ def generate_pip_html(
                         with a.td():
                             for l in d.licenses:
                                 l.render(a)
+                            if d.license_evidence:
+                                a.div(_t=d.license_evidence, style="font-size: small")
                         a.td(_t=d.note)
 
     if headers is None:
@@ -54,6 +56,33 @@ def generate_apt_html(
     packages: List[AptPackage],
     headers: List[str] = None,
 ):
+    def table(deps: List[AptPackage], headers: Optional[List[str]] = None):
+        with a.table(klass="table table-striped"):
+            if headers:
+                with a.thead().tr():
+                    for h in headers:
+                        a.th(_t=h)
+            with a.tbody():
+                for d in deps:
+                    with a.tr():
+                        a.td().a(
+                            _t=d.name_version,
+                            href=d.uri,
+                        )
+                        with a.td():
+                            for l in d.licenses:
+                                l.render(a)
+                        with a.td():
+                            for license, files in d.transitive_licenses.items():
+                                with a.div():
+                                    license.render(a, ":")
+                                    with a.ul():
+                                        for f in files:
+                                            a.li(_t=f)
+
+                            d.licenses[-1].render(a)
+                        a.td(_t=d.note)
+
     if headers is None:
         headers = [
             "3rd party dependency",
@@ -62,31 +91,13 @@ def generate_apt_html(
             "Notes",
         ]
 
-    with a.table(klass="table table-striped"):
-        if headers:
-            with a.thead().tr():
-                for h in headers:
-                    a.th(_t=h)
-        with a.tbody():
-            for d in packages:
-                with a.tr():
-                    a.td().a(
-                        _t=d.name_version,
-                        href=d.uri,
-                    )
-                    with a.td():
-                        for l in d.licenses:
-                            l.render(a)
-                    with a.td():
-                        for license, files in d.transitive_licenses.items():
-                            with a.div():
-                                license.render(a, ":")
-                                with a.ul():
-                                    for f in files:
-                                        a.li(_t=f)
-
-                        d.licenses[-1].render(a)
-                    a.td(_t=d.note)
+    table([p for p in packages if p.is_direct], headers)
+
+    # Only present when apt dependencies have been followed (--apt-follow-depends)
+    transitive = [p for p in packages if not p.is_direct]
+    if transitive:
+        a.h3(_t="Transitive APT Dependencies")
+        table(transitive, headers)
 
 
 def problem_pip_row(p: ProblemPackage, is_direct: bool, a: Airium):
@@ -164,7 +175,7 @@ def generate_problems_html(
                 problem_pip_row(p, False, a)
             for p in packages.apt:
                 problem_apt_row(p, a)
-            for t in ["docker", "bash", "notebook"]:
+            for t in ["docker", "bash", "notebook", "image"]:
                 for p in packages[t].pip.direct:
                     problem_pip_row(p, True, a)
                 for p in packages[t].pip.transitive:
@@ -203,6 +214,24 @@ def render_problems(packages: ProblemPackages, a: Airium):
         generate_problems_html(a, packages)
 
 
+def render_not_evaluated(not_evaluated: NotEvaluated, a: Airium):
+    with a.article():
+        a.h1(_t="Not Evaluated")
+        a.p(
+            _t=f"The packages of these files weren't evaluated, as {not_evaluated.reason}."
+        )
+        with a.table(klass="table table-striped"):
+            with a.thead().tr():
+                a.th(_t="Source")
+                a.th(_t="Filename")
+            with a.tbody():
+                for source, files in not_evaluated.files.items():
+                    for f in files:
+                        with a.tr():
+                            a.td(_t=source)
+                            a.td(_t=f)
+
+
 def render(
     problem_packages: ProblemPackages,
     pip_requirements: Optional[Dict[str, PipPackages]] = None,
@@ -210,6 +239,8 @@ def render(
     dockerfile_requirements: Optional[Dict[str, CombinedPackages]] = None,
     bash_requirements: Optional[Dict[str, CombinedPackages]] = None,
     notebook_requirements: Optional[Dict[str, CombinedPackages]] = None,
+    image_requirements: Optional[Dict[str, CombinedPackages]] = None,
+    not_evaluated: Optional[NotEvaluated] = None,
 ) -> str:
     a = Airium()
     a("<!DOCTYPE html>")
@@ -222,6 +253,9 @@ def render(
         with a.body().div(klass="container"):
             render_problems(problem_packages, a)
             a.br()
+            if not_evaluated is not None and not not_evaluated.is_empty:
+                render_not_evaluated(not_evaluated, a)
+                a.br()
             if pip_requirements:
                 render_pip(pip_requirements, a)
                 a.br()
@@ -236,5 +270,8 @@ def render(
                 a.br()
             if bash_requirements:
                 render_combined("Bash", bash_requirements, a)
+                a.br()
+            if image_requirements:
+                render_combined("Image", image_requirements, a)
 
     return str(a)
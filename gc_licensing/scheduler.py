@@ -0,0 +1,410 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from .timings import TimingHistory
+
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+# What a work item spends its time on:
+#  * `network`: fetching apt copyright files.
+#  * `venv`: building a venv to install a set of pip requirements into.
+#  * `sources`: resolving a Dockerfile, script, notebook or image, which mostly waits for
+#    it to be parsed and for its pip and apt packages to be resolved on the other pools.
+# Parsing itself is CPU bound, so runs on the processes of a `ParseStage` instead.
+Resource = Literal["network", "venv", "sources"]
+
+# Estimated seconds to run work items that have never been timed: a fixed cost, plus a cost
+# per unit of their `size`
+DEFAULT_COSTS: Dict[str, Tuple[float, float]] = {
+    # Per pip package installed
+    "pip": (20.0, 5.0),
+    "extra-pip": (20.0, 5.0),
+    "requirements": (20.0, 5.0),
+    # Per apt package looked up
+    "apt": (0.0, 0.5),
+    "apt-source": (1.0, 0.0),
+    # Per MiB of the image archive
+    "image": (5.0, 0.05),
+}
+
+
+@dataclass
+class WorkItem:
+    """
+    A unit of work of a scan, e.g. a requirements file or set of pip packages to install
+    into a venv, or an apt source package to fetch the copyright file of.
+    """
+
+    kind: str
+    name: str
+    resource: Resource
+    # Whether it's satisfied by a cache (or by the results of a previous scan)
+    cached: bool = False
+    detail: str = ""
+    # The digest of the files it's read from, so timings are only reused for the same files
+    digest: str = ""
+    # How much there is to do, in the units of its `DEFAULT_COSTS`
+    size: int = 0
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}:{self.name}"
+
+
+def estimate_cost(item: WorkItem, history: Optional[TimingHistory]) -> float:
+    """
+    Estimated seconds to run a work item: how long it took before if it's been timed, or
+    otherwise from its size. Dockerfiles, scripts and notebooks cost nothing themselves, as
+    their packages are resolved by the other work items.
+    """
+    if item.cached or item.kind not in DEFAULT_COSTS:
+        return 0.0
+    if history is not None:
+        estimate = history.estimate(item.key, item.digest)
+        if estimate is not None:
+            return estimate
+    fixed, per_unit = DEFAULT_COSTS[item.kind]
+    return fixed + per_unit * item.size
+
+
+class ScanStopped(Exception):
+    """
+    Raised while waiting for the work items of a scan which has been stopped early.
+    """
+
+
+_active: Optional["Scheduler"] = None
+_current = threading.local()
+
+
+def completed(value: T) -> "Future[T]":
+    future: "Future[T]" = Future()
+    future.set_result(value)
+    return future
+
+
+def unfinished(future: Future) -> bool:
+    """
+    Whether a work item didn't finish because the scan was stopped (or ran out of time):
+    it's still running, or it or the work it was waiting for was cancelled.
+    """
+    return (
+        not future.done()
+        or future.cancelled()
+        or isinstance(future.exception(), CancelledError)
+    )
+
+
+def then(future: "Future[T]", fn: Callable[[T], U]) -> "Future[U]":
+    """
+    A future for `fn` of the result of `future`, called once it's done.
+    """
+    output: "Future[U]" = Future()
+
+    def done(f: "Future[T]"):
+        try:
+            output.set_result(fn(f.result()))
+        except Exception as err:
+            output.set_exception(err)
+
+    future.add_done_callback(done)
+    return output
+
+
+def _run_inline(fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+    future: "Future[T]" = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as err:
+        future.set_exception(err)
+    return future
+
+
+class _PriorityPool:
+    """
+    A pool of threads which runs the most expensive work submitted to it first, so that the
+    longest work items aren't left to start last and hold up the end of the scan. Work of
+    the same cost runs in the order it was submitted. With a `deadline` (in terms of
+    `time.monotonic`), work which isn't expected to finish by then is cancelled rather
+    than started.
+    """
+
+    def __init__(
+        self, resource: Resource, workers: int, deadline: Optional[float] = None
+    ):
+        self.resource = resource
+        self.workers = workers
+        self.deadline = deadline
+        # (negated cost, order submitted, future, function)
+        self._queue: List[Tuple[float, int, Future, Callable[[], object]]] = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._held = False
+        self._stopped = False
+        self._shutdown = False
+
+    def submit(self, cost: float, fn: Callable[[], T]) -> "Future[T]":
+        future: "Future[T]" = Future()
+        with self._condition:
+            if self._stopped:
+                future.cancel()
+                return future
+            if self._shutdown:
+                raise RuntimeError(f"The {self.resource} pool has been shut down")
+            heapq.heappush(self._queue, (-cost, next(self._order), future, fn))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f"{self.resource}_{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._condition.notify()
+        return future
+
+    def hold(self, held: bool):
+        with self._condition:
+            self._held = held
+            self._condition.notify_all()
+
+    def stop(self):
+        """
+        Cancels the work which hasn't started, and any submitted from now on.
+        """
+        with self._condition:
+            self._stopped = True
+            queued, self._queue = self._queue, []
+            self._condition.notify_all()
+        for _, _, future, _ in queued:
+            future.cancel()
+
+    def _work(self):
+        _current.resource = self.resource
+        while True:
+            with self._condition:
+                while not self._shutdown and (self._held or not self._queue):
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                cost, _, future, fn = heapq.heappop(self._queue)
+
+            if self.deadline is not None and time.monotonic() - cost > self.deadline:
+                logging.info(
+                    f"Not starting work on the {self.resource} pool expected to take "
+                    f"{-cost:.0f}s, as it would run past the time budget"
+                )
+                future.cancel()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as err:
+                future.set_exception(err)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Waits for all of the work submitted to finish, unless `wait` is False: then the
+        work still running is abandoned, so the process can exit without it.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._held = False
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class Scheduler:
+    """
+    Runs the work items of a scan as a pipeline, with a pool of threads per resource so
+    that each has its own concurrency limit: apt copyright files are fetched while pip
+    requirements are installed into venvs, while later files are still being parsed.
+    Each pool starts the work items estimated to take longest first, from how long they
+    took in previous runs (see `estimate_cost`).
+
+    A scan can be stopped early with `stop`, which cancels the work items which haven't
+    started: waiting for them with `as_completed` or `wait` raises `ScanStopped`. With a
+    `deadline` (in terms of `time.monotonic`), work items which aren't expected to finish
+    by then aren't started, and the scan is stopped when it's reached.
+
+    While a scheduler is active (as a context manager), `submit` runs work items on it.
+    Otherwise they're run as soon as they're submitted, one at a time.
+    """
+
+    def __init__(
+        self,
+        network_workers: int,
+        venv_workers: int,
+        history: Optional[TimingHistory] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.history = history
+        self.deadline = deadline
+        self.limits: Dict[Resource, int] = {
+            "network": max(network_workers, 1),
+            "venv": max(venv_workers, 1),
+            # Enough to keep the network and venv pools busy
+            "sources": max(network_workers, 1) + max(venv_workers, 1),
+        }
+        self._pools = {
+            resource: _PriorityPool(resource, limit, deadline)
+            for resource, limit in self.limits.items()
+        }
+        # Set to why the scan was stopped, if it is
+        self.stopped: "Future[str]" = Future()
+        self._stop_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def __enter__(self) -> "Scheduler":
+        global _active
+        _active = self
+        if self.deadline is not None:
+            self._timer = threading.Timer(
+                max(self.deadline - time.monotonic(), 0.0),
+                self.stop,
+                ["the time budget ran out"],
+            )
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+        self.shutdown()
+
+    def shutdown(self):
+        # Work items on the sources pool submit work to the others, so finish them first.
+        # Once the scan's stopped there's nothing to wait for: the work still running is
+        # abandoned.
+        if self._timer is not None:
+            self._timer.cancel()
+        wait = not self.stopped.done()
+        for resource in ["sources", "network", "venv"]:
+            self._pools[resource].shutdown(wait)
+
+    def stop(self, reason: str):
+        """
+        Stops the scan: work items which haven't started are cancelled, and anything
+        waiting for them raises `ScanStopped`.
+        """
+        with self._stop_lock:
+            if self.stopped.done():
+                return
+            self.stopped.set_result(reason)
+        logging.info(f"Stopping the scan: {reason}")
+        for pool in self._pools.values():
+            pool.stop()
+
+    def as_completed(self, futures: Iterable["Future[T]"]) -> Iterator["Future[T]"]:
+        """
+        Yields the futures as they complete, like `concurrent.futures.as_completed`, but
+        raises `ScanStopped` if the scan is stopped before they all have.
+        """
+        pending = set(futures)
+        while pending:
+            done, _ = wait(pending | {self.stopped}, return_when=FIRST_COMPLETED)
+            if self.stopped.done():
+                raise ScanStopped(self.stopped.result())
+            for future in done:
+                pending.discard(future)
+                yield future
+
+    def wait(self, futures: Iterable[Future]):
+        for _ in self.as_completed(futures):
+            pass
+
+    @contextmanager
+    def held(self) -> Iterator["Scheduler"]:
+        """
+        Queues the work submitted within it without starting any, so that once all of it
+        is known it's started longest first rather than in the order it was submitted.
+        """
+        for pool in self._pools.values():
+            pool.hold(True)
+        try:
+            yield self
+        finally:
+            for pool in self._pools.values():
+                pool.hold(False)
+
+    def _submit(
+        self, resource: Resource, cost: float, fn: Callable[..., T], *args, **kwargs
+    ) -> "Future[T]":
+        # A work item waiting on its own pool could wait for ever, so run it in place
+        if getattr(_current, "resource", None) == resource:
+            return _run_inline(fn, *args, **kwargs)
+
+        def run():
+            logging.debug(
+                f"Running {getattr(fn, '__name__', fn)} on the {resource} pool"
+            )
+            return fn(*args, **kwargs)
+
+        return self._pools[resource].submit(cost, run)
+
+    def submit(
+        self, resource: Resource, fn: Callable[..., T], *args, **kwargs
+    ) -> "Future[T]":
+        return self._submit(resource, 0.0, fn, *args, **kwargs)
+
+    def submit_item(
+        self, item: WorkItem, fn: Callable[..., T], *args, **kwargs
+    ) -> "Future[T]":
+        """
+        Runs a work item on the pool for its resource, recording how long it took.
+        """
+
+        def timed():
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            # How long a cached item took says nothing about how long it takes uncached
+            if self.history is not None and not item.cached:
+                self.history.record(item.key, time.perf_counter() - start, item.digest)
+            return result
+
+        cost = estimate_cost(item, self.history)
+        return self._submit(item.resource, cost, timed)
+
+
+def submit(resource: Resource, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+    """
+    Runs `fn` on the pool for `resource` of the active scheduler, if there is one.
+    """
+    if _active is None:
+        return _run_inline(fn, *args, **kwargs)
+    return _active.submit(resource, fn, *args, **kwargs)
+
+
+def submit_item(item: WorkItem, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+    """
+    Runs a work item on the active scheduler, if there is one.
+    """
+    if _active is None:
+        return _run_inline(fn, *args, **kwargs)
+    return _active.submit_item(item, fn, *args, **kwargs)
@@ -1,56 +1,153 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+import io
+import json
+import threading
 from collections import defaultdict
-from typing import List, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
 from pathlib import Path
-import apt
 import requests
 
 from ..config import configs
 
 from ..license import License
+from ..license_index import classify_licenses
+from ..lookup import lookups, shared_package
 from ..package import AptPackage, AptPackages
+from ..store import PackStore
+from .apt_index import (
+    DEFAULT_MIRROR,
+    AptIndex,
+    IndexVersion,
+    download_release_index_files,
+    host_index_files,
+    load_apt_index,
+)
 
 import logging
 
+try:
+    import apt
 
-def cache_name(package_name: str) -> Path:
-    return configs.app.apt.cache_path / f"license_{package_name}.txt"
+    AptCache = Union[apt.Cache, AptIndex]
+    AptVersion = Union[apt.package.Version, IndexVersion]
+except ImportError:
+    # python-apt can only be installed as a system package, fall back to reading the
+    # package indexes directly.
+    apt = None
+    AptCache = AptIndex
+    AptVersion = IndexVersion
 
 
-def parse_copyright_text(copyright_text: str) -> Tuple[List[str], List[str]]:
-    copyright_text = copyright_text.split("\n")
+_copyright_stores: Dict[Path, PackStore] = {}
 
-    licenses = [line[9:] for line in copyright_text if line.startswith("License: ")]
-    filenames = [line[7:] for line in copyright_text if line.startswith("Files: ")]
-    return licenses, filenames
 
+def copyright_store() -> PackStore:
+    """
+    Raw copyright files and their parsed records are cached in a single packed store in
+    `configs.app.apt.cache_path`, rather than as thousands of small files.
+    """
+    cache_path = Path(configs.app.apt.cache_path)
+    if cache_path not in _copyright_stores:
+        _copyright_stores[cache_path] = PackStore(cache_path, "copyright")
+    return _copyright_stores[cache_path]
 
-def generate_output_package(
-    package_name: str, version: str, uri: str, licenses: List[str], filenames: List[str]
-) -> AptPackage:
-    if len(licenses) > 0:
-        direct_license = licenses[0]
-        licensed_files = defaultdict(list)
-
-        # Apt licensing is more complex (and more complete) than pip licensing.
-        # We get an overall license for the package (direct license)
-        # and a list of sub-files and their individual licenses for files in the package
-        # We convert this into a license-indexed dictionary of files.
-        for l, f in zip(licenses[1:], filenames[1:]):
-            licensed_files[l].append(f)
-
-        return AptPackage(
-            package_name,
-            version,
-            direct_license,
-            licensed_files,
-            uri,
+
+@dataclass
+class CopyrightRecord:
+    """
+    Compact form of a Debian copyright file: the license covering the package as a whole,
+    plus a license-indexed dictionary of the files that are licensed differently.
+    """
+
+    direct_license: Optional[str]
+    licensed_files: Dict[str, List[str]] = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {"license": self.direct_license, "files": self.licensed_files}
         )
-    return None
+
+    @classmethod
+    def from_json(cls, text: str) -> "CopyrightRecord":
+        record = json.loads(text)
+        return cls(record["license"], record["files"])
+
+
+def parse_copyright(lines: Iterable[str]) -> CopyrightRecord:
+    """
+    Single pass parser for machine-readable (DEP-5) copyright files. Lines are consumed as
+    they are read, so the whole file never needs to be held in memory.
+
+    Each `Files:` paragraph is paired with the `License:` field of the same paragraph.
+    Continuation lines extend the `Files:` list and are otherwise ignored (for `License:`
+    they hold the license text). Standalone `License:` paragraphs only define license
+    texts, so they are only used when the file doesn't have any `Files:` paragraphs.
+    """
+    direct_license = None
+    fallback_license = None
+    licensed_files = defaultdict(list)
+
+    files: Optional[List[str]] = None
+    license_name: Optional[str] = None
+    current_field: Optional[str] = None
+
+    def end_paragraph():
+        nonlocal direct_license, fallback_license
+        if license_name is None:
+            return
+
+        if files is None:
+            if fallback_license is None:
+                fallback_license = license_name
+        elif "*" in files and direct_license is None:
+            direct_license = license_name
+        else:
+            licensed_files[license_name].append(" ".join(files))
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            end_paragraph()
+            files, license_name, current_field = None, None, None
+        elif line[0] in " \t":
+            if current_field == "files":
+                files += line.split()
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            current_field = name.strip().lower()
+            if current_field == "files":
+                files = value.split()
+            elif current_field == "license":
+                license_name = value.strip()
+    end_paragraph()
+
+    if direct_license is None:
+        # No `Files: *` paragraph, so take the first license that applies to any files.
+        direct_license = next(iter(licensed_files), fallback_license)
+    return CopyrightRecord(direct_license, dict(licensed_files))
+
+
+def parse_copyright_text(copyright_text: str) -> CopyrightRecord:
+    return parse_copyright(io.StringIO(copyright_text))
+
+
+def generate_output_package(
+    package_name: str, version: str, uri: str, record: CopyrightRecord
+) -> Optional[AptPackage]:
+    if record.direct_license is None:
+        return None
+
+    # Apt licensing is more complex (and more complete) than pip licensing.
+    # We get an overall license for the package (direct license)
+    # and a license-indexed dictionary of sub-files that are licensed differently.
+    return AptPackage(
+        package_name, version, record.direct_license, record.licensed_files, uri
+    )
 
 
-def changelog_uris(vrs: apt.package.Version) -> str:
+def changelog_uris(vrs: AptVersion) -> str:
     try:
         pool_name = vrs.filename.split("/")[1]
         return [
@@ -63,49 +160,120 @@ def changelog_uris(vrs: apt.package.Version) -> str:
         return []
 
 
+SourceCopyright = Tuple[str, CopyrightRecord]
+
+
+def source_key(vrs: AptVersion) -> str:
+    return f"{vrs.source_name}_{vrs.version}"
+
+
+def source_copyright_cached(vrs: AptVersion) -> bool:
+    # Checking (e.g. for `--plan`) mustn't create the store
+    if not PackStore.exists(Path(configs.app.apt.cache_path), "copyright"):
+        return False
+    return f"record/{source_key(vrs)}" in copyright_store()
+
+
+def fetch_source_copyright(
+    vrs: AptVersion, no_cache: bool = False
+) -> Optional[SourceCopyright]:
+    store = copyright_store()
+    key = source_key(vrs)
+    text_key = f"copyright/{key}"
+    record_key = f"record/{key}"
+    for u in changelog_uris(vrs):
+        if not no_cache:
+            cached_record = store.get_text(record_key)
+            if cached_record is not None:
+                logging.debug(f"Cache hit for copyright record: {key}")
+                return u, CopyrightRecord.from_json(cached_record)
+
+        copyright_text = None if no_cache else store.get_text(text_key)
+        if copyright_text is not None:
+            logging.debug(f"Cache hit for copyright file: {key}")
+        else:
+            response = requests.get(u)
+            if response.status_code != 200:
+                logging.debug(
+                    f"Failed to download. Got status code: {response.status_code}"
+                )
+                continue
+
+            copyright_text = response.text
+            store.put_text(text_key, copyright_text)
+
+        record = parse_copyright_text(copyright_text)
+        store.put_text(record_key, record.to_json())
+
+        # Possible that the license is there, we just can't auto-parse it.
+        # The URL is still returned so that it can be checked manually.
+        return u, record
+    return None
+
+
+def get_source_copyright(
+    vrs: AptVersion, no_cache: bool = False
+) -> Optional[SourceCopyright]:
+    """
+    Binary packages built from the same source package (e.g. all of the `libboost-*`
+    packages) share a single copyright file, so it is only fetched and parsed once per run.
+    """
+    return lookups.get(
+        ("apt-source", vrs.source_name, vrs.version),
+        lambda: fetch_source_copyright(vrs, no_cache),
+    )
+
+
+def _package_version(apt_cache: AptCache, package_name: str) -> Optional[str]:
+    try:
+        versions = apt_cache[package_name].versions
+    except KeyError:
+        return None
+    return versions[0].version if versions else None
+
+
 def get_package_license(
-    apt_cache: apt.Cache, package_name: str, no_cache: bool = False
-) -> str:
+    apt_cache: AptCache,
+    package_name: str,
+    no_cache: bool = False,
+    is_direct: bool = True,
+) -> AptPackage:
+    """
+    Each package is looked up once per run, however many files install it.
+    """
+    return shared_package(
+        "apt",
+        package_name,
+        _package_version(apt_cache, package_name),
+        lambda: _lookup_package_license(apt_cache, package_name, no_cache),
+        is_direct,
+    )
+
+
+def _lookup_package_license(
+    apt_cache: AptCache,
+    package_name: str,
+    no_cache: bool = False,
+    is_direct: bool = True,
+) -> AptPackage:
     output_package: Optional[AptPackage] = None
     version = None
-
-    # Possible that the license is there, we just can't auto-parse it.
-    # If the URI hit with a 200, record that URL and use it later.
-    success_url = None
+    uri = None
 
     try:
         pkg = apt_cache[package_name]
         logging.debug(f"Processing APT package [{package_name}]")
 
-        versioned_uris = {v.version: changelog_uris(v) for v in pkg.versions}
-        for version, uris in versioned_uris.items():
-            for u in uris:
-                if not no_cache and cache_name(package_name).exists():
-                    logging.debug(
-                        f"Cache hit for file: {str(cache_name(package_name))}"
-                    )
-                    success_url = u
-                    with open(cache_name(package_name)) as fh:
-                        copyright_text = fh.read()
-                else:
-                    response = requests.get(u)
-                    if response.status_code != 200:
-                        logging.debug(
-                            f"Failed to download. Got status code: {response.status_code}"
-                        )
-                        continue
-
-                    success_url = u
-
-                    with open(cache_name(package_name), "wb") as fh:
-                        fh.write(response.text.encode())
-
-                    copyright_text = response.text
-                licenses, filenames = parse_copyright_text(copyright_text)
-
-                output_package = generate_output_package(
-                    package_name, version, u, licenses, filenames
-                )
+        for vrs in pkg.versions:
+            version = vrs.version
+            source_copyright = get_source_copyright(vrs, no_cache)
+            if source_copyright is None:
+                continue
+
+            uri, record = source_copyright
+            output_package = generate_output_package(package_name, version, uri, record)
+            if output_package is not None:
+                output_package.is_direct = is_direct
                 break
 
     except KeyError:
@@ -118,7 +286,9 @@ def get_package_license(
 
     if output_package is None:
         logging.debug("  License not found...")
-        output_package = AptPackage(package_name, version, "UNKNOWN", {}, success_url)
+        output_package = AptPackage(
+            package_name, version, "UNKNOWN", {}, uri, is_direct
+        )
     else:
         logging.debug(f"  Direct license: {output_package.licenses[0]}")
         logging.debug("  Transitive licenses:")
@@ -127,9 +297,166 @@ def get_package_license(
     return output_package
 
 
-def apt_from_repo(apt_packages_txt: str, no_cache: bool) -> AptPackages:
-    apt_cache = apt.Cache()
+def resolve_dependency(apt_cache: AptCache, or_group: List[str]) -> Optional[str]:
+    """
+    Picks the package apt would install for a (possibly virtual) alternative dependency,
+    e.g. `default-jre | java-runtime`.
+    """
+    for name in or_group:
+        if name in apt_cache:
+            return name
+
+    for name in or_group:
+        if apt_cache.is_virtual_package(name):
+            providers = apt_cache.get_providing_packages(name)
+            if providers:
+                return providers[0].name
+    return None
+
+
+def _package_depends(apt_cache: AptCache, package_name: str) -> List[str]:
+    depends = []
+    try:
+        pkg = apt_cache[package_name]
+        vrs = pkg.candidate or (pkg.versions[0] if pkg.versions else None)
+        if vrs is not None:
+            for dep in vrs.dependencies:
+                name = resolve_dependency(
+                    apt_cache, [d.name for d in dep.or_dependencies]
+                )
+                if name is not None:
+                    depends.append(name)
+    except KeyError:
+        pass
+    return depends
+
+
+def package_depends(apt_cache: AptCache, package_name: str) -> List[str]:
+    """
+    The runtime dependencies of a package, looked up once per run and shared by every
+    file, so common dependencies like libc6 are only expanded once.
+    """
+    return lookups.get(
+        ("apt-depends", package_name),
+        lambda: _package_depends(apt_cache, package_name),
+    )
+
+
+def _dependency_closure(apt_cache: AptCache, package_name: str) -> FrozenSet[str]:
+    closure = set()
+    to_visit = list(package_depends(apt_cache, package_name))
+    while to_visit:
+        name = to_visit.pop()
+        if name in closure or name == package_name:
+            continue
+        closure.add(name)
+        known = lookups.peek(("apt-closure", name))
+        if known is not None:
+            closure |= known
+        else:
+            to_visit += package_depends(apt_cache, name)
+
+    closure.discard(package_name)
+    return frozenset(closure)
+
+
+def dependency_closure(apt_cache: AptCache, package_name: str) -> FrozenSet[str]:
+    """
+    All packages pulled in by installing `package_name` (excluding itself). Any package
+    whose closure was already computed is merged in without being traversed again.
+    """
+    return lookups.get(
+        ("apt-closure", package_name),
+        lambda: _dependency_closure(apt_cache, package_name),
+    )
+
+
+def get_package_licenses(
+    apt_cache: AptCache,
+    package_names: List[str],
+    no_cache: bool = False,
+    follow_depends: bool = False,
+) -> AptPackages:
+    packages = [get_package_license(apt_cache, p, no_cache) for p in package_names]
+
+    if follow_depends:
+        transitive_names = set()
+        for p in package_names:
+            transitive_names |= dependency_closure(apt_cache, p)
+
+        packages += [
+            get_package_license(apt_cache, p, no_cache, is_direct=False)
+            for p in sorted(transitive_names - set(package_names))
+        ]
+
+    # Classify the license names of the whole package set in one pass up front, rather
+    # than one at a time as each package is rendered.
+    classify_licenses(
+        l.name for p in packages for l in p.licenses + list(p.transitive_licenses)
+    )
+    return packages
+
+
+_apt_cache: Optional[AptCache] = None
+_apt_cache_lock = threading.Lock()
+
+
+def open_apt_cache() -> AptCache:
+    """
+    Opens the package database selected by `configs.app.apt`:
+     * `backend: python-apt` uses the host's apt cache (requires the python3-apt system package).
+     * `backend: index` parses `Packages` indexes directly: either the `index_files` given,
+       the indexes of `release` for `architecture` downloaded from `mirror`, or by default
+       the host's dpkg status database and apt lists.
+    """
+    cfg = configs.app.apt
+    backend = cfg.get("backend") or ("python-apt" if apt is not None else "index")
+
+    if backend == "python-apt":
+        if apt is None:
+            raise ValueError(
+                "The python-apt backend requires the python3-apt system package. "
+                "Use `--apt-backend index` instead, or recreate your venv with `--system-site-packages`."
+            )
+        return apt.Cache()
+
+    architecture = cfg.get("architecture")
+    if cfg.get("index_files"):
+        index_files = [Path(f) for f in cfg.index_files]
+    elif cfg.get("release"):
+        index_files = download_release_index_files(
+            cfg.cache_path,
+            cfg.release,
+            architecture or "amd64",
+            cfg.get("mirror") or DEFAULT_MIRROR,
+        )
+    else:
+        index_files = host_index_files(architecture)
+
+    index = load_apt_index(index_files)
+    logging.debug(f"Loaded {len(index)} packages from {len(index_files)} apt indexes")
+    return index
+
+
+def get_apt_cache() -> AptCache:
+    """
+    The package database is opened once and shared for the rest of the run.
+    """
+    global _apt_cache
+    with _apt_cache_lock:
+        if _apt_cache is None:
+            _apt_cache = open_apt_cache()
+    return _apt_cache
+
+
+def read_apt_requirements(apt_packages_txt: str) -> List[str]:
     with open(apt_packages_txt, "r") as fh:
-        packages = fh.readlines()
+        return [p.strip() for p in fh.readlines() if p.strip()]
+
 
-        return [get_package_license(apt_cache, p.strip(), no_cache) for p in packages]
+def apt_from_repo(
+    apt_packages_txt: str, no_cache: bool, follow_depends: bool = False
+) -> AptPackages:
+    apt_cache = get_apt_cache()
+    packages = read_apt_requirements(apt_packages_txt)
+    return get_package_licenses(apt_cache, packages, no_cache, follow_depends)
@@ -0,0 +1,349 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import gzip
+import logging
+import lzma
+import re
+import time
+from dataclasses import dataclass, field
+from functools import cmp_to_key
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+
+DPKG_STATUS_PATH = Path("/var/lib/dpkg/status")
+APT_LISTS_PATH = Path("/var/lib/apt/lists")
+
+DEFAULT_MIRROR = "http://archive.ubuntu.com/ubuntu"
+DEFAULT_COMPONENTS = ["main", "restricted", "universe", "multiverse"]
+DEFAULT_POCKETS = ["", "-updates", "-security"]
+
+# Downloaded indexes older than this are fetched again
+INDEX_MAX_AGE_SECONDS = 24 * 60 * 60
+
+# The only fields needed to look up licenses and dependencies. Everything else (notably
+# the multi-line descriptions) is skipped while parsing.
+INDEX_FIELDS = {
+    "package",
+    "version",
+    "source",
+    "filename",
+    "section",
+    "architecture",
+    "status",
+    "depends",
+    "pre-depends",
+    "provides",
+}
+
+
+def _order(c: str) -> int:
+    if c.isdigit():
+        return 0
+    if c.isalpha():
+        return ord(c)
+    if c == "~":
+        return -1
+    if c:
+        return ord(c) + 256
+    return 0
+
+
+def _compare_fragment(a: str, b: str) -> int:
+    """
+    Port of dpkg's `verrevcmp`: compares alternating non-digit and digit runs, where `~`
+    sorts before anything (even the end of the string).
+    """
+    i, j = 0, 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or (
+            j < len(b) and not b[j].isdigit()
+        ):
+            ac = _order(a[i] if i < len(a) else "")
+            bc = _order(b[j] if j < len(b) else "")
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+        while i < len(a) and j < len(b) and a[i].isdigit() and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _split_version(version: str) -> Optional[Tuple[int, str, str]]:
+    """
+    Splits a Debian version into its epoch, upstream version and revision, or None if it
+    isn't valid. As in dpkg, the epoch ends at the first colon (the upstream version can
+    contain colons) and the revision starts after the last hyphen.
+    """
+    epoch, _, rest = version.partition(":") if ":" in version else ("0", "", version)
+    if not epoch.isdigit():
+        return None
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else (rest, "", "0")
+    return int(epoch), upstream, revision
+
+
+def compare_versions(a: str, b: str) -> int:
+    """
+    Compares two Debian version strings, returning <0, 0 or >0 (as `dpkg --compare-versions`).
+    Invalid versions sort before every valid one.
+    """
+    split_a, split_b = _split_version(a), _split_version(b)
+    if split_a is None or split_b is None:
+        return (split_a is not None) - (split_b is not None)
+    epoch_a, upstream_a, revision_a = split_a
+    epoch_b, upstream_b, revision_b = split_b
+    if epoch_a != epoch_b:
+        return epoch_a - epoch_b
+    return _compare_fragment(upstream_a, upstream_b) or _compare_fragment(
+        revision_a, revision_b
+    )
+
+
+@dataclass
+class IndexBaseDependency:
+    name: str
+
+
+@dataclass
+class IndexDependency:
+    or_dependencies: List[IndexBaseDependency]
+
+
+@dataclass
+class IndexVersion:
+    """
+    The subset of `apt.package.Version` needed to look up licenses and dependencies.
+    """
+
+    package_name: str
+    version: str
+    source_name: str
+    filename: str
+    dependencies: List[IndexDependency] = field(default_factory=list)
+
+
+@dataclass
+class IndexPackage:
+    name: str
+    versions: List[IndexVersion] = field(default_factory=list)
+
+    @property
+    def candidate(self) -> Optional[IndexVersion]:
+        return self.versions[0] if self.versions else None
+
+
+def parse_depends(depends: str) -> List[IndexDependency]:
+    """
+    Parses a `Depends` style field, e.g. `libc6 (>= 2.14), libgcc-s1 | libgcc1, perl:any`.
+    Version constraints, architecture qualifiers and build profiles are dropped.
+    """
+    output = []
+    for group in depends.split(","):
+        names = [
+            re.split(r"[\s(\[<:]", alternative.strip(), maxsplit=1)[0]
+            for alternative in group.split("|")
+        ]
+        names = [n for n in names if n]
+        if names:
+            output.append(IndexDependency([IndexBaseDependency(n) for n in names]))
+    return output
+
+
+def pool_filename(fields: Dict[str, str], source_name: str) -> str:
+    """
+    Installed packages in the dpkg status database don't record their pool filename. The
+    component is all that's needed to build the changelog URL, which is recorded in the
+    section for anything outside of `main` (e.g. `universe/python`).
+    """
+    section = fields.get("section", "")
+    component = section.split("/")[0] if "/" in section else "main"
+    prefix = source_name[:4] if source_name.startswith("lib") else source_name[0]
+    version = fields["version"].split(":")[-1]
+    arch = fields.get("architecture", "all")
+    return f"pool/{component}/{prefix}/{source_name}/{fields['package']}_{version}_{arch}.deb"
+
+
+def iter_paragraphs(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    """
+    Streams the paragraphs of a dpkg status or Packages file, keeping only INDEX_FIELDS.
+    """
+    fields: Dict[str, str] = {}
+    current_field = None
+    for line in lines:
+        if not line.strip():
+            if fields:
+                yield fields
+            fields, current_field = {}, None
+        elif line[0] in " \t":
+            if current_field is not None:
+                fields[current_field] += " " + line.strip()
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            name = name.lower()
+            if name in INDEX_FIELDS:
+                current_field = name
+                fields[name] = value.strip()
+            else:
+                current_field = None
+    if fields:
+        yield fields
+
+
+def open_index_file(path: Path):
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.suffix == ".xz":
+        return lzma.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+class AptIndex:
+    """
+    Pure python replacement for the parts of `apt.Cache` used by the apt source. Rather
+    than relying on python-apt and the host's apt configuration, it reads the dpkg status
+    database and/or any `Packages` index files directly, so it can run in a plain venv
+    and audit a release other than the one the host is running.
+    """
+
+    def __init__(self):
+        self._packages: Dict[str, IndexPackage] = {}
+        self._providers: Dict[str, List[str]] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._packages
+
+    def __getitem__(self, name: str) -> IndexPackage:
+        return self._packages[name]
+
+    def __len__(self) -> int:
+        return len(self._packages)
+
+    def is_virtual_package(self, name: str) -> bool:
+        return name not in self._packages and name in self._providers
+
+    def get_providing_packages(self, name: str) -> List[IndexPackage]:
+        return [self._packages[p] for p in self._providers.get(name, [])]
+
+    def add_paragraph(self, fields: Dict[str, str]):
+        if "package" not in fields or "version" not in fields:
+            return
+        if "status" in fields and not fields["status"].endswith(" installed"):
+            return
+
+        name = fields["package"]
+        source_name = fields.get("source", name).split(" ")[0]
+
+        pkg = self._packages.setdefault(name, IndexPackage(name))
+        for v in pkg.versions:
+            if v.version == fields["version"]:
+                # The same version is listed by both dpkg status and the apt lists,
+                # only the latter records the real pool filename.
+                if "filename" in fields:
+                    v.filename = fields["filename"]
+                return
+
+        depends = ", ".join(
+            fields[f] for f in ["pre-depends", "depends"] if fields.get(f)
+        )
+        pkg.versions.append(
+            IndexVersion(
+                name,
+                fields["version"],
+                source_name,
+                fields.get("filename") or pool_filename(fields, source_name),
+                parse_depends(depends),
+            )
+        )
+
+        for provided in parse_depends(fields.get("provides", "")):
+            providers = self._providers.setdefault(provided.or_dependencies[0].name, [])
+            if name not in providers:
+                providers.append(name)
+
+    def load(self, path: Path) -> "AptIndex":
+        logging.debug(f"Loading apt index {str(path)}")
+        with open_index_file(path) as fh:
+            for fields in iter_paragraphs(fh):
+                self.add_paragraph(fields)
+
+        newest_first = cmp_to_key(lambda a, b: compare_versions(b.version, a.version))
+        for pkg in self._packages.values():
+            pkg.versions.sort(key=newest_first)
+        return self
+
+
+def host_index_files(architecture: Optional[str] = None) -> List[Path]:
+    files = [DPKG_STATUS_PATH] if DPKG_STATUS_PATH.exists() else []
+    if APT_LISTS_PATH.exists():
+        arch = architecture or "*"
+        files += sorted(
+            f
+            for f in APT_LISTS_PATH.glob(f"*_binary-{arch}_Packages*")
+            if f.name.endswith(("_Packages", "_Packages.gz", "_Packages.xz"))
+        )
+    return files
+
+
+def download_release_index_files(
+    cache_path: Path,
+    release: str,
+    architecture: str,
+    mirror: str = DEFAULT_MIRROR,
+    components: Optional[List[str]] = None,
+    pockets: Optional[List[str]] = None,
+) -> List[Path]:
+    index_path = cache_path / "indexes"
+    index_path.mkdir(exist_ok=True, parents=True)
+
+    files = []
+    for pocket in pockets or DEFAULT_POCKETS:
+        for component in components or DEFAULT_COMPONENTS:
+            dist = f"{release}{pocket}"
+            filename = (
+                index_path / f"{dist}_{component}_binary-{architecture}_Packages.xz"
+            )
+            is_fresh = (
+                filename.exists()
+                and time.time() - filename.stat().st_mtime < INDEX_MAX_AGE_SECONDS
+            )
+            if not is_fresh:
+                url = f"{mirror}/dists/{dist}/{component}/binary-{architecture}/Packages.xz"
+                logging.debug(f"Downloading apt index {url}")
+                response = requests.get(url, stream=True)
+                if response.status_code != 200:
+                    logging.warning(
+                        f"Failed to download apt index {url}. Got status code: {response.status_code}"
+                    )
+                    continue
+
+                partial = filename.with_suffix(".partial")
+                with open(partial, "wb") as fh:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        fh.write(chunk)
+                partial.replace(filename)
+            files.append(filename)
+    return files
+
+
+def load_apt_index(index_files: List[Path]) -> AptIndex:
+    index = AptIndex()
+    for f in index_files:
+        index.load(f)
+    return index
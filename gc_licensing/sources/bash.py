@@ -1,132 +1,199 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
-import re
+import logging
 from pathlib import Path
-from typing import Tuple, List
+from typing import List, Optional, Tuple
 
 from gc_licensing.package import CombinedPackages
 
-from .utils import run_list_of_commands
+from ..lookup import lookups
+from .commands import unwrap_command
+from .shell import SimpleCommand, is_shell, parse_script
+from .utils import merge_combined_packages, run_list_of_commands
 
-from typing import List, Optional
 
+# Commands which only print their arguments, so mention packages without installing them
+OUTPUT_COMMANDS = {"echo", "printf"}
+SOURCE_COMMANDS = {"source", "."}
+# Options of bash/sh which take a value, e.g. `bash -o pipefail script.sh`
+SHELL_VALUE_OPTIONS = {"-o", "+o", "-O", "+O", "--rcfile", "--init-file"}
+SCRIPT_SUFFIXES = (".sh", ".bash")
 
-class MultilineStringCommandParser:
-    """
-    Need to handle multiline strings in bash, which are typically defined using either a single quote
-    or an EOF block. This simple parser can read a shell script, pull out commands line-by-line, filter
-    out comment blocks and then join commands over multiple lines where it encounters an odd number of
-    quote/EOF marks in the line.
-    """
-
-    paired_chars = ['"', "'", "EOF"]
-
-    def __init__(self):
-        self.output: List[str] = []
+ScriptKey = Tuple[Path, int]
+ScriptResult = Tuple[CombinedPackages, List[Path]]
 
-        self._open_command: List[str] = []
-        self._current_quote: Optional[str] = None
 
-    def process(self, commands: List[str]):
-        self.output.clear()
-        self._open_command.clear()
-        self._current_quote = None
-
-        for command in commands:
-            self.cmd(command)
+def commands_from_script(script: str) -> List[SimpleCommand]:
+    """
+    The simple commands run by a shell script, with any that only print their arguments
+    dropped.
+    """
+    return [c for c in parse_script(script) if c.argv[0] not in OUTPUT_COMMANDS]
 
-        if self._current_quote:
-            self.close_block()
 
-        return self.output
+def script_key(script_path: Path) -> ScriptKey:
+    script_path = script_path.resolve()
+    return script_path, script_path.stat().st_mtime_ns
 
-    def open_block(self, quote: str):
-        self._current_quote = quote
 
-    def close_block(self):
-        self.output.append(" ".join(self._open_command))
-        self._open_command.clear()
-        self._current_quote = None
+def _read_commands(script_path: Path) -> List[SimpleCommand]:
+    with open(script_path) as fh:
+        return commands_from_script(fh.read())
 
-    def cmd(self, command: str):
-        q = self.get_unclosed_quote(command)
-        opened_now = False
-        if not self.is_open:
-            if q:
-                self.open_block(q)
-                opened_now = True
-            else:
-                self.output.append(command)
 
-        if self.is_open:
-            self._open_command.append(command)
-            if q == self._current_quote and not opened_now:
-                self.close_block()
+def bash_commands(script_path: Path) -> List[SimpleCommand]:
+    # Scripts are parsed at most once per run, however many scripts use them
+    return lookups.get(
+        ("bash-commands", script_key(script_path)),
+        lambda: _read_commands(script_path),
+    )
 
-    def get_unclosed_quote(self, command: str):
-        for char in self.paired_chars:
-            command = command.replace("\\" + char, "")
 
-        if self.is_open:
-            if command.count(self._current_quote) % 2 == 1:
-                return self._current_quote
-            else:
+def _script_operand(argv: List[str]) -> Optional[str]:
+    """
+    The script run by `source x.sh`, `. x.sh`, `bash -e x.sh` or `./x.sh`, if any.
+    """
+    argv = unwrap_command(argv)
+    if not argv:
+        return None
+    if argv[0] in SOURCE_COMMANDS:
+        return argv[1] if len(argv) > 1 else None
+    if is_shell(argv[0]):
+        args = iter(argv[1:])
+        for arg in args:
+            if arg in SHELL_VALUE_OPTIONS:
+                next(args, None)
+            elif arg == "-c":
                 return None
-        else:
-            for char in self.paired_chars:
-                if command.count(char) % 2 == 1:
-                    return char
-            return None
+            elif not arg.startswith(("-", "+")):
+                return arg
+        return None
+    # Run directly, e.g. `./install.sh`
+    if "/" in argv[0] and argv[0].endswith(SCRIPT_SUFFIXES):
+        return argv[0]
+    return None
 
-    @property
-    def is_open(self):
-        return self._current_quote is not None
 
-
-def filter_input(content: List[str]) -> List[str]:
-    current_command = []
-    commands = []
-
-    for line in content:
-        line = line.strip()
-        if line.startswith("#"):
+def invoked_scripts(script_path: Path, commands: List[SimpleCommand]) -> List[Path]:
+    """
+    The local scripts sourced or run by a script. Relative paths are taken to be relative
+    to the script's own directory, and anything that depends on a variable is ignored.
+    """
+    scripts = []
+    for command in commands:
+        operand = _script_operand(command.argv)
+        if not operand or operand.startswith("/") or any(c in operand for c in "$`"):
             continue
+        path = script_path.parent / operand
+        if path.is_file() and path.resolve() not in scripts:
+            scripts.append(path.resolve())
+    return scripts
 
-        # Capture lines that end with a continuation
-        if line.endswith("\\"):
-            current_command.append(line[:-1].strip())
-        else:
-            if line:
-                current_command.append(line)
-                commands.append(current_command)
-            current_command = []
-
-    if current_command:
-        commands.append(current_command)
-    return commands
 
+def script_dependencies(
+    script_path: Path, commands: Optional[List[SimpleCommand]] = None
+) -> List[Path]:
+    """
+    Every local script a script sources or runs, directly or through other scripts.
+    """
+    root = script_path.resolve()
+    dependencies: List[Path] = []
+    pending = [root]
+    while pending:
+        path = pending.pop()
+        path_commands = (
+            commands if path == root and commands is not None else bash_commands(path)
+        )
+        for script in invoked_scripts(path, path_commands):
+            if script not in dependencies and script != root:
+                dependencies.append(script)
+                pending.append(script)
+    return dependencies
+
+
+def _resolve_script(
+    script_path: Path,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool,
+    commands: Optional[List[SimpleCommand]],
+    visiting: Tuple[Path, ...],
+) -> ScriptResult:
+    """
+    Scripts already being resolved (`visiting`) are skipped to break cycles, so a script's
+    result only differs with those of them it can reach: it's resolved at most once per
+    run for each of those, however many scripts use it.
+    """
+    key = script_key(script_path)
+    reachable = frozenset(visiting).intersection(
+        script_dependencies(script_path, commands)
+    )
+    return lookups.get(
+        ("bash-script", key, find_requirements, apt_follow_depends, reachable),
+        lambda: _resolve_script_uncached(
+            script_path,
+            no_cache,
+            find_requirements,
+            apt_follow_depends,
+            commands,
+            visiting + (key[0],),
+        ),
+    )
+
+
+def _resolve_script_uncached(
+    script_path: Path,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool,
+    commands: Optional[List[SimpleCommand]],
+    visiting: Tuple[Path, ...],
+) -> ScriptResult:
+    if commands is None:
+        commands = bash_commands(script_path)
+    results = [
+        run_list_of_commands(
+            script_path,
+            commands,
+            no_cache,
+            find_requirements,
+            apt_follow_depends=apt_follow_depends,
+        )
+    ]
+
+    for script in invoked_scripts(script_path, commands):
+        if script in visiting:
+            logging.warning(f"Scripts form a cycle: {[*visiting, script]}")
+            continue
+        results.append(
+            _resolve_script(
+                script, no_cache, find_requirements, apt_follow_depends, None, visiting
+            )
+        )
 
-def filter_output(commands: List[str]) -> List[str]:
-    run_commands = []
-    for cmd in commands:
-        run_commands += [
-            c
-            for c in cmd.replace("||", "&&").split(" && ")
-            if not c.strip().startswith("echo")
-        ]
-    return run_commands
+    return (
+        merge_combined_packages([packages for packages, _ in results]),
+        list(dict.fromkeys(f for _, files in results for f in files)),
+    )
 
 
 def bash_from_repo(
-    script_path: Path, no_cache: bool, find_requirements: bool
+    script_path: Path,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool = False,
+    commands: Optional[List[SimpleCommand]] = None,
 ) -> Tuple[CombinedPackages, Optional[List[Path]]]:
-    with open(script_path) as fh:
-        content = fh.readlines()
-
-    commands = filter_input(content)
-
-    q = MultilineStringCommandParser()
-    commands = q.process([" ".join(c) for c in commands])
-    commands = filter_output(commands)
-
-    return run_list_of_commands(script_path, commands, no_cache, find_requirements)
+    """
+    The packages installed by a script, including those installed by any local scripts it
+    sources (`source x.sh`, `. x.sh`) or runs (`bash x.sh`, `./x.sh`).
+    """
+    output = _resolve_script(
+        script_path,
+        no_cache,
+        find_requirements,
+        apt_follow_depends,
+        commands,
+        (),
+    )
+    return output
@@ -0,0 +1,275 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import json
+import posixpath
+import re
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+
+from .shell import ASSIGNMENT, SimpleCommand, parse_script
+
+
+# A command is either a simple command already tokenized by `parse_script`, or a string of
+# shell script (e.g. from a Dockerfile RUN instruction) which is tokenized on the way in.
+Command = Union[str, SimpleCommand]
+
+
+@dataclass(frozen=True)
+class OptionSpec:
+    """
+    The options of a program which take a value, so that the value isn't mistaken for an
+    operand. Long options are mapped to the short option they're an alias of, if any.
+    """
+
+    short: str
+    long: FrozenSet[str]
+    aliases: Dict[str, str] = field(default_factory=dict)
+
+
+# Parsed out of `pip --help` and `pip install --help`
+PIP_OPTIONS = OptionSpec(
+    short="rcetbif",
+    long=frozenset(
+        {
+            "--requirement",
+            "--constraint",
+            "--editable",
+            "--target",
+            "--platform",
+            "--python-version",
+            "--implementation",
+            "--abi",
+            "--root",
+            "--prefix",
+            "--build",
+            "--src",
+            "--upgrade-strategy",
+            "--install-option",
+            "--global-option",
+            "--config-settings",
+            "--no-binary",
+            "--only-binary",
+            "--progress-bar",
+            "--report",
+            "--index-url",
+            "--extra-index-url",
+            "--find-links",
+            "--python",
+            "--log",
+            "--proxy",
+            "--retries",
+            "--timeout",
+            "--exists-action",
+            "--trusted-host",
+            "--cert",
+            "--client-cert",
+            "--cache-dir",
+        }
+    ),
+    aliases={"--requirement": "-r", "--constraint": "-c", "--editable": "-e"},
+)
+
+# A less complete list, from reading `man apt-get`
+APT_OPTIONS = OptionSpec(
+    short="oct",
+    long=frozenset(
+        {"--option", "--config-file", "--target-release", "--default-release"}
+    ),
+)
+
+# Programs which run the command given by the rest of their arguments, and those of their
+# options that take a value
+WRAPPERS: Dict[str, Set[str]] = {
+    "sudo": {"-u", "-g", "-h", "-p", "-C", "-D", "-r", "-t", "-U"},
+    "env": {"-u", "-C", "-S"},
+    "nice": {"-n"},
+    "nohup": set(),
+    "time": set(),
+    "exec": set(),
+    "command": set(),
+}
+
+PIP = re.compile(r"^pip[\d.]*$")
+APT = {"apt", "apt-get", "aptitude"}
+
+
+@dataclass
+class ParsedCommand:
+    """
+    A package manager command, e.g. `pip install -qr reqs.txt numpy` is program `pip`,
+    subcommand `install`, options `[("-q", None), ("-r", "reqs.txt")]` and operands
+    `["numpy"]`.
+    """
+
+    program: str
+    subcommand: Optional[str]
+    options: List[Tuple[str, Optional[str]]]
+    operands: List[str]
+
+    def values(self, option: str) -> List[str]:
+        return [v for o, v in self.options if o == option and v]
+
+
+def parse_options(
+    args: List[str], spec: OptionSpec
+) -> Tuple[List[Tuple[str, Optional[str]]], List[str]]:
+    options: List[Tuple[str, Optional[str]]] = []
+    operands: List[str] = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == "--":
+            operands += args[i:]
+            break
+
+        if arg.startswith("--"):
+            name, equals, value = arg.partition("=")
+            if not equals and name in spec.long:
+                value, i = (args[i], i + 1) if i < len(args) else ("", i)
+            takes_value = equals or name in spec.long
+            options.append(
+                (spec.aliases.get(name, name), value if takes_value else None)
+            )
+        elif arg.startswith("-") and len(arg) > 1:
+            # A cluster of short options, e.g. `-qr reqs.txt` or `-rreqs.txt`
+            for j, char in enumerate(arg[1:], 1):
+                if char not in spec.short:
+                    options.append((f"-{char}", None))
+                    continue
+                value = arg[j + 1 :]
+                if not value and i < len(args):
+                    value, i = args[i], i + 1
+                options.append((f"-{char}", value))
+                break
+        else:
+            operands.append(arg)
+    return options, operands
+
+
+def unwrap_command(argv: List[str]) -> List[str]:
+    """
+    Drops wrappers such as `sudo -E env FOO=1`, along with their options.
+    """
+    while argv and posixpath.basename(argv[0]) in WRAPPERS:
+        takes_value = WRAPPERS[posixpath.basename(argv[0])]
+        i = 1
+        while i < len(argv) and (argv[i].startswith("-") or ASSIGNMENT.match(argv[i])):
+            i += 2 if argv[i] in takes_value else 1
+        argv = argv[i:]
+    return argv
+
+
+def _pip_args(argv: List[str]) -> Optional[List[str]]:
+    program = posixpath.basename(argv[0])
+    if PIP.match(program):
+        return argv[1:]
+    if program == "uv" and argv[1:2] == ["pip"]:
+        return argv[2:]
+
+    # `python -m pip`, or e.g. `{sys.executable} -m pip` in notebooks
+    for i in range(1, len(argv) - 1):
+        if argv[i] == "-m":
+            return argv[i + 2 :] if PIP.match(argv[i + 1]) else None
+        if not argv[i].startswith("-"):
+            return None
+    return None
+
+
+def parse_command(argv: List[str]) -> Optional[ParsedCommand]:
+    """
+    Parses a simple command into the IR, if it runs one of the package managers we know.
+    """
+    argv = unwrap_command(argv)
+    if not argv:
+        return None
+
+    pip_args = _pip_args(argv)
+    if pip_args is not None:
+        program, args, spec = "pip", pip_args, PIP_OPTIONS
+    elif posixpath.basename(argv[0]) in APT:
+        program, args, spec = "apt", argv[1:], APT_OPTIONS
+    else:
+        return None
+
+    # Global options may come before the subcommand, e.g. `pip -q install` or
+    # `apt-get -y install`
+    options, operands = parse_options(args, spec)
+    subcommand = operands.pop(0) if operands else None
+    return ParsedCommand(program, subcommand, options, operands)
+
+
+def iter_simple_commands(commands: Iterable[Command]) -> Iterable[SimpleCommand]:
+    for command in commands:
+        if isinstance(command, SimpleCommand):
+            yield command
+        else:
+            yield from parse_script(command)
+
+
+@dataclass
+class Installs:
+    """
+    Everything a list of commands installs, from a single pass over them.
+    """
+
+    pip_packages: List[str] = field(default_factory=list)
+    apt_packages: List[str] = field(default_factory=list)
+    requirement_files: List[str] = field(default_factory=list)
+
+
+def extract_installs(commands: Iterable[Command]) -> Installs:
+    installs = Installs()
+    for command in iter_simple_commands(commands):
+        parsed = parse_command(command.argv)
+        if parsed is None or parsed.subcommand != "install":
+            continue
+
+        if parsed.program == "pip":
+            installs.pip_packages += parsed.operands
+            installs.requirement_files += parsed.values("-r")
+        elif parsed.program == "apt":
+            installs.apt_packages += parsed.operands
+    return installs
+
+
+def parse_copy(value: str) -> Tuple[List[str], str]:
+    """
+    The sources and destination of a Dockerfile COPY, in shell or exec (JSON) form.
+    """
+    args: Optional[List[str]] = None
+    if value.strip().startswith("["):
+        try:
+            args = json.loads(value)
+        except json.JSONDecodeError:
+            args = None
+    if not isinstance(args, list):
+        args = value.split()
+    if len(args) < 2:
+        return [], ""
+    return args[:-1], args[-1]
+
+
+def copy_source(path: str, copies: List[Tuple[List[str], str]]) -> Optional[str]:
+    """
+    Where in the build context a path in the image was copied from, if it was.
+    """
+    path = posixpath.normpath(path)
+    for sources, destination in reversed(copies):
+        destination = posixpath.normpath(destination)
+        if path == destination and len(sources) == 1:
+            return sources[0]
+
+        if destination == ".":
+            relative = path
+        elif path.startswith(destination.rstrip("/") + "/"):
+            relative = path[len(destination.rstrip("/")) + 1 :]
+        else:
+            continue
+
+        for source in sources:
+            if posixpath.basename(source.rstrip("/")) == relative:
+                return source
+        if len(sources) == 1:
+            return posixpath.normpath(posixpath.join(sources[0], relative))
+    return None
@@ -1,31 +1,177 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
-import tempfile
-from typing import Dict, List, Optional, Tuple
+import io
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from pathlib import Path
-from dockerfile_parse import DockerfileParser
 
+from ..lookup import lookups
 from ..package import CombinedPackages
-from .utils import run_list_of_commands
+from .utils import merge_combined_packages, run_list_of_commands
 
 
-def extract_commands(df: str) -> Tuple[List[str], List[str]]:
-    # DockerFileParser has an unwanted side-effect of overwriting the content of `<cwd>/Dockerfile`
-    # By overriding the fileobj, it'll do that writing to a temporary file, which we can then just
-    # throw away.
-    tf = tempfile.NamedTemporaryFile()
-    dfp = DockerfileParser(fileobj=tf)
-    dfp.content = df
+ESCAPE_DIRECTIVE = re.compile(r"^#\s*escape\s*=\s*(\S)\s*$", re.IGNORECASE)
+PARSER_DIRECTIVE = re.compile(r"^#\s*\w+\s*=")
+INSTRUCTION = re.compile(r"^\s*([A-Za-z]+)(?:\s+(.*))?$", re.DOTALL)
+FLAG = re.compile(r"^--([A-Za-z\-]+)(?:=(\S*))?(?:\s+|$)")
+# Not `<<<` here-strings, which are a single line
+HEREDOC = re.compile(r"(?<!<)<<(?!<)(-?)([\"']?)([A-Za-z_][\w\-]*)\2")
+VARIABLE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+SHELLS = {"sh", "bash", "/bin/sh", "/bin/bash", "/usr/bin/env bash", "/usr/bin/env sh"}
+
+
+@dataclass
+class Instruction:
+    """
+    A single Dockerfile instruction, with any continuation lines joined, leading flags
+    (e.g. `--mount=type=cache,target=/root/.cache`, `--from=builder`) split out and the
+    bodies of any BuildKit heredocs attached in order.
+    """
+
+    instruction: str
+    value: str
+    flags: Dict[str, str] = field(default_factory=dict)
+    heredocs: List[str] = field(default_factory=list)
+    line: int = 0
+
+
+def _split_flags(value: str) -> Tuple[Dict[str, str], str]:
+    flags = {}
+    m = FLAG.match(value)
+    while m:
+        flags[m[1].lower()] = m[2] if m[2] is not None else ""
+        value = value[m.end() :]
+        m = FLAG.match(value)
+    return flags, value
+
+
+def _parse_instruction(parts: List[str], line: int) -> Optional[Instruction]:
+    m = INSTRUCTION.match(" ".join(p for p in parts if p))
+    if not m:
+        return None
+    flags, value = _split_flags((m[2] or "").strip())
+    return Instruction(m[1].upper(), value, flags, [], line)
+
+
+def iter_instructions(lines: Iterable[str]) -> Iterator[Instruction]:
+    """
+    Single-pass tokenizer for Dockerfiles. Handles the `escape` parser directive, line
+    continuations (including comments and blank lines within them), instruction flags and
+    heredocs.
+    """
+    escape = "\\"
+    in_directives = True
+    lines = iter(lines)
+
+    line_number = 0
+    start_line = 0
+    parts: List[str] = []
+    for raw in lines:
+        line_number += 1
+        line = raw.rstrip("\r\n")
+        stripped = line.strip()
+
+        if in_directives:
+            m = ESCAPE_DIRECTIVE.match(stripped)
+            if m:
+                escape = m[1]
+                continue
+            in_directives = PARSER_DIRECTIVE.match(stripped) is not None
+
+        if not stripped or stripped.startswith("#"):
+            continue
+
+        if not parts:
+            start_line = line_number
+        if stripped.endswith(escape):
+            parts.append(stripped[:-1].strip())
+            continue
+        parts.append(stripped)
+
+        instruction = _parse_instruction(parts, start_line)
+        parts = []
+        if instruction is None:
+            continue
 
-    full_commands = [
-        s["value"].strip() for s in dfp.structure if s["instruction"] == "RUN"
-    ]
+        # Heredoc bodies follow the instruction line, in the order they were opened
+        if instruction.instruction in ("RUN", "COPY", "ADD"):
+            for strip_tabs, _, delimiter in HEREDOC.findall(instruction.value):
+                body = []
+                for raw_body in lines:
+                    line_number += 1
+                    body_line = raw_body.rstrip("\r\n")
+                    if strip_tabs:
+                        body_line = body_line.lstrip("\t")
+                    if body_line == delimiter:
+                        break
+                    body.append(body_line)
+                instruction.heredocs.append("\n".join(body))
+        yield instruction
 
-    copy_commands = [
-        s["value"].strip() for s in dfp.structure if s["instruction"] == "COPY"
-    ]
+    # A continuation on the last line of the file
+    instruction = _parse_instruction(parts, start_line) if parts else None
+    if instruction is not None:
+        yield instruction
 
-    tf.close()
+
+def _join_continuations(script: str) -> List[str]:
+    lines = []
+    current = ""
+    for line in script.splitlines():
+        stripped = line.strip()
+        if not stripped or (stripped.startswith("#") and not current):
+            continue
+        if stripped.endswith("\\"):
+            current += stripped[:-1].strip() + " "
+            continue
+        lines.append((current + stripped).strip())
+        current = ""
+    if current.strip():
+        lines.append(current.strip())
+    return lines
+
+
+def run_instruction_commands(instruction: Instruction) -> List[str]:
+    """
+    The shell commands run by a RUN instruction, in shell, exec (JSON) or heredoc form.
+    """
+    value = instruction.value.strip()
+    if value.startswith("["):
+        try:
+            args = json.loads(value)
+        except json.JSONDecodeError:
+            args = None
+        if isinstance(args, list) and all(isinstance(a, str) for a in args):
+            if len(args) >= 3 and args[0] in SHELLS and args[1] == "-c":
+                return [args[2]]
+            return [" ".join(args)]
+
+    if instruction.heredocs:
+        # Only heredocs fed to a shell are scripts, e.g. `RUN <<EOF` or `RUN bash <<EOF`,
+        # others are the input of some other program (e.g. `RUN python3 <<EOF`).
+        program = HEREDOC.sub("", value).strip()
+        commands = [program] if program and program not in SHELLS else []
+        if not commands:
+            for body in instruction.heredocs:
+                commands += _join_continuations(body)
+        return commands
+
+    return [value] if value else []
+
+
+def extract_instruction_commands(
+    instructions: Iterable[Instruction],
+) -> Tuple[List[str], List[str]]:
+    full_commands = []
+    copy_commands = []
+    for instruction in instructions:
+        if instruction.instruction == "RUN":
+            full_commands += run_instruction_commands(instruction)
+        elif instruction.instruction == "COPY" and not instruction.heredocs:
+            copy_commands.append(instruction.value.strip())
 
     run_commands = []
     for cmd in full_commands:
@@ -34,14 +180,251 @@ def extract_commands(df: str) -> Tuple[List[str], List[str]]:
     return run_commands, copy_commands
 
 
-def docker_from_repo(
-    dockerfile_path: Path, no_cache: bool, find_requirements: bool
-) -> Tuple[CombinedPackages, Optional[List[Path]]]:
+def extract_commands(df: str) -> Tuple[List[str], List[str]]:
+    return extract_instruction_commands(iter_instructions(io.StringIO(df)))
+
+
+@dataclass
+class Stage:
+    """
+    A build stage: everything from one `FROM` to the next.
+    """
+
+    dockerfile: Path
+    index: int
+    base: str
+    name: Optional[str] = None
+    instructions: List[Instruction] = field(default_factory=list)
+
+
+StageKey = Tuple[Path, int]
+
+StageResult = Tuple[CombinedPackages, List[Path]]
+
+
+def parse_stages(dockerfile_path: Path) -> List[Stage]:
+    # Global ARGs (before the first FROM) may be used to pick the base image
+    build_args: Dict[str, str] = {}
+    stages: List[Stage] = []
+
     with open(dockerfile_path) as fh:
-        df = fh.read()
+        for instruction in iter_instructions(fh):
+            if instruction.instruction == "FROM":
+                value = VARIABLE.sub(
+                    lambda m: build_args.get(m[1] or m[2], ""), instruction.value
+                )
+                parts = value.split()
+                name = None
+                if len(parts) >= 3 and parts[1].lower() == "as":
+                    name = parts[2].lower()
+                stages.append(
+                    Stage(dockerfile_path, len(stages), parts[0] if parts else "", name)
+                )
+            elif instruction.instruction == "ARG" and not stages:
+                arg, _, default = instruction.value.partition("=")
+                build_args[arg.strip()] = default.strip().strip("\"'")
+            else:
+                if not stages:
+                    stages.append(Stage(dockerfile_path, 0, ""))
+                stages[-1].instructions.append(instruction)
+    return stages
+
+
+def _strip_tag(image: str) -> str:
+    image = image.split("@")[0]
+    name, _, tag = image.rpartition(":")
+    return name if name and "/" not in tag else image
+
+
+class StageGraph:
+    """
+    The build stages of a set of Dockerfiles, and the stages each one is built from: its
+    `FROM` base and the sources of any `COPY --from`. These are either earlier stages of
+    the same Dockerfile, or images built by other Dockerfiles in the repository, as given
+    by `image_map` (image name -> Dockerfile). Dockerfiles already parsed (e.g. by the parse
+    stage) can be given as `parsed`, others are parsed as they're found.
+    """
+
+    def __init__(
+        self,
+        dockerfiles: List[Path],
+        image_map: Optional[Dict[str, Path]] = None,
+        parsed: Optional[Dict[Path, List[Stage]]] = None,
+    ):
+        self.stages: Dict[StageKey, Stage] = {}
+        self.files: Dict[Path, List[StageKey]] = {}
+        self.image_map = {k: v.resolve() for k, v in (image_map or {}).items()}
+        self.parsed = {k.resolve(): v for k, v in (parsed or {}).items()}
+        for d in dockerfiles:
+            self.add(d)
+
+    def add(self, dockerfile_path: Path) -> List[StageKey]:
+        dockerfile_path = dockerfile_path.resolve()
+        if dockerfile_path not in self.files:
+            self.files[dockerfile_path] = []
+            stages = self.parsed.get(dockerfile_path)
+            if stages is None:
+                stages = parse_stages(dockerfile_path)
+            for stage in stages:
+                key = (dockerfile_path, stage.index)
+                self.stages[key] = stage
+                self.files[dockerfile_path].append(key)
+        return self.files[dockerfile_path]
+
+    def lookup(self, stage: Stage, ref: str) -> Optional[StageKey]:
+        for key in self.files[stage.dockerfile][: stage.index]:
+            other = self.stages[key]
+            if other.name == ref.lower() or str(other.index) == ref:
+                return key
+
+        dockerfile = self.image_map.get(ref) or self.image_map.get(_strip_tag(ref))
+        if dockerfile is None:
+            return None
+        if not dockerfile.exists():
+            logging.warning(f"Dockerfile {dockerfile} for image {ref} doesn't exist")
+            return None
+
+        stages = self.add(dockerfile)
+        return stages[-1] if stages else None
+
+    def parents(self, key: StageKey) -> List[StageKey]:
+        stage = self.stages[key]
+        refs = [stage.base] + [
+            i.flags["from"]
+            for i in stage.instructions
+            if i.instruction == "COPY" and i.flags.get("from")
+        ]
+
+        parents = []
+        for ref in refs:
+            parent = self.lookup(stage, ref)
+            if parent is not None and parent not in parents:
+                parents.append(parent)
+        return parents
 
-    run_commands, copy_dict = extract_commands(df)
+    def ancestors(self, key: StageKey) -> Set[StageKey]:
+        """
+        Every stage a stage is built from, directly or through other stages.
+        """
+        ancestors: Set[StageKey] = set()
+        pending = [key]
+        while pending:
+            for parent in self.parents(pending.pop()):
+                if parent not in ancestors:
+                    ancestors.add(parent)
+                    pending.append(parent)
+        return ancestors
 
-    return run_list_of_commands(
-        dockerfile_path, run_commands, no_cache, find_requirements, copy_dict
+
+def _resolve_stage(
+    graph: StageGraph,
+    key: StageKey,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool,
+    visiting: Tuple[StageKey, ...],
+) -> StageResult:
+    """
+    Stages already being resolved (`visiting`) are skipped to break cycles, so a stage's
+    result only differs with those of them it's built from: it's resolved at most once per
+    run for each of those, however many stages and Dockerfiles derive from it.
+    """
+    reachable = frozenset(visiting).intersection(graph.ancestors(key))
+    return lookups.get(
+        (
+            "docker-stage",
+            key,
+            find_requirements,
+            apt_follow_depends,
+            frozenset(graph.image_map.items()),
+            reachable,
+        ),
+        lambda: _resolve_stage_uncached(
+            graph,
+            key,
+            no_cache,
+            find_requirements,
+            apt_follow_depends,
+            visiting + (key,),
+        ),
+    )
+
+
+def _resolve_stage_uncached(
+    graph: StageGraph,
+    key: StageKey,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool,
+    visiting: Tuple[StageKey, ...],
+) -> StageResult:
+    stage = graph.stages[key]
+    # `COPY --from` copies from another stage rather than the build context
+    run_commands, copy_commands = extract_instruction_commands(
+        i for i in stage.instructions if "from" not in i.flags
+    )
+    own_packages, own_req_files = run_list_of_commands(
+        stage.dockerfile,
+        run_commands,
+        no_cache,
+        find_requirements,
+        copy_commands,
+        apt_follow_depends,
+    )
+
+    results = [own_packages]
+    req_files = list(own_req_files)
+    for parent in graph.parents(key):
+        if parent in visiting:
+            logging.warning(f"Dockerfile stages form a cycle: {[*visiting, parent]}")
+            continue
+        parent_packages, parent_req_files = _resolve_stage(
+            graph, parent, no_cache, find_requirements, apt_follow_depends, visiting
+        )
+        results.append(parent_packages)
+        req_files += parent_req_files
+
+    return merge_combined_packages(results), list(dict.fromkeys(req_files))
+
+
+def dockerfiles_from_repo(
+    dockerfile_paths: List[Path],
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool = False,
+    image_map: Optional[Dict[str, Path]] = None,
+    parsed: Optional[Dict[Path, List[Stage]]] = None,
+) -> Dict[Path, StageResult]:
+    """
+    Each stage's packages are those installed by its own RUN instructions, plus those of
+    the stages it's built from. Every stage is resolved once per run, however many stages
+    and Dockerfiles derive from it (even when they're resolved separately), and a
+    Dockerfile's packages (and requirements files) are those of all its stages.
+    """
+    graph = StageGraph(dockerfile_paths, image_map, parsed)
+    output = {}
+    for d in dockerfile_paths:
+        results = [
+            _resolve_stage(
+                graph, key, no_cache, find_requirements, apt_follow_depends, ()
+            )
+            for key in graph.add(d)
+        ]
+        output[d] = (
+            merge_combined_packages([packages for packages, _ in results]),
+            list(dict.fromkeys(f for _, files in results for f in files)),
+        )
+    return output
+
+
+def docker_from_repo(
+    dockerfile_path: Path,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool = False,
+    image_map: Optional[Dict[str, Path]] = None,
+) -> Tuple[CombinedPackages, Optional[List[Path]]]:
+    output = dockerfiles_from_repo(
+        [dockerfile_path], no_cache, find_requirements, apt_follow_depends, image_map
     )
+    return output[dockerfile_path]
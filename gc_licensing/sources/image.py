@@ -0,0 +1,306 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import io
+import json
+import logging
+import posixpath
+import re
+import tarfile
+from dataclasses import dataclass, field
+from email.parser import Parser
+from pathlib import Path
+from typing import Dict, IO, Iterable, List, Optional, Tuple
+
+from ..config import configs
+from ..package import AptPackage, CombinedPackages, PipPackage
+from ..store import PackStore
+from .apt import changelog_uris, generate_output_package, parse_copyright_text
+from .apt_index import IndexVersion, iter_paragraphs, pool_filename
+
+
+DPKG_STATUS = "var/lib/dpkg/status"
+DPKG_STATUS_DIR = "var/lib/dpkg/status.d/"
+DOC_ROOT = "usr/share/doc/"
+DIST_INFO = re.compile(
+    r"^(?:.*/)?(?:site|dist)-packages/[^/]+\.dist-info/"
+    r"(?:METADATA|(?:LICEN[CS]E|COPYING)[^/]*|licenses/.+)$"
+)
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+# Bump when the contents recorded for each layer change, to invalidate cached layers
+LAYER_CACHE_VERSION = 1
+
+
+@dataclass
+class LayerContents:
+    """
+    The files of a single image layer that are needed to find the licenses of the
+    packages installed in it, plus the files it deletes from the layers below.
+    """
+
+    files: Dict[str, str] = field(default_factory=dict)
+    links: Dict[str, str] = field(default_factory=dict)
+    whiteouts: List[str] = field(default_factory=list)
+    opaque: List[str] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def from_json(cls, text: str) -> "LayerContents":
+        return cls(**json.loads(text))
+
+
+def _normalize(path: str) -> str:
+    return posixpath.normpath("/" + path).lstrip("/")
+
+
+def is_license_path(path: str) -> bool:
+    if path == DPKG_STATUS or path.startswith(DPKG_STATUS_DIR):
+        return True
+    if path.startswith(DOC_ROOT):
+        # `usr/share/doc/<pkg>/copyright`, or `usr/share/doc/<pkg>` itself for symlinks
+        parts = path[len(DOC_ROOT) :].split("/")
+        return len(parts) == 1 or (len(parts) == 2 and parts[1] == "copyright")
+    return DIST_INFO.match(path) is not None
+
+
+def read_layer(fileobj: IO[bytes]) -> LayerContents:
+    """
+    Streams a (possibly compressed) layer tar once, keeping only the files that matter.
+    """
+    contents = LayerContents()
+    with tarfile.open(fileobj=fileobj, mode="r|*") as layer:
+        for member in layer:
+            path = _normalize(member.name)
+            dirname, basename = posixpath.split(path)
+            if basename == OPAQUE_WHITEOUT:
+                contents.opaque.append(dirname)
+            elif basename.startswith(WHITEOUT_PREFIX):
+                contents.whiteouts.append(
+                    posixpath.join(dirname, basename[len(WHITEOUT_PREFIX) :])
+                )
+            elif not is_license_path(path):
+                continue
+            elif member.issym():
+                contents.links[path] = posixpath.normpath(
+                    posixpath.join(dirname, member.linkname)
+                    if not member.linkname.startswith("/")
+                    else member.linkname.lstrip("/")
+                )
+            elif member.isfile():
+                data = layer.extractfile(member).read()
+                contents.files[path] = data.decode("utf-8", errors="replace")
+    return contents
+
+
+@dataclass
+class LayerRef:
+    digest: str
+    path: str
+
+
+def image_layers(image: tarfile.TarFile) -> List[LayerRef]:
+    """
+    The layers of an image saved by `docker save` (`manifest.json`) or in OCI layout
+    (`index.json`), bottom first.
+    """
+
+    def read_json(name: str):
+        return json.load(image.extractfile(image.getmember(name)))
+
+    names = set(image.getnames())
+    if "manifest.json" in names:
+        manifest = read_json("manifest.json")[0]
+        layers = manifest["Layers"]
+        diff_ids = read_json(manifest["Config"]).get("rootfs", {}).get("diff_ids", [])
+        if len(diff_ids) != len(layers):
+            diff_ids = layers
+        return [LayerRef(d, l) for d, l in zip(diff_ids, layers)]
+
+    if "index.json" in names:
+
+        def blob(digest: str) -> str:
+            return "blobs/" + digest.replace(":", "/", 1)
+
+        descriptor = read_json("index.json")["manifests"][0]
+        manifest = read_json(blob(descriptor["digest"]))
+        if "manifests" in manifest:
+            # A multi-platform index, take the first image
+            manifest = read_json(blob(manifest["manifests"][0]["digest"]))
+        return [LayerRef(l["digest"], blob(l["digest"])) for l in manifest["layers"]]
+
+    raise ValueError("Not a `docker save` or OCI image archive")
+
+
+_layer_stores: Dict[Path, PackStore] = {}
+
+
+def layer_store() -> PackStore:
+    cache_path = Path(configs.app.apt.cache_path)
+    if cache_path not in _layer_stores:
+        _layer_stores[cache_path] = PackStore(cache_path, "layers")
+    return _layer_stores[cache_path]
+
+
+def image_layer_contents(
+    image_path: Path, no_cache: bool = False
+) -> List[LayerContents]:
+    """
+    Reads the relevant contents of each layer. Layers are cached by digest, so layers
+    shared with other images (e.g. a common base) are only ever read once.
+    """
+    store = layer_store()
+    output = []
+    # Archives may be compressed, e.g. `docker save image | gzip > image.tar.gz`
+    with tarfile.open(image_path, mode="r:*") as image:
+        for layer in image_layers(image):
+            key = f"layer-v{LAYER_CACHE_VERSION}/{layer.digest}"
+            cached = None if no_cache else store.get_text(key)
+            if cached is not None:
+                output.append(LayerContents.from_json(cached))
+                continue
+
+            logging.debug(f"Reading layer {layer.digest} of {image_path}")
+            contents = read_layer(image.extractfile(image.getmember(layer.path)))
+            store.put_text(key, contents.to_json())
+            output.append(contents)
+    return output
+
+
+def _remove_under(files: Dict[str, str], path: str, keep_root: bool = False):
+    prefix = path + "/" if path else ""
+    for p in [
+        p for p in files if p.startswith(prefix) or (p == path and not keep_root)
+    ]:
+        del files[p]
+
+
+def merge_layers(layers: Iterable[LayerContents]) -> LayerContents:
+    """
+    Applies the layers in order, including their whiteouts, to give the final filesystem.
+    """
+    merged = LayerContents()
+    for layer in layers:
+        for d in layer.opaque:
+            _remove_under(merged.files, d, keep_root=True)
+            _remove_under(merged.links, d, keep_root=True)
+        for p in layer.whiteouts:
+            _remove_under(merged.files, p)
+            _remove_under(merged.links, p)
+        for p in layer.files:
+            merged.links.pop(p, None)
+        for p in layer.links:
+            merged.files.pop(p, None)
+        merged.files.update(layer.files)
+        merged.links.update(layer.links)
+    return merged
+
+
+def _resolve(path: str, links: Dict[str, str]) -> str:
+    for _ in range(8):
+        parts = path.split("/")
+        for i in range(len(parts), 0, -1):
+            prefix = "/".join(parts[:i])
+            if prefix in links:
+                path = "/".join([links[prefix]] + parts[i:])
+                break
+        else:
+            return path
+    return path
+
+
+def apt_packages_from_filesystem(fs: LayerContents) -> List[AptPackage]:
+    status_texts = [fs.files[DPKG_STATUS]] if DPKG_STATUS in fs.files else []
+    status_texts += [
+        t for p, t in sorted(fs.files.items()) if p.startswith(DPKG_STATUS_DIR)
+    ]
+
+    packages = []
+    for text in status_texts:
+        for fields in iter_paragraphs(io.StringIO(text)):
+            if "package" not in fields or "version" not in fields:
+                continue
+            if "status" in fields and not fields["status"].endswith(" installed"):
+                continue
+
+            name, version = fields["package"], fields["version"]
+            source_name = fields.get("source", name).split(" ")[0]
+            vrs = IndexVersion(
+                name, version, source_name, pool_filename(fields, source_name)
+            )
+            uris = changelog_uris(vrs)
+            uri = uris[-1] if uris else ""
+
+            copyright_path = _resolve(f"{DOC_ROOT}{name}/copyright", fs.links)
+            copyright_text = fs.files.get(copyright_path)
+            output_package = None
+            if copyright_text is not None:
+                output_package = generate_output_package(
+                    name, version, uri, parse_copyright_text(copyright_text)
+                )
+            if output_package is None:
+                output_package = AptPackage(name, version, "UNKNOWN", {}, uri)
+            packages.append(output_package)
+    return sorted(packages, key=lambda p: p.name)
+
+
+def metadata_license(metadata) -> str:
+    """
+    The license named by package metadata, preferring (as pip-licenses does) trove
+    classifiers over the free-form `License` field.
+    """
+    if metadata.get("License-Expression"):
+        return metadata["License-Expression"]
+
+    classifiers = [
+        c.split(" :: ")[-1]
+        for c in metadata.get_all("Classifier") or []
+        if c.startswith("License ::")
+    ]
+    if classifiers:
+        return "; ".join(classifiers)
+
+    license_str = (metadata.get("License") or "").strip().split("\n")[0]
+    return license_str if license_str and len(license_str) < 100 else "UNKNOWN"
+
+
+def pip_packages_from_filesystem(fs: LayerContents) -> List[PipPackage]:
+    dist_infos: Dict[str, Dict[str, str]] = {}
+    for path, text in fs.files.items():
+        m = re.match(r"^(.*\.dist-info)/(.+)$", path)
+        if m and DIST_INFO.match(path):
+            dist_infos.setdefault(m[1], {})[m[2]] = text
+
+    packages = {}
+    for dist_info, files in sorted(dist_infos.items()):
+        if "METADATA" not in files:
+            continue
+        metadata = Parser().parsestr(files["METADATA"], headersonly=True)
+        if not metadata.get("Name"):
+            continue
+
+        license_files = sorted(f for f in files if f != "METADATA")
+        license_text = files[license_files[0]] if license_files else None
+
+        pkg = PipPackage(
+            metadata["Name"],
+            metadata.get("Version", ""),
+            metadata_license(metadata),
+            None,
+            True,
+            license_text,
+        )
+        packages.setdefault((pkg.name.lower(), pkg.version), pkg)
+    return sorted(packages.values(), key=lambda p: p.name.lower())
+
+
+def image_from_archive(image_path: Path, no_cache: bool = False) -> CombinedPackages:
+    """
+    Finds the packages actually installed in an image, from a `docker save` or OCI
+    archive: apt packages from the dpkg database and their copyright files, and pip
+    packages from their `.dist-info` metadata. Every package found is reported as direct.
+    """
+    fs = merge_layers(image_layer_contents(image_path, no_cache))
+    return (pip_packages_from_filesystem(fs), []), apt_packages_from_filesystem(fs)
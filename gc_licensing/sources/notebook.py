@@ -1,35 +1,245 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+import json
+import re
 from pathlib import Path
-from typing import Tuple, List, Optional
-import nbformat as nbf
+from typing import Any, Iterator, Tuple, List, Optional, TextIO
 
 from ..package import CombinedPackages
 
-from .bash import filter_input, filter_output, MultilineStringCommandParser
+from .bash import commands_from_script
+from .shell import SimpleCommand
 from .utils import (
     run_list_of_commands,
 )
 
 
-def get_commands(notebook_path: Path):
-    nbtk = nbf.read(notebook_path.absolute(), nbf.NO_CONVERT)
-    code_cells = [c["source"] for c in nbtk.cells if c["cell_type"] == "code"]
+CHUNK_SIZE = 1 << 16
 
-    commands = []
-    for cell in code_cells:
-        commands += cell.split("\n")
+WHITESPACE = re.compile(r"[ \t\r\n]*")
+STRING_SPECIAL = re.compile(r'["\\]')
+# What ends a number or literal, and the next token that matters inside a container
+SCALAR_END = re.compile(r"[,}\]\s]")
+CONTAINER_TOKEN = re.compile(r'["{}\[\]]')
 
-    commands = filter_input(commands)
+SHELL_CELL_MAGICS = {"%%bash", "%%sh", "%%script bash", "%%script sh"}
+# Line magics which run the package manager of the same name
+PACKAGE_MAGICS = {"pip", "conda"}
+SHELL_MAGICS = {"sx", "system"}
 
-    q = MultilineStringCommandParser()
-    commands = q.process([" ".join(c) for c in commands])
-    commands = filter_output(commands)
-    return commands
+
+class _JsonScanner:
+    """
+    A minimal pull parser over a JSON file read in chunks. Values that aren't needed are
+    skipped without being decoded, and consumed input is dropped as it's read, so memory
+    use doesn't grow with the size of the values skipped (e.g. base64 image outputs).
+    """
+
+    def __init__(self, fh: TextIO, chunk_size: int = CHUNK_SIZE):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        # Start of a value being read, which must be kept in the buffer until it's decoded
+        self.mark: Optional[int] = None
+
+    def _fill(self) -> bool:
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            return False
+        start = self.pos if self.mark is None else self.mark
+        self.buffer = self.buffer[start:] + chunk
+        self.pos -= start
+        if self.mark is not None:
+            self.mark = 0
+        return True
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f"Invalid notebook JSON: {message}")
+
+    def peek(self) -> str:
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise self._error("unexpected end of file")
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise self._error(f"expected {char!r}, found {found!r}")
+        self.pos += 1
+
+    def skip_string(self):
+        self.expect('"')
+        while True:
+            m = STRING_SPECIAL.search(self.buffer, self.pos)
+            if m is None:
+                self.pos = len(self.buffer)
+            elif m[0] == '"':
+                self.pos = m.end()
+                return
+            elif m.end() < len(self.buffer):
+                self.pos = m.end() + 1
+                continue
+            else:
+                # An escape split across chunks
+                self.pos = m.start()
+            if not self._fill():
+                raise self._error("unterminated string")
+
+    def _skip_to(self, pattern: re.Pattern):
+        while True:
+            m = pattern.search(self.buffer, self.pos)
+            if m is not None:
+                self.pos = m.start()
+                return
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return
+
+    def skip_value(self):
+        depth = 0
+        while True:
+            c = self.peek()
+            if c == '"':
+                self.skip_string()
+            elif c in "{[":
+                depth += 1
+                self.pos += 1
+            elif c in "}]":
+                depth -= 1
+                self.pos += 1
+            elif depth == 0:
+                if c in ",:":
+                    raise self._error(f"expected a value, found {c!r}")
+                self._skip_to(SCALAR_END)
+            else:
+                self._skip_to(CONTAINER_TOKEN)
+            if depth <= 0:
+                return
+
+    def read_value(self) -> Any:
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            return json.loads(self.buffer[self.mark : self.pos])
+        finally:
+            self.mark = None
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        Yields the keys of an object, the caller must read or skip each value.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            c = self.peek()
+            self.pos += 1
+            if c == "}":
+                return
+            if c != ",":
+                raise self._error(f"expected ',' or '}}', found {c!r}")
+
+    def iter_array(self) -> Iterator[None]:
+        """
+        Yields once per item of an array, the caller must read or skip each item.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            c = self.peek()
+            self.pos += 1
+            if c == "]":
+                return
+            if c != ",":
+                raise self._error(f"expected ',' or ']', found {c!r}")
+
+
+def iter_code_cells(fh: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """
+    Streams the source of each code cell out of a notebook, skipping everything else
+    (outputs, attachments, metadata) without decoding or validating it.
+    """
+    scanner = _JsonScanner(fh, chunk_size)
+    for key in scanner.iter_object():
+        if key != "cells":
+            scanner.skip_value()
+            continue
+
+        for _ in scanner.iter_array():
+            cell_type, source = None, None
+            for cell_key in scanner.iter_object():
+                if cell_key == "cell_type":
+                    cell_type = scanner.read_value()
+                elif cell_key == "source":
+                    source = scanner.read_value()
+                else:
+                    scanner.skip_value()
+            if cell_type == "code" and source is not None:
+                yield source if isinstance(source, str) else "".join(source)
+
+
+def cell_shell_script(source: str) -> str:
+    """
+    The shell script run by a code cell: the whole cell for `%%bash` cells, otherwise
+    only its `!` shell escapes and package magics. Python code is never tokenized.
+    """
+    lines = source.split("\n")
+    if " ".join(lines[0].split()) in SHELL_CELL_MAGICS:
+        return "\n".join(lines[1:])
+
+    script = []
+    continuing = False
+    for line in lines:
+        stripped = line.strip()
+        if continuing:
+            script.append(line)
+        elif stripped.startswith("!"):
+            script.append(stripped[1:])
+        elif stripped.startswith("%"):
+            magic, _, args = stripped[1:].partition(" ")
+            if magic in PACKAGE_MAGICS:
+                script.append(f"{magic} {args}")
+            elif magic in SHELL_MAGICS:
+                script.append(args)
+            else:
+                continue
+        else:
+            continue
+        continuing = stripped.endswith("\\")
+    return "\n".join(script)
+
+
+def get_commands(notebook_path: Path) -> List[SimpleCommand]:
+    with open(notebook_path, encoding="utf-8") as fh:
+        scripts = [cell_shell_script(c) for c in iter_code_cells(fh)]
+    return commands_from_script("\n".join(scripts))
 
 
 def notebook_from_repo(
-    notebook_path: Path, no_cache: bool, find_requirements: bool
+    notebook_path: Path,
+    no_cache: bool,
+    find_requirements: bool,
+    apt_follow_depends: bool = False,
+    commands: Optional[List[SimpleCommand]] = None,
 ) -> Tuple[CombinedPackages, Optional[List[Path]]]:
-    code_cells = get_commands(notebook_path)
-    return run_list_of_commands(notebook_path, code_cells, no_cache, find_requirements)
+    if commands is None:
+        commands = get_commands(notebook_path)
+    return run_list_of_commands(
+        notebook_path,
+        commands,
+        no_cache,
+        find_requirements,
+        apt_follow_depends=apt_follow_depends,
+    )
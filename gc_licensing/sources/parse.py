@@ -0,0 +1,87 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import logging
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Literal, Optional, Tuple, Union
+
+from .bash import bash_commands
+from .docker import Stage, parse_stages
+from .notebook import get_commands
+from .shell import SimpleCommand
+
+
+SourceKind = Literal["dockerfile", "bash", "notebook"]
+
+# What the parse stage produces for each kind of file: the build stages of a Dockerfile, or
+# the commands run by a script or notebook.
+ParsedSource = Union[List[Stage], List[SimpleCommand]]
+
+
+def parse_source(kind: SourceKind, path: Path) -> ParsedSource:
+    if kind == "dockerfile":
+        return parse_stages(path.resolve())
+    if kind == "bash":
+        return bash_commands(path)
+    if kind == "notebook":
+        return get_commands(path)
+    raise ValueError(f"Unknown source kind {kind}")
+
+
+class ParseStage:
+    """
+    Parses bash scripts, Dockerfiles and notebooks on a pool of processes, as the parsing
+    is CPU bound pure Python. Files are submitted as soon as they're discovered, and the
+    parsed commands collected when their packages are resolved, so parsing carries on in
+    the background while earlier files are resolved. With `workers` <= 1 every file is
+    parsed in this process when submitted.
+    """
+
+    def __init__(self, workers: int):
+        self._executor: Optional[Executor] = (
+            ProcessPoolExecutor(workers) if workers > 1 else None
+        )
+        self._parsed: Dict[Tuple[SourceKind, Path], "Future[ParsedSource]"] = {}
+        # Files may be submitted from several threads, e.g. the Dockerfiles they build from
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "ParseStage":
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self, wait: bool = True):
+        """
+        Waits for every file submitted to be parsed, unless `wait` is False (e.g. the scan
+        was stopped): then the files which haven't started being parsed are cancelled.
+        """
+        if self._executor is not None:
+            if not wait:
+                # `shutdown(cancel_futures=True)` needs Python 3.9
+                for future in self._parsed.values():
+                    future.cancel()
+            self._executor.shutdown(wait)
+            self._executor = None
+
+    def submit(self, kind: SourceKind, path: Path):
+        key = (kind, path)
+        with self._lock:
+            if key in self._parsed:
+                return
+            if self._executor is not None:
+                self._parsed[key] = self._executor.submit(parse_source, kind, path)
+                return
+            future: "Future[ParsedSource]" = Future()
+            self._parsed[key] = future
+
+        try:
+            future.set_result(parse_source(kind, path))
+        except Exception as err:
+            future.set_exception(err)
+
+    def result(self, kind: SourceKind, path: Path) -> ParsedSource:
+        self.submit(kind, path)
+        logging.debug(f"Waiting for {kind} {path} to be parsed")
+        return self._parsed[(kind, path)].result()
@@ -3,13 +3,14 @@
 import re
 import sys
 import csv
+import json
 import logging
 import subprocess
 import tempfile
 import requests
 
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from pkginfo import Wheel
 
@@ -17,19 +18,39 @@ import requirements as requirements_parser
 from requirements.requirement import Requirement as ParserRequirement
 from packaging.requirements import Requirement, InvalidRequirement
 
+from ..lookup import shared_package
 from ..package import PipPackage, PipPackages
 
 
 PACKAGE_ROOT = Path(__file__).parent.parent
 
+# `-r other.txt`, `--requirement=other.txt`, `-c constraints.txt` etc.
+INCLUDE_LINE = re.compile(
+    r"^\s*(?:-r|-c|--requirement|--constraint)(?:\s*=\s*|\s+|(?<=-r)|(?<=-c))([^\s#]+)"
+)
+
+
+def create_packages(
+    deps: List[List[str]],
+    is_direct: bool = True,
+    license_texts: Optional[Dict[str, str]] = None,
+) -> List[PipPackage]:
+    license_texts = license_texts or {}
 
-def create_packages(deps: List[List[str]], is_direct: bool = True) -> List[PipPackage]:
     def package_from_row(row: List[str]) -> PipPackage:
         name: str = row[0]
         version: str = row[1]
         license_str: str = row[2]
         uri = row[3] if len(row) == 4 else None
-        return PipPackage(name, version, license_str, uri, is_direct)
+        license_text = license_texts.get(name.lower())
+        return shared_package(
+            "pip",
+            name.lower(),
+            version,
+            lambda: PipPackage(name, version, license_str, uri, True, license_text),
+            is_direct,
+            uri,
+        )
 
     deps = [package_from_row(d) for d in deps]
     return sorted(deps, key=lambda d: d.name.lower())
@@ -50,6 +71,23 @@ def get_requirements_after_install(
     return [l for l in reqs_after if l not in reqs_before]
 
 
+def read_license_texts(license_texts_path: Optional[Path]) -> Dict[str, str]:
+    """
+    Reads the license file contents dumped by `pip-licenses --with-license-file -f json`,
+    keyed by lower case package name.
+    """
+    if license_texts_path is None or not Path(license_texts_path).exists():
+        return {}
+
+    with open(license_texts_path) as fh:
+        rows = json.load(fh)
+    return {
+        r["Name"].lower(): r["LicenseText"]
+        for r in rows
+        if r.get("LicenseText") and r["LicenseText"] != "UNKNOWN"
+    }
+
+
 def filter_for_version_marker(reqs: List[Requirement]) -> List[Requirement]:
     vn = f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}"
     return [
@@ -144,10 +182,35 @@ def parse_requirements_file(requirements_path: Path) -> List[Requirement]:
         return []
 
 
+def requirements_file_includes(requirements_path: Path) -> List[Path]:
+    """
+    The files a requirements file pulls in with `-r`/`-c` (and their long forms),
+    recursively, as pip resolves them: relative to the including file.
+    """
+    includes: List[Path] = []
+    pending = [requirements_path]
+    while pending:
+        path = pending.pop()
+        try:
+            lines = path.read_text().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            m = INCLUDE_LINE.match(line)
+            if m is None:
+                continue
+            include = (path.parent / m[1]).resolve()
+            if include not in includes and include != requirements_path.resolve():
+                includes.append(include)
+                pending.append(include)
+    return includes
+
+
 def pip_from_csv(
     before_csv_path: Path,
     after_csv_path: Path,
     requirements: List[Requirement],
+    license_texts_path: Optional[Path] = None,
 ) -> PipPackages:
     # Filter out requirements that don't apply to this python version
     requirements_packages = {
@@ -168,8 +231,11 @@ def pip_from_csv(
         r for r in installed_requirements if r[0].lower() not in requirements_packages
     ]
 
-    direct_packages = create_packages(direct_reqs)
-    transitive_packages = create_packages(transitive_reqs, is_direct=False)
+    license_texts = read_license_texts(license_texts_path)
+    direct_packages = create_packages(direct_reqs, license_texts=license_texts)
+    transitive_packages = create_packages(
+        transitive_reqs, is_direct=False, license_texts=license_texts
+    )
     return direct_packages, transitive_packages
 
 
@@ -196,5 +262,6 @@ def pip_from_repo(
 
     before_path = app_path.resolve() / f"{app_name}-before.csv"
     after_path = app_path.resolve() / f"{app_name}-after.csv"
+    license_texts_path = app_path.resolve() / f"{app_name}-license-texts.json"
 
-    return pip_from_csv(before_path, after_path, requirements)
+    return pip_from_csv(before_path, after_path, requirements, license_texts_path)
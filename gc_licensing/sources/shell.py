@@ -0,0 +1,263 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import re
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+
+# Words which may come before a command without being the command themselves
+RESERVED_PREFIXES = {
+    "if",
+    "then",
+    "else",
+    "elif",
+    "do",
+    "while",
+    "until",
+    "!",
+    "{",
+    "time",
+}
+# Words which end a compound command, or start one that isn't itself a command
+RESERVED_COMMANDS = {"fi", "done", "esac", "}", "for", "select", "case", "function"}
+
+SHELLS = {"sh", "bash", "dash", "zsh"}
+ASSIGNMENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*=")
+OPERATORS = ("&&", "||", ";;", "|&", ";", "|", "&", "(", ")")
+WORD_END = " \t\r\n;|&()<>"
+
+
+@dataclass
+class SimpleCommand:
+    """
+    A single command with its arguments after quote removal, e.g. `pip install "numpy>=1.0"`
+    is `["pip", "install", "numpy>=1.0"]`. Redirections are dropped, and the bodies of any
+    heredocs it reads are attached in order.
+    """
+
+    argv: List[str]
+    heredocs: List[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return " ".join(self.argv)
+
+
+class _Tokenizer:
+    def __init__(self, text: str):
+        self.text = text
+        self.i = 0
+        self.commands: List[SimpleCommand] = []
+
+        self.current = SimpleCommand([])
+        self.word: List[str] = []
+        self.in_word = False
+        self.skip_word = False
+        self.pending_heredocs: List[Tuple[str, bool, SimpleCommand]] = []
+
+    def end_word(self):
+        if self.in_word:
+            if self.skip_word:
+                self.skip_word = False
+            else:
+                self.current.argv.append("".join(self.word))
+        self.word = []
+        self.in_word = False
+
+    def end_command(self):
+        self.end_word()
+        self.skip_word = False
+
+        argv = self.current.argv
+        start = 0
+        while start < len(argv) and (
+            argv[start] in RESERVED_PREFIXES or ASSIGNMENT.match(argv[start])
+        ):
+            start += 1
+        del argv[:start]
+
+        if argv and argv[0] not in RESERVED_COMMANDS:
+            self.commands.append(self.current)
+        self.current = SimpleCommand([])
+
+    def closing(self, i: int, open_char: str, close_char: str) -> int:
+        """
+        The index just past the bracket closing the one at `i`, e.g. for `$(...)`.
+        """
+        depth = 0
+        while i < len(self.text):
+            c = self.text[i]
+            if c == "\\":
+                i += 2
+                continue
+            if c == "'":
+                end = self.text.find("'", i + 1)
+                i = len(self.text) if end == -1 else end + 1
+                continue
+            if c == open_char:
+                depth += 1
+            elif c == close_char:
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+        return i
+
+    def substitution(self, i: int) -> int:
+        """
+        The index just past a `$(...)`, `${...}` or backtick substitution starting at `i`,
+        which is kept verbatim in the word.
+        """
+        text = self.text
+        if text[i] == "`":
+            end = i + 1
+            while end < len(text) and text[end] != "`":
+                end += 2 if text[end] == "\\" else 1
+            return min(end + 1, len(text))
+        if text.startswith("$(", i):
+            return self.closing(i + 1, "(", ")")
+        return self.closing(i + 1, "{", "}")
+
+    def double_quoted(self):
+        text = self.text
+        i = self.i + 1
+        self.in_word = True
+        while i < len(text):
+            c = text[i]
+            if c == "\\" and i + 1 < len(text):
+                if text[i + 1] == "\n":
+                    i += 2
+                    continue
+                if text[i + 1] in '"\\$`':
+                    self.word.append(text[i + 1])
+                    i += 2
+                    continue
+            elif c == '"':
+                i += 1
+                break
+            elif c == "`" or (c == "$" and text[i + 1 : i + 2] in ("(", "{")):
+                end = self.substitution(i)
+                self.word.append(text[i:end])
+                i = end
+                continue
+            self.word.append(c)
+            i += 1
+        self.i = i
+
+    def heredoc_operator(self):
+        self.end_word()
+        text = self.text
+        i = self.i + 2
+        strip_tabs = text[i : i + 1] == "-"
+        if strip_tabs:
+            i += 1
+        while i < len(text) and text[i] in " \t":
+            i += 1
+
+        start = i
+        while i < len(text) and text[i] not in WORD_END:
+            i += 1
+        delimiter = re.sub(r"[\"'\\]", "", text[start:i])
+        if delimiter:
+            self.pending_heredocs.append((delimiter, strip_tabs, self.current))
+        self.i = i
+
+    def heredoc_bodies(self):
+        text = self.text
+        for delimiter, strip_tabs, command in self.pending_heredocs:
+            body = []
+            while self.i < len(text):
+                end = text.find("\n", self.i)
+                end = len(text) if end == -1 else end
+                line = text[self.i : end]
+                self.i = end + 1
+                if strip_tabs:
+                    line = line.lstrip("\t")
+                if line.rstrip() == delimiter:
+                    break
+                body.append(line)
+            command.heredocs.append("\n".join(body))
+        self.pending_heredocs.clear()
+
+    def redirection(self):
+        # A file descriptor number directly before the operator (e.g. `2>`) isn't an argument
+        if self.in_word and "".join(self.word).isdigit():
+            self.word = []
+            self.in_word = False
+        else:
+            self.end_word()
+
+        i = self.i + 1
+        while i < len(self.text) and self.text[i] in "<>&|":
+            i += 1
+        self.i = i
+        self.skip_word = True
+
+    def run(self) -> List[SimpleCommand]:
+        text = self.text
+        while self.i < len(text):
+            c = text[self.i]
+            if c == "\\":
+                if text[self.i + 1 : self.i + 2] != "\n":
+                    self.word.append(text[self.i + 1 : self.i + 2])
+                    self.in_word = True
+                self.i += 2
+            elif c == "'":
+                end = text.find("'", self.i + 1)
+                end = len(text) if end == -1 else end
+                self.word.append(text[self.i + 1 : end])
+                self.in_word = True
+                self.i = end + 1
+            elif c == '"':
+                self.double_quoted()
+            elif c == "`" or (c == "$" and text[self.i + 1 : self.i + 2] in ("(", "{")):
+                end = self.substitution(self.i)
+                self.word.append(text[self.i : end])
+                self.in_word = True
+                self.i = end
+            elif c == "#" and not self.in_word:
+                end = text.find("\n", self.i)
+                self.i = len(text) if end == -1 else end
+            elif c in " \t\r":
+                self.end_word()
+                self.i += 1
+            elif c == "\n":
+                self.end_command()
+                self.i += 1
+                self.heredoc_bodies()
+            elif text.startswith("<<", self.i) and not text.startswith("<<<", self.i):
+                self.heredoc_operator()
+            elif c in "<>" or text.startswith("&>", self.i):
+                self.redirection()
+            elif c in ";|&()":
+                self.end_command()
+                self.i += next(len(o) for o in OPERATORS if text.startswith(o, self.i))
+            else:
+                self.word.append(c)
+                self.in_word = True
+                self.i += 1
+        self.end_command()
+        return self.commands
+
+
+def is_shell(program: str) -> bool:
+    return program.split("/")[-1] in SHELLS
+
+
+def parse_script(text: str) -> List[SimpleCommand]:
+    """
+    Splits a shell script into its simple commands in a single pass, respecting quoting,
+    line continuations, comments, heredocs, command lists (`&&`, `||`, `;`, `&`) and
+    pipelines. Scripts run by a nested shell (`bash -c "..."`, `sh <<EOF`) are expanded
+    in place.
+    """
+    commands = []
+    for command in _Tokenizer(text).run():
+        argv = command.argv
+        if is_shell(argv[0]) and "-c" in argv[1:-1]:
+            commands += parse_script(argv[argv.index("-c") + 1])
+        elif is_shell(argv[0]) and len(argv) == 1 and command.heredocs:
+            for body in command.heredocs:
+                commands += parse_script(body)
+        else:
+            commands.append(command)
+    return commands
@@ -1,112 +1,39 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
-from functools import reduce
+import logging
+import os
+import re
+import subprocess
 from pathlib import Path
 import tempfile
-from typing import List, Optional, Tuple
-import re
-import apt
+from concurrent.futures import Future
+from typing import Dict, Iterable, Iterator, List, Optional, Pattern, Tuple
 
-from .apt import get_package_license
+from .apt import get_apt_cache, get_package_licenses
 
 
-from ..package import AptPackage, CombinedPackages, PipPackage
+from ..lookup import lookups
+from ..package import AptPackage, CombinedPackages, PipPackage, PipPackages
+from ..scheduler import WorkItem, submit, submit_item
+from .commands import Command, copy_source, extract_installs, parse_copy
 from .pip import parse_requirements_file, pip_from_repo
 
 
-# All arguments to pip that take a second parameter, used to filter out that parameter.
-# Parsed out of `pip install --help`
-PIP_TWO_PARAMS_ARGS = [
-    "-r",
-    "-qr",
-    "--requirement",
-    "-c",
-    "--constraint",
-    "-e",
-    "--editable",
-    "-t",
-    "--target",
-    "--platform",
-    "--python-version",
-    "--implementation",
-    "--abi",
-    "--root",
-    "--prefix",
-    "-b",
-    "--build",
-    "--src",
-    "--upgrade-strategy",
-    "--install-option",
-    "--global-option",
-    "--no-binary",
-    "--only-binary",
-    "--progress-bar",
-    "-i",
-    "--index-url",
-    "--extra-index-url",
-    "-f",
-    "--find-links",
-    "--log",
-    "--proxy",
-    "--retries",
-    "--timeout",
-    "--exists-action",
-    "--trusted-host",
-    "--cert",
-    "--client-cert",
-    "--cache-dir",
-]
-
-# A less complete list, from reading `man apt-get` and `man apt-cache`
-APT_TWO_PARAMS_ARGS = [
-    "--with-source",
-    "-o",
-    "--option" "-c",
-    "--config-file",
-    "-p",
-    "--pkg-cache",
-    "-q",
-    "-s",
-    "--src-cache",
-]
-
-
-def filter_installs(commands: List[List[str]], two_params_args: List[str]) -> List[str]:
-    packages = []
-    for command in commands:
-        for p in two_params_args:
-            if p in command:
-                idx = command.index(p)
-                del command[idx : idx + 2]
-        command = [p for p in command if not p.startswith("-")]
-
-        packages += command
-    return packages
-
-
-def requirement_files_from_commands(commands: List[str]) -> List[str]:
-    matches = [
-        re.findall(r".*pip3*\sinstall\s.*-[a-qs-z]*r\s([^ ]+)", r) for r in commands
-    ]
-    return [m for n in matches for m in n if n]
+def requirement_files_from_commands(commands: List[Command]) -> List[str]:
+    return extract_installs(commands).requirement_files
 
 
-def pip_packages_from_commands(commands: List[str]) -> List[str]:
-    pip_installs = [re.findall(r".*pip3*\sinstall\s(.+)", r) for r in commands]
-    pip_installs = [r[0].split() for r in pip_installs if r]
-    return filter_installs(pip_installs, PIP_TWO_PARAMS_ARGS)
+def pip_packages_from_commands(commands: List[Command]) -> List[str]:
+    return extract_installs(commands).pip_packages
 
 
-def apt_packages_from_commands(commands: List[str]) -> List[str]:
-    apt_installs = [re.match(r".*apt(?:\-get?).+install\s(.+)", r) for r in commands]
-    apt_installs = [r[1].split() for r in apt_installs if r is not None]
-    return filter_installs(apt_installs, APT_TWO_PARAMS_ARGS)
+def apt_packages_from_commands(commands: List[Command]) -> List[str]:
+    return extract_installs(commands).apt_packages
 
 
-def pip_licenses_from_commands(
-    run_commands: List[str],
+def pip_licenses_from_packages(
+    pip_packages: List[str],
 ) -> Tuple[List[PipPackage], List[PipPackage]]:
-    pip_packages = pip_packages_from_commands(run_commands)
     if not pip_packages:
         return [], []
 
@@ -123,76 +50,270 @@ def pip_licenses_from_commands(
         return pip_from_repo(tempdir_path, "requirements.txt", reqs)
 
 
-def apt_licenses_from_commands(
-    run_commands: List[str], no_cache: bool = False
-) -> List[AptPackage]:
-    apt_cache = apt.Cache()
-    apt_packages = apt_packages_from_commands(run_commands)
+RequirementSet = Tuple[str, ...]
 
-    return [get_package_license(apt_cache, p.strip(), no_cache) for p in apt_packages]
 
+def requirement_set(pip_packages: Iterable[str]) -> RequirementSet:
+    return tuple(sorted(set(pip_packages)))
 
-def path_is_ignored(path: Path, ignore_paths: List[Path]) -> bool:
-    path = path.resolve()
-    for p in ignore_paths:
-        if p == path or p in path.parents:
-            return True
-    return False
 
+def pip_licenses_future(
+    pip_packages: RequirementSet,
+) -> "Future[Tuple[List[PipPackage], List[PipPackage]]]":
+    """
+    Every distinct set of pip packages installed by commands is installed into a single
+    venv per run, however many stages, scripts and notebooks install it. The scan plan
+    submits each set up front; any others are submitted when first needed.
+    """
+    item = WorkItem(
+        "requirements", " ".join(pip_packages), "venv", size=len(pip_packages)
+    )
+    return lookups.get(
+        ("pip-requirements", pip_packages),
+        lambda: submit_item(item, pip_licenses_from_packages, list(pip_packages)),
+    )
 
-def find_requirements_files(
-    base_path: Path, requirements_files_names: List[str], ignore_paths: List[Path]
-) -> List[Path]:
-    ignore_paths = [a.resolve() for a in ignore_paths]
 
-    files = set(
-        reduce(
-            lambda x, f: x + [b.resolve() for b in base_path.glob(f"**/{f}")],
-            requirements_files_names,
-            [],
-        )
+def apt_licenses_from_packages(
+    apt_packages: List[str], no_cache: bool = False, follow_depends: bool = False
+) -> List[AptPackage]:
+    apt_cache = get_apt_cache()
+    return get_package_licenses(apt_cache, apt_packages, no_cache, follow_depends)
+
+
+def merge_combined_packages(packages: List[CombinedPackages]) -> CombinedPackages:
+    """
+    Merges the packages found in several places, keeping the first of any duplicates.
+    A pip package is only transitive if it's not a direct dependency anywhere.
+    """
+    pip_direct = {}
+    pip_transitive = {}
+    apt = {}
+    for (direct, transitive), apt_packages in packages:
+        for p in direct:
+            pip_direct.setdefault((p.name.lower(), p.version), p)
+        for p in transitive:
+            pip_transitive.setdefault((p.name.lower(), p.version), p)
+        for p in apt_packages:
+            if p.name not in apt or (p.is_direct and not apt[p.name].is_direct):
+                apt[p.name] = p
+
+    pip_transitive = {k: v for k, v in pip_transitive.items() if k not in pip_direct}
+    pip_packages: PipPackages = (
+        list(pip_direct.values()),
+        list(pip_transitive.values()),
     )
+    return pip_packages, list(apt.values())
+
+
+# Marks a node of the ignore trie as ignored, along with everything below it
+_IGNORED = None
+
+
+def _ignore_trie(ignore_paths: Iterable[Path]) -> Dict:
+    trie: Dict = {}
+    for path in ignore_paths:
+        node = trie
+        for part in path.resolve().parts:
+            node = node.setdefault(part, {})
+        node[_IGNORED] = True
+    return trie
+
+
+def glob_pattern(pattern: str) -> Pattern:
+    """
+    A regex matching the relative paths that `Path.glob(f"**/{pattern}")` would find, i.e.
+    `pattern` at any depth. `*` and `?` don't match across directories, and `**` matches
+    any number of them.
+    """
+    parts = []
+    for segment in pattern.strip("/").split("/"):
+        if segment == "**":
+            parts.append("(?:[^/]+/)*")
+            continue
+
+        regex = ""
+        i = 0
+        while i < len(segment):
+            c = segment[i]
+            end = segment.find("]", i + 2) if c == "[" else -1
+            if c == "*":
+                regex += "[^/]*"
+            elif c == "?":
+                regex += "[^/]"
+            elif end != -1:
+                char_class = segment[i + 1 : end]
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                regex += f"[{char_class}]"
+                i = end
+            else:
+                regex += re.escape(c)
+            i += 1
+        parts.append(regex + "/")
+    return re.compile("^(?:[^/]+/)*" + "".join(parts)[:-1] + "$")
+
+
+def _walk_files(base_path: Path, node: Optional[Dict]) -> Iterator[str]:
+    """
+    The files below `base_path`, relative to it. `node` is the ignore trie node of
+    `base_path`, which is walked alongside the tree so that ignored directories are never
+    descended into. Symlinked directories aren't followed.
+    """
+    stack: List[Tuple[str, str, Optional[Dict]]] = [(str(base_path), "", node)]
+    while stack:
+        directory, relative_dir, node = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as err:
+            logging.warning(f"Couldn't read directory {directory}: {err}")
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            child = node.get(entry.name) if node else None
+            if child is not None and _IGNORED in child:
+                continue
+
+            relative_path = relative_dir + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append((entry.path, relative_path + "/", child))
+            elif entry.is_file():
+                yield relative_path
+        stack += reversed(subdirectories)
+
+
+def _git_files(base_path: Path, node: Optional[Dict]) -> Optional[Iterator[str]]:
+    """
+    The files below `base_path` that are tracked by git, relative to it, or None if it's
+    not in a git repository. Listing the index never touches untracked or ignored files.
+    """
+    try:
+        result = subprocess.run(
+            ["git", "-C", str(base_path), "ls-files", "-z", "--cached"],
+            capture_output=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as err:
+        stderr = getattr(err, "stderr", b"") or b""
+        logging.warning(
+            f"Couldn't list files tracked by git in {base_path}, walking the directory "
+            f"instead: {stderr.decode(errors='replace').strip() or err}"
+        )
+        return None
+
+    def iter_files() -> Iterator[str]:
+        for relative_path in result.stdout.decode(errors="surrogateescape").split("\0"):
+            if not relative_path:
+                continue
+            ignored = node
+            for part in relative_path.split("/"):
+                ignored = ignored.get(part) if ignored else None
+                if ignored is not None and _IGNORED in ignored:
+                    break
+            else:
+                # The index may list files that have since been deleted
+                if (base_path / relative_path).is_file():
+                    yield relative_path
+
+    return iter_files()
+
+
+def discover_files(
+    base_path: Path,
+    patterns: Dict[str, List[str]],
+    ignore_paths: List[Path],
+    backend: str = "walk",
+) -> Dict[str, List[Path]]:
+    """
+    Finds the files matching each kind of source's patterns (as `find_requirements_files`)
+    from a single listing of `base_path`: either a walk of the directory (`walk`), or the
+    files tracked by git (`git`), which falls back to the walk outside a git repository.
+    Ignored paths are held in a trie of path components, so ignored directories are pruned
+    without checking every path against every ignored path.
+    """
+    base_path = base_path.resolve()
+    matchers = [
+        (kind, glob_pattern(p)) for kind, names in patterns.items() for p in names
+    ]
+    found: Dict[str, List[Path]] = {kind: [] for kind in patterns}
+    if not matchers:
+        return found
+
+    node: Optional[Dict] = _ignore_trie(ignore_paths)
+    for part in base_path.parts:
+        node = node.get(part) if node else None
+        if node is not None and _IGNORED in node:
+            return found
+
+    files = _git_files(base_path, node) if backend == "git" else None
+    if files is None:
+        files = _walk_files(base_path, node)
+
+    for relative_path in files:
+        matched = set()
+        for kind, regex in matchers:
+            if kind not in matched and regex.match(relative_path):
+                found[kind].append(Path(relative_path))
+                matched.add(kind)
 
-    if ignore_paths:
-        files = [f for f in files if not path_is_ignored(f, ignore_paths)]
+    for kind, kind_files in found.items():
+        print(f"Found {kind} files {[str(f) for f in kind_files]}")
+    return found
 
-    print(f"Found files {[str(f) for f in files]}")
-    return [f.relative_to(base_path.resolve()) for f in files]
+
+def find_requirements_files(
+    base_path: Path,
+    requirements_files_names: List[str],
+    ignore_paths: List[Path],
+    backend: str = "walk",
+) -> List[Path]:
+    return discover_files(
+        base_path, {"requirements": requirements_files_names}, ignore_paths, backend
+    )["requirements"]
 
 
 def handle_copied_requirement_files(
-    req_files: List[str], copy_commands: List[str]
+    req_files: List[str], copy_commands: Optional[List[str]]
 ) -> List[str]:
+    """
+    Requirements files installed from a Dockerfile are paths in the image, so map any
+    that were copied in back to their source in the build context.
+    """
     if not copy_commands:
         return req_files
 
-    for c in copy_commands:
-        for i, r in enumerate(req_files):
-            # Not as simple as just splitting on space - what if the path contains a space?
-            # Instead find the target of the copy from the list of requirements files, then
-            # extract the source of the copy from the rest of the command.
-            copy_src_match = re.match(f"(.+)\\s{r}", c)
-            if copy_src_match is not None:
-                req_files[i] = copy_src_match[1]
-    return req_files
+    copies = [parse_copy(c) for c in copy_commands]
+    return [copy_source(r, copies) or r for r in req_files]
 
 
 def run_list_of_commands(
     script_path: Path,
-    commands: List[str],
+    commands: List[Command],
     no_cache: bool,
     find_requirements: bool,
     copy_commands: Optional[List[str]] = None,
+    apt_follow_depends: bool = False,
 ) -> Tuple[CombinedPackages, List[Path]]:
-    pip_licenses = pip_licenses_from_commands(commands)
-    apt_licenses = apt_licenses_from_commands(commands, no_cache)
+    installs = extract_installs(commands)
+    # The pip packages are installed into a venv while the apt packages are looked up
+    pip_licenses = pip_licenses_future(requirement_set(installs.pip_packages))
+    apt_licenses = submit(
+        "network",
+        apt_licenses_from_packages,
+        installs.apt_packages,
+        no_cache,
+        apt_follow_depends,
+    )
 
     if find_requirements:
-        req_files = requirement_files_from_commands(commands)
-        req_files = handle_copied_requirement_files(req_files, copy_commands)
+        req_files = handle_copied_requirement_files(
+            installs.requirement_files, copy_commands
+        )
         absolute_req_files = list(
             set((script_path.parent / r).resolve() for r in req_files)
         )
     else:
         absolute_req_files = []
-    return (pip_licenses, apt_licenses), absolute_req_files
+    return (pip_licenses.result(), apt_licenses.result()), absolute_req_files
@@ -0,0 +1,138 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+# <sha256 of content> <length of compressed content>, followed by the compressed content
+BLOB_HEADER = struct.Struct(">32sI")
+
+# <sha256 of key> <sha256 of content> <offset of compressed content in pack> <length>
+INDEX_RECORD = struct.Struct(">32s32sQI")
+
+BlobLocation = Tuple[int, int]
+
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+class PackStore:
+    """
+    Content-addressed key/value store backed by two append-only files:
+     * `<name>.pack` holds zlib compressed blobs, each one stored only once no matter how
+       many keys refer to it (e.g. the many copies of the GPL or Expat boilerplate).
+     * `<name>.idx` holds fixed size records mapping a key to a blob in the pack. It is
+       memory-mapped and scanned on open, then only records appended since are read.
+
+    Writers hold an exclusive `flock` on the index while appending, so multiple processes
+    can safely share a store (e.g. on a shared CI volume). A blob is always fully written
+    before the index record pointing at it, so readers never need to take the lock.
+    """
+
+    def __init__(self, path: Path, name: str):
+        path.mkdir(exist_ok=True, parents=True)
+        self.pack_path = path / f"{name}.pack"
+        self.index_path = path / f"{name}.idx"
+        self.pack_path.touch(exist_ok=True)
+        self.index_path.touch(exist_ok=True)
+
+        self._keys: Dict[bytes, BlobLocation] = {}
+        self._blobs: Dict[bytes, BlobLocation] = {}
+        self._index_size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def exists(path: Path, name: str) -> bool:
+        """
+        Whether the store has been created, without creating it.
+        """
+        return (path / f"{name}.idx").exists()
+
+    def _refresh(self):
+        """
+        Reads any index records appended (by this or any other process) since the last refresh.
+        """
+        size = self.index_path.stat().st_size
+        size -= size % INDEX_RECORD.size
+        if size <= self._index_size:
+            return
+
+        with open(self.index_path, "rb") as fh:
+            with mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ) as index:
+                new_records = index[self._index_size : size]
+
+        for key_digest, content_digest, offset, length in INDEX_RECORD.iter_unpack(
+            new_records
+        ):
+            self._keys[key_digest] = (offset, length)
+            self._blobs[content_digest] = (offset, length)
+        self._index_size = size
+
+    def _location(self, key: str) -> Optional[BlobLocation]:
+        key_digest = _digest(key.encode())
+        with self._lock:
+            if key_digest not in self._keys:
+                self._refresh()
+            return self._keys.get(key_digest)
+
+    def __contains__(self, key: str) -> bool:
+        return self._location(key) is not None
+
+    def get(self, key: str) -> Optional[bytes]:
+        location = self._location(key)
+        if location is None:
+            return None
+
+        offset, length = location
+        with open(self.pack_path, "rb") as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as pack:
+                return zlib.decompress(pack[offset : offset + length])
+
+    def put(self, key: str, data: bytes):
+        key_digest = _digest(key.encode())
+        content_digest = _digest(data)
+
+        with self._lock, open(self.index_path, "r+b") as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                location = self._blobs.get(content_digest)
+                if location is not None and self._keys.get(key_digest) == location:
+                    return
+
+                if location is None:
+                    compressed = zlib.compress(data)
+                    with open(self.pack_path, "ab") as pack:
+                        offset = os.fstat(pack.fileno()).st_size + BLOB_HEADER.size
+                        pack.write(BLOB_HEADER.pack(content_digest, len(compressed)))
+                        pack.write(compressed)
+                        pack.flush()
+                        os.fsync(pack.fileno())
+                    location = (offset, len(compressed))
+
+                # Drop any partial record left by a writer that died mid-append.
+                index.truncate(self._index_size)
+                index.seek(self._index_size)
+                index.write(INDEX_RECORD.pack(key_digest, content_digest, *location))
+                index.flush()
+
+                self._index_size += INDEX_RECORD.size
+                self._keys[key_digest] = location
+                self._blobs[content_digest] = location
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+
+    def get_text(self, key: str) -> Optional[str]:
+        data = self.get(key)
+        return data.decode() if data is not None else None
+
+    def put_text(self, key: str, text: str):
+        self.put(key, text.encode())
@@ -0,0 +1,62 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+# Weight of the latest duration of a work item in its estimate, against those before it
+LATEST_WEIGHT = 0.5
+
+
+class TimingHistory:
+    """
+    How long each work item (keyed by `WorkItem.key`) took in previous runs, kept in a small
+    JSON file in the cache directory. Items read from files (e.g. requirements files) are
+    recorded with the digest of their contents, and only estimated from durations recorded
+    for the same contents: editing a file invalidates its history. Estimates are a moving
+    average of the durations recorded, so a single slow run (e.g. a cold pip cache) doesn't
+    skew them for long.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Work item key: (digest of its contents, seconds)
+        self._durations: Dict[str, Tuple[str, float]] = {}
+        try:
+            stored = json.loads(path.read_text())
+            self._durations = {
+                key: (str(digest), float(seconds))
+                for key, (digest, seconds) in stored.items()
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as err:
+            logging.warning(f"Ignoring unreadable timings {path}: {err}")
+
+    @classmethod
+    def in_cache(cls, cache_path: Path) -> "TimingHistory":
+        return cls(Path(cache_path) / "timings.json")
+
+    def estimate(self, key: str, digest: str = "") -> Optional[float]:
+        with self._lock:
+            recorded = self._durations.get(key)
+        if recorded is None or recorded[0] != digest:
+            return None
+        return recorded[1]
+
+    def record(self, key: str, seconds: float, digest: str = ""):
+        with self._lock:
+            previous = self._durations.get(key)
+            if previous is not None and previous[0] == digest:
+                seconds = LATEST_WEIGHT * seconds + (1 - LATEST_WEIGHT) * previous[1]
+            self._durations[key] = (digest, seconds)
+
+    def save(self):
+        with self._lock:
+            text = json.dumps(self._durations, indent=1, sort_keys=True)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(text)
@@ -1,13 +1,39 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
 import argparse
+import os
 from pathlib import Path
+from typing import Tuple
 
 from .package import AptPackages
 
 CONFIG_ROOT = Path(__file__).parent
 
 
+def image_mapping(value: str) -> Tuple[str, Path]:
+    image, sep, dockerfile = value.partition("=")
+    if not sep or not image or not dockerfile:
+        raise argparse.ArgumentTypeError(f"Expected IMAGE=DOCKERFILE, got `{value}`")
+    return image, Path(dockerfile)
+
+
+def duration(value: str) -> float:
+    """
+    A number of seconds, or of minutes or hours with an `m` or `h` suffix (e.g. `90m`).
+    """
+    units = {"s": 1, "m": 60, "h": 3600}
+    number, unit = (value[:-1], value[-1]) if value[-1:] in units else (value, "s")
+    try:
+        seconds = float(number) * units[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Expected a duration like 600, 45m or 2h, got `{value}`"
+        )
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"Expected a positive duration, got `{value}`")
+    return seconds
+
+
 def parse_args():
     config_parser = argparse.ArgumentParser()
     config_parser.add_argument(
@@ -25,6 +51,66 @@ def parse_args():
     parser.add_argument("--repository", type=Path, required=True)
     parser.add_argument("--no-follow-requirements-files", action="store_true")
     parser.add_argument("--ignore-paths", type=Path, nargs="*", default=None)
+    parser.add_argument(
+        "--discovery",
+        choices=["walk", "git"],
+        default="walk",
+        help="How `--find-*` options list the repository's files. `walk` walks the directory "
+        "tree, `git` lists the files tracked by git (so anything .gitignored is skipped), "
+        "falling back to `walk` if the repository isn't a git repository.",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes used to parse Dockerfiles, bash scripts and notebooks. "
+        "With 1, files are parsed in the main process. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--network-workers",
+        type=int,
+        default=8,
+        help="Number of files whose apt packages are looked up at once.",
+    )
+    parser.add_argument(
+        "--venv-workers",
+        type=int,
+        default=2,
+        help="Number of venvs pip requirements are installed into at once.",
+    )
+    parser.add_argument(
+        "--incremental-base",
+        type=str,
+        default=None,
+        metavar="REF",
+        help="Only re-resolve the files which changed (directly or through the files they "
+        "include, copy or run) since the git commit REF, reusing the results stored by "
+        "the scan of REF for everything else.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Checkpoint the results of each file as it's resolved, and reuse those "
+        "checkpointed by previous scans with `--resume` (e.g. one which crashed or was "
+        "preempted) for the files whose contents, and those of the files they depend on, "
+        "haven't changed since.",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=duration,
+        default=None,
+        metavar="DURATION",
+        help="Finish within DURATION (seconds, or e.g. `45m` or `2h`) of starting. Work "
+        "expected to run past it (from how long it took before) isn't started, and the "
+        "scan is stopped when it runs out. Files left unfinished are reported as not "
+        "evaluated, and it exits with failure.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the work the scan would do, which of it is cached and how long the "
+        "rest is estimated to take (from how long it took before), then exit.",
+    )
 
     grp = parser.add_argument_group("Pip")
     grp.add_argument(
@@ -39,6 +125,13 @@ def parse_args():
         default=None,
         help="Cached CSV containing post-install packages from the PIP license check.",
     )
+    grp.add_argument(
+        "--pip-license-texts",
+        type=Path,
+        default=None,
+        help="Cached JSON containing the license files of post-install packages, "
+        "from `pip-licenses -f json --with-license-file --no-license-path`.",
+    )
     grp.add_argument("--pip-requirements-files", type=Path, nargs="*", default=[])
     grp.add_argument("--find-pip-files", action="store_true")
     grp.add_argument(
@@ -48,6 +141,46 @@ def parse_args():
     grp = parser.add_argument_group("Apt / apt-get")
     grp.add_argument("--apt-requirements-files", type=Path, nargs="*", default=[])
     grp.add_argument("--apt-no-cache", action="store_true")
+    grp.add_argument(
+        "--apt-backend",
+        choices=["python-apt", "index"],
+        default=None,
+        help="Where to look up apt packages. `python-apt` uses the host's apt cache (requires "
+        "python3-apt), `index` parses dpkg status and Packages index files directly. "
+        "Defaults to `python-apt` when it is installed.",
+    )
+    grp.add_argument(
+        "--apt-release",
+        type=str,
+        default=None,
+        help="`index` backend only: download and audit against the Packages indexes of this "
+        "release (e.g. `jammy`) rather than the host's.",
+    )
+    grp.add_argument(
+        "--apt-architecture",
+        type=str,
+        default=None,
+        help="`index` backend only: the architecture of the indexes to use (e.g. `amd64`).",
+    )
+    grp.add_argument(
+        "--apt-mirror",
+        type=str,
+        default=None,
+        help="`index` backend only: the mirror to download `--apt-release` indexes from.",
+    )
+    grp.add_argument(
+        "--apt-index-files",
+        type=Path,
+        nargs="*",
+        default=None,
+        help="`index` backend only: dpkg status or Packages(.gz|.xz) files to use.",
+    )
+    grp.add_argument(
+        "--apt-follow-depends",
+        action="store_true",
+        help="Also check the licenses of every package apt would install as a runtime "
+        "dependency of the requested packages. These are reported as transitive dependencies.",
+    )
     grp.add_argument("--find-apt-files", action="store_true")
     grp.add_argument("--find-apt-files-names", type=str, nargs="*", default=[])
 
@@ -58,6 +191,15 @@ def parse_args():
         "--find-dockerfiles-names", type=str, nargs="*", default=["Dockerfile"]
     )
     grp.add_argument("--docker-no-follow-requirements-files", action="store_true")
+    grp.add_argument(
+        "--docker-image-map",
+        type=image_mapping,
+        nargs="*",
+        default=[],
+        metavar="IMAGE=DOCKERFILE",
+        help="Local base images and the Dockerfiles (relative to the repository) which build "
+        "them. Dockerfiles built `FROM` these images include their packages.",
+    )
 
     grp = parser.add_argument_group("Bash")
     grp.add_argument("--bash-files", type=Path, nargs="*", default=[])
@@ -73,6 +215,16 @@ def parse_args():
     )
     grp.add_argument("--notebook-no-follow-requirements-files", action="store_true")
 
+    grp = parser.add_argument_group("Container images")
+    grp.add_argument(
+        "--container-images",
+        type=Path,
+        nargs="*",
+        default=[],
+        help="Image archives (optionally compressed) saved by `docker save` or in OCI "
+        "layout. The packages actually installed in the image are read from its layers.",
+    )
+
     grp = parser.add_argument_group("Output")
     grp.add_argument(
         "--output-path",
@@ -101,6 +253,14 @@ def parse_args():
         action="store_true",
         help="Only used for JUnit output. If set, transitive dependencies will render as test failures in the JUnit",
     )
+    grp.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="Check the packages of each file as soon as it's resolved, and stop the scan "
+        "at the first direct dependency (or with `--fail-on-transitive`, any dependency) "
+        "failing the check. Reports list the files checked by then, and it exits with "
+        "failure.",
+    )
     args = parser.parse_args(remaining_args)
 
     if args.output_path is None and args.upload_page_id is None:
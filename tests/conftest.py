@@ -3,12 +3,21 @@
 import pytest
 from pathlib import Path
 from gc_licensing.config import configs
+from gc_licensing.lookup import lookups
 
 
 @pytest.fixture
-def load_config():
+def load_config(tmp_path):
     app_config_path = Path(__file__).parent / "assets" / "config.yml"
     user_config_path = Path(__file__).parent / "assets" / "user.config.yml"
     configs.load(app_config_path, user_config_path)
+    # Keep the caches tests write out of the repository
+    configs.app.apt.cache_path = tmp_path / "license-cache"
 
     return configs
+
+
+@pytest.fixture(autouse=True)
+def clear_lookups():
+    # Lookups are shared for the rest of the run, which for tests is a single test
+    lookups.clear()
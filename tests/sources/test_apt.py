@@ -1,31 +1,35 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
 from dataclasses import dataclass
-import string
 from typing import List
 import pytest
-import random
 
 from gc_licensing.license import License
+from gc_licensing.package import AptPackage
+from gc_licensing.sources import apt as apt_source
 from gc_licensing.sources.apt import (
-    cache_name,
+    CopyrightRecord,
     changelog_uris,
+    copyright_store,
+    dependency_closure,
+    fetch_source_copyright,
     generate_output_package,
+    get_package_license,
+    get_package_licenses,
+    parse_copyright,
     parse_copyright_text,
+    source_copyright_cached,
 )
 
 
-@pytest.mark.parametrize(
-    "input_string",
-    [
-        ["".join(random.choice(string.ascii_letters) for _ in range(10))]
-        for _ in range(10)
-    ],
-)
-def test_cache_name(load_config, input_string):
-    c = cache_name(input_string)
-    assert c.name == f"license_{input_string}.txt"
-    assert c.parent == load_config.app.apt.cache_path
+def test_copyright_store(load_config, monkeypatch, tmp_path):
+    monkeypatch.setattr(load_config.app.apt, "cache_path", tmp_path / "a")
+    store = copyright_store()
+    assert store.pack_path.parent == tmp_path / "a"
+    assert copyright_store() is store
+
+    monkeypatch.setattr(load_config.app.apt, "cache_path", tmp_path / "b")
+    assert copyright_store().pack_path.parent == tmp_path / "b"
 
 
 @pytest.mark.parametrize(
@@ -79,60 +83,314 @@ def test_changelog_uris(
     assert uris == expected_urls
 
 
+@dataclass
+class MockVersion:
+    source_name: str
+    version: str
+    filename: str
+
+
+@dataclass
+class MockPackage:
+    versions: List[MockVersion]
+
+
+@dataclass
+class MockResponse:
+    status_code: int
+    text: str
+
+
+def test_get_package_license_shared_source(load_config, monkeypatch, tmp_path):
+    with open("tests/assets/license_virtualenv.txt") as fh:
+        copyright_text = fh.read()
+
+    requested_urls = []
+
+    def mock_get(url):
+        requested_urls.append(url)
+        return MockResponse(200, copyright_text)
+
+    monkeypatch.setattr(apt_source.requests, "get", mock_get)
+    monkeypatch.setattr(load_config.app.apt, "cache_path", tmp_path)
+
+    vrs = MockVersion("boost", "1.71.0", "pool/main/b/boost/boost_1.71.0_amd64.deb")
+    apt_cache = {
+        "libboost-dev": MockPackage([vrs]),
+        "libboost-python-dev": MockPackage([vrs]),
+    }
+
+    packages = [get_package_license(apt_cache, p, True) for p in apt_cache]
+
+    assert len(requested_urls) == 1
+    assert [p.name for p in packages] == ["libboost-dev", "libboost-python-dev"]
+    for p in packages:
+        assert p.version == "1.71.0"
+        assert p.licenses == [License("Expat")]
+        assert p.uri == requested_urls[0]
+
+    files = [list(p.transitive_licenses.values())[0] for p in packages]
+    assert files[0] is files[1]
+
+
+def test_source_copyright_cached(load_config, monkeypatch, tmp_path):
+    monkeypatch.setattr(load_config.app.apt, "cache_path", tmp_path)
+    vrs = MockVersion("boost", "1.71.0", "pool/main/b/boost/boost_1.71.0_amd64.deb")
+
+    assert not source_copyright_cached(vrs)
+    assert list(tmp_path.iterdir()) == []
+
+    copyright_store().put_text("record/boost_1.71.0", CopyrightRecord("MIT").to_json())
+    assert source_copyright_cached(vrs)
+
+
+def test_get_package_license_shared_package(load_config, monkeypatch, tmp_path):
+    with open("tests/assets/license_virtualenv.txt") as fh:
+        copyright_text = fh.read()
+
+    monkeypatch.setattr(
+        apt_source.requests, "get", lambda url: MockResponse(200, copyright_text)
+    )
+    monkeypatch.setattr(load_config.app.apt, "cache_path", tmp_path)
+
+    generated = []
+    generate_output_package = apt_source.generate_output_package
+
+    def mock_generate_output_package(*args):
+        generated.append(args[0])
+        return generate_output_package(*args)
+
+    monkeypatch.setattr(
+        apt_source, "generate_output_package", mock_generate_output_package
+    )
+
+    vrs = MockVersion("git", "2.25.1", "pool/main/g/git/git_2.25.1_amd64.deb")
+    apt_cache = {"git": MockPackage([vrs])}
+
+    # e.g. installed directly by one Dockerfile, and as a dependency by another
+    direct = get_package_license(apt_cache, "git", True)
+    transitive = get_package_license(apt_cache, "git", True, is_direct=False)
+    assert get_package_license(apt_cache, "git", True) is direct
+
+    assert generated == ["git"]
+    assert direct.is_direct and not transitive.is_direct
+    assert transitive.licenses is direct.licenses
+
+
 def test_parse_copyright_text():
     with open("tests/assets/license_virtualenv.txt") as fh:
-        licenses, filenames = parse_copyright_text(fh.read())
+        record = parse_copyright(fh)
+
+    assert record.direct_license == "Expat"
+    assert record.licensed_files == {"Expat": ["debian/*"]}
 
-        assert len(licenses) == 3
-        assert len(filenames) == 2
 
-        assert licenses[0] == "Expat"
-        assert filenames[0] == "*"
+def test_parse_copyright_text_stanzas():
+    copyright_text = (
+        "Format: https://www.debian.org/doc/packaging-manuals/copyright-format/1.0/\n"
+        "Upstream-Name: mock\n"
+        "\n"
+        "License: GPL-2+\n"
+        " This program is free software; you can redistribute it\n"
+        "\n"
+        "Files: src/vendor/*\n"
+        "  third_party/*.c\n"
+        "Copyright: 2020 Someone Else\n"
+        "License: BSD-3-clause\n"
+        "\n"
+        "Files: *\n"
+        "Copyright: 2020 Someone\n"
+        "License: Expat\n"
+        " Permission is hereby granted, free of charge, to any person obtaining\n"
+        "\n"
+        "Files: debian/*\n"
+        "License: GPL-2+\n"
+    )
+    record = parse_copyright_text(copyright_text)
 
-        assert licenses[1] == "Expat"
-        assert filenames[1] == "debian/*"
+    assert record.direct_license == "Expat"
+    assert record.licensed_files == {
+        "BSD-3-clause": ["src/vendor/* third_party/*.c"],
+        "GPL-2+": ["debian/*"],
+    }
+    assert CopyrightRecord.from_json(record.to_json()) == record
 
 
 @pytest.mark.parametrize(
-    "pkg_args",
+    "copyright_text, expected_license",
     [
-        [
-            "vim",
-            "2:8.1.2269-1ubuntu5.11",
-            "https://changelogs.ubuntu.com/changelogs/binary/v/vim/2:8.1.2269-1ubuntu5.11/copyright",
-            ["Expat", "Expat", "Apache 2.0"],
-            ["*", "debian/*", "fake_file/*"],
-        ],
-        [
-            "vim",
-            "2:8.1.2269-1ubuntu5.11",
-            "https://changelogs.ubuntu.com/changelogs/binary/v/vim/2:8.1.2269-1ubuntu5.11/copyright",
-            ["Expat", "Expat", "Apache 2.0"],
-            ["*", "debian/*", "fake_file/*"],
-        ],
+        ["Files: src/*\nLicense: MIT\n\nLicense: MIT\n text\n", "MIT"],
+        ["License: Apache-2.0\n text\n", "Apache-2.0"],
+        ["This package is in the public domain.\n", None],
     ],
 )
-def test_generate_output_package(pkg_args):
-    pkg_args = [
-        "vim",
-        "2:8.1.2269-1ubuntu5.11",
-        "https://changelogs.ubuntu.com/changelogs/binary/v/vim/2:8.1.2269-1ubuntu5.11/copyright",
-        [],
-        [],
-    ]
-    pkg = generate_output_package(*pkg_args)
+def test_parse_copyright_text_fallback(copyright_text, expected_license):
+    assert parse_copyright_text(copyright_text).direct_license == expected_license
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        CopyrightRecord(
+            "Expat", {"Expat": ["debian/*"], "Apache 2.0": ["fake_file/*"]}
+        ),
+        CopyrightRecord(None),
+    ],
+)
+def test_generate_output_package(load_config, record):
+    uri = "https://changelogs.ubuntu.com/changelogs/binary/v/vim/2:8.1.2269-1ubuntu5.11/copyright"
+    pkg = generate_output_package("vim", "2:8.1.2269-1ubuntu5.11", uri, record)
 
-    if len(pkg_args[3]) == 0:
+    if record.direct_license is None:
         assert pkg is None
         return
 
     assert len(pkg.licenses) == 1
-    assert pkg.licenses[0] == License(pkg_args[3][0])
+    assert pkg.licenses[0] == License(record.direct_license)
+
+    assert len(pkg.transitive_licenses) == len(record.licensed_files)
+    for lname, files in record.licensed_files.items():
+        assert pkg.transitive_licenses[License(lname)] == files
+
+    assert pkg.uri == uri
+
+
+def test_fetch_source_copyright_record_cache(load_config, monkeypatch, tmp_path):
+    monkeypatch.setattr(load_config.app.apt, "cache_path", tmp_path)
+    vrs = MockVersion("vim", "2:8.1.2269-1ubuntu5.11", "pool/main/v/vim/vim.deb")
+
+    with open("tests/assets/license_virtualenv.txt") as fh:
+        copyright_text = fh.read()
+    monkeypatch.setattr(
+        apt_source.requests, "get", lambda url: MockResponse(200, copyright_text)
+    )
+    _, record = fetch_source_copyright(vrs)
+    store = copyright_store()
+    assert store.get_text("copyright/vim_2:8.1.2269-1ubuntu5.11") == copyright_text
+    assert "record/vim_2:8.1.2269-1ubuntu5.11" in store
+
+    def fail_get(url):
+        raise AssertionError("Cached records should not be re-downloaded")
+
+    monkeypatch.setattr(apt_source.requests, "get", fail_get)
+    monkeypatch.setattr(apt_source, "parse_copyright", fail_get)
+    _, cached_record = fetch_source_copyright(vrs)
+    assert cached_record == record
+
+
+@dataclass
+class MockBaseDependency:
+    name: str
 
-    assert len(pkg.transitive_licenses) == len(pkg_args[4]) - 1
-    for i, lname in enumerate(pkg_args[3][1:]):
-        assert pkg.transitive_licenses[License(lname)] == [pkg_args[4][i + 1]]
 
-    assert pkg.uri == pkg_args[2]
+@dataclass
+class MockDependency:
+    or_dependencies: List[MockBaseDependency]
 
-    pkg = generate_output_package(*pkg_args)
+
+@dataclass
+class MockDependencyVersion:
+    dependencies: List[MockDependency]
+
+
+@dataclass
+class MockDependencyPackage:
+    name: str
+    candidate: MockDependencyVersion
+
+
+class MockDependencyCache(dict):
+    """
+    `git` -> `libc6`, `perl`, `liberror-perl`
+    `perl` -> `libc6`, `perl-base`
+    `liberror-perl` -> `perl`
+    `libc6` <-> `libgcc-s1` (cyclic)
+    `default-jre | java-runtime` -> `openjdk` (virtual)
+    """
+
+    def __init__(self):
+        graph = {
+            "git": [["libc6"], ["perl"], ["liberror-perl"]],
+            "perl": [["libc6"], ["perl-base"]],
+            "perl-base": [],
+            "liberror-perl": [["perl"]],
+            "libc6": [["libgcc-s1"]],
+            "libgcc-s1": [["libc6"]],
+            "ant": [["default-jre", "java-runtime"]],
+            "openjdk": [["libc6"]],
+        }
+        super().__init__(
+            {
+                name: MockDependencyPackage(
+                    name,
+                    MockDependencyVersion(
+                        [
+                            MockDependency([MockBaseDependency(d) for d in deps])
+                            for deps in depends
+                        ]
+                    ),
+                )
+                for name, depends in graph.items()
+            }
+        )
+        self.lookups = []
+
+    def __getitem__(self, name):
+        self.lookups.append(name)
+        return super().__getitem__(name)
+
+    def is_virtual_package(self, name):
+        return name == "java-runtime"
+
+    def get_providing_packages(self, name):
+        return [self["openjdk"]]
+
+
+@pytest.fixture
+def dependency_cache():
+    return MockDependencyCache()
+
+
+def test_dependency_closure(dependency_cache):
+    assert dependency_closure(dependency_cache, "git") == {
+        "libc6",
+        "libgcc-s1",
+        "perl",
+        "perl-base",
+        "liberror-perl",
+    }
+    assert dependency_closure(dependency_cache, "libc6") == {"libgcc-s1"}
+    assert dependency_closure(dependency_cache, "ant") == {
+        "openjdk",
+        "libc6",
+        "libgcc-s1",
+    }
+
+    # Every package is only expanded once, no matter how many times it's depended on.
+    expanded = [l for l in dependency_cache.lookups if l != "openjdk"]
+    assert len(expanded) == len(set(expanded))
+
+
+def test_get_package_licenses_follow_depends(
+    load_config, monkeypatch, dependency_cache
+):
+    monkeypatch.setattr(
+        apt_source,
+        "get_package_license",
+        lambda _, name, no_cache, is_direct=True: AptPackage(
+            name, "1.0", "MIT", {}, None, is_direct
+        ),
+    )
+
+    packages = get_package_licenses(dependency_cache, ["git", "perl"], False, False)
+    assert [(p.name, p.is_direct) for p in packages] == [("git", True), ("perl", True)]
+
+    packages = get_package_licenses(dependency_cache, ["git", "perl"], False, True)
+    assert [(p.name, p.is_direct) for p in packages] == [
+        ("git", True),
+        ("perl", True),
+        ("libc6", False),
+        ("liberror-perl", False),
+        ("libgcc-s1", False),
+        ("perl-base", False),
+    ]
@@ -0,0 +1,153 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import gzip
+import lzma
+import shutil
+import pytest
+from pathlib import Path
+
+from gc_licensing.sources.apt import changelog_uris, dependency_closure
+from gc_licensing.sources import apt as apt_source
+from gc_licensing.sources.apt_index import (
+    AptIndex,
+    _split_version,
+    compare_versions,
+    load_apt_index,
+    parse_depends,
+)
+
+
+ASSETS_PATH = Path(__file__).parent.parent / "assets" / "apt"
+
+
+@pytest.mark.parametrize(
+    "a, b, expected",
+    [
+        ["1.0", "1.0", 0],
+        ["1.0", "1.1", -1],
+        ["1.10", "1.9", 1],
+        ["1.0~rc1", "1.0", -1],
+        ["1.0", "1.0+dfsg", -1],
+        ["1:1.0", "2.0", 1],
+        ["2.25.1-1ubuntu3.10", "2.25.1-1ubuntu3", 1],
+        ["2.25.1-1ubuntu3.10", "2.25.1-1ubuntu3.9", 1],
+        ["1.0-1", "1.0-1~bpo1", 1],
+        ["0.01", "0.1", 0],
+        ["1:2.0:3-1", "1:2.0:2-1", 1],
+        ["1:2.0:3-1", "2.0:3-1", 1],
+        ["x:1.0", "1.0", -1],
+        ["x:1.0", "y:1.0", 0],
+    ],
+)
+def test_compare_versions(a: str, b: str, expected: int):
+    result = compare_versions(a, b)
+    assert (result > 0) - (result < 0) == expected
+    result = compare_versions(b, a)
+    assert (result > 0) - (result < 0) == -expected
+
+
+def test_split_version():
+    assert _split_version("1:2.0:3-1") == (1, "2.0:3", "1")
+    assert _split_version("2.0-1-2") == (0, "2.0-1", "2")
+    assert _split_version("x:1.0") is None
+    assert _split_version(":1.0") is None
+
+
+def test_parse_depends():
+    depends = parse_depends(
+        "libc6 (>= 2.29), libgcc-s1 | libgcc1, python3:any, foo [amd64] <!nocheck>"
+    )
+    assert [[d.name for d in dep.or_dependencies] for dep in depends] == [
+        ["libc6"],
+        ["libgcc-s1", "libgcc1"],
+        ["python3"],
+        ["foo"],
+    ]
+    assert parse_depends("") == []
+
+
+@pytest.mark.parametrize("compression", [None, "gz", "xz"])
+def test_load_packages_index(tmp_path, compression):
+    index_path = ASSETS_PATH / "Packages"
+    if compression is not None:
+        compressed_path = tmp_path / f"Packages.{compression}"
+        opener = gzip.open if compression == "gz" else lzma.open
+        with open(index_path, "rb") as src, opener(compressed_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        index_path = compressed_path
+
+    index = load_apt_index([index_path])
+
+    assert len(index) == 3
+    assert "git" in index
+    assert "vim" not in index
+
+    git = index["git"]
+    assert [v.version for v in git.versions] == [
+        "1:2.25.1-1ubuntu3.10",
+        "1:2.25.1-1ubuntu3",
+    ]
+    assert git.candidate.source_name == "git"
+    assert [d.or_dependencies[0].name for d in git.candidate.dependencies] == [
+        "libpcre2-8-0",
+        "libc6",
+        "libcurl3-gnutls",
+        "liberror-perl",
+        "zlib1g",
+        "perl",
+        "git-man",
+        "git-man",
+    ]
+
+    boost = index["libboost-python1.71.0"]
+    assert boost.candidate.source_name == "boost1.71"
+    assert changelog_uris(boost.candidate) == [
+        "https://changelogs.ubuntu.com/changelogs/binary/b/boost1.71/1.71.0-6ubuntu6/copyright",
+        "https://changelogs.ubuntu.com/changelogs/pool/universe/b/boost1.71/boost1.71_1.71.0-6ubuntu6/copyright",
+    ]
+
+    assert index.is_virtual_package("java-runtime-headless")
+    assert not index.is_virtual_package("default-jre-headless")
+    assert [p.name for p in index.get_providing_packages("java-runtime-headless")] == [
+        "default-jre-headless"
+    ]
+
+
+def test_load_dpkg_status():
+    index = load_apt_index([ASSETS_PATH / "status"])
+
+    # Packages which have been removed are skipped
+    assert "screen" not in index
+
+    assert changelog_uris(index["vim"].candidate) == [
+        "https://changelogs.ubuntu.com/changelogs/binary/v/vim/2:8.1.2269-1ubuntu5.11/copyright",
+        "https://changelogs.ubuntu.com/changelogs/pool/main/v/vim/vim_2:8.1.2269-1ubuntu5.11/copyright",
+    ]
+    assert changelog_uris(index["htop"].candidate)[1] == (
+        "https://changelogs.ubuntu.com/changelogs/pool/universe/h/htop/htop_2.2.0-2build1/copyright"
+    )
+
+
+def test_index_dependency_closure():
+    index = AptIndex()
+    index.add_paragraph(
+        {"package": "ant", "version": "1.0", "depends": "java-runtime-headless"}
+    )
+    for path in [ASSETS_PATH / "Packages", ASSETS_PATH / "status"]:
+        index.load(path)
+
+    # openjdk-11-jre-headless isn't in any of the indexes, so can't be followed.
+    assert dependency_closure(index, "ant") == {"default-jre-headless"}
+
+
+def test_open_apt_cache_index_files(load_config, monkeypatch):
+    monkeypatch.setitem(load_config.app.apt, "backend", "index")
+    monkeypatch.setitem(
+        load_config.app.apt,
+        "index_files",
+        [ASSETS_PATH / "Packages", ASSETS_PATH / "status"],
+    )
+
+    index = apt_source.open_apt_cache()
+    assert "git" in index
+    assert "vim" in index
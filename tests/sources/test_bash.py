@@ -1,10 +1,13 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+from gc_licensing.package import PipPackage
+from gc_licensing.sources import bash
 from gc_licensing.sources.bash import (
-    MultilineStringCommandParser,
-    filter_input,
-    filter_output,
+    bash_from_repo,
+    commands_from_script,
+    invoked_scripts,
 )
+from gc_licensing.sources.shell import parse_script
 
 import pytest
 
@@ -15,86 +18,168 @@ import pytest
         [
             "tests/assets/tiny_bash_dbl_quote.sh",
             [
-                ['echo "hello, world!"'],
-                ['echo "Done'],
-                ["multiline"],
-                ['string"'],
-                ['echo "goodbye"'],
+                ["echo", "hello, world!"],
+                ["echo", "Done\nmultiline\nstring"],
+                ["echo", "goodbye"],
             ],
         ],
         [
             "tests/assets/tiny_bash_multiline_command.sh",
             [
-                ['echo "hello, world!"'],
-                ["do_thing", '"the first argument"', '"another argument"'],
-                ['echo "goodbye"'],
+                ["echo", "hello, world!"],
+                ["do_thing", "the first argument", "another argument"],
+                ["echo", "goodbye"],
+            ],
+        ],
+        [
+            "tests/assets/tiny_bash_eof.sh",
+            [
+                ["echo", "hello, world!"],
+                ["cat"],
+                ["echo", "goodbye"],
+            ],
+        ],
+        [
+            "tests/assets/tiny_bash_dbl_quote_escape.sh",
+            [
+                ["echo", "hello, world!"],
+                ["echo", "Done\nmultiline\nstring"],
+                ["echo", 'string with " escaped quote'],
+                ["echo", "goodbye"],
             ],
         ],
     ],
 )
-def test_filter_input(bashfile, expected):
+def test_parse_script(bashfile, expected):
     with open(bashfile) as fh:
-        content = fh.readlines()
+        commands = parse_script(fh.read())
+
+    assert [c.argv for c in commands] == expected
+
 
-    commands = filter_input(content)
+def test_parse_script_heredoc():
+    with open("tests/assets/tiny_bash_eof.sh") as fh:
+        commands = parse_script(fh.read())
 
-    assert len(commands) == len(expected)
-    for c, e in zip(commands, expected):
-        assert c == e
+    assert commands[1].heredocs == ['Your "Name" is ${yourname}\n']
 
 
 @pytest.mark.parametrize(
-    "bashfile, expected",
+    "script, expected",
     [
+        ["FOO=1 BAR='a b' pip install x", [["pip", "install", "x"]]],
         [
-            "tests/assets/tiny_bash_dbl_quote.sh",
+            "apt-get update&&apt-get install -y vim || true; make | tee log",
             [
-                'echo "hello, world!"',
-                'echo "Done multiline string"',
-                'echo "goodbye"',
+                ["apt-get", "update"],
+                ["apt-get", "install", "-y", "vim"],
+                ["true"],
+                ["make"],
+                ["tee", "log"],
             ],
         ],
+        ["pip install x 2>&1 > /dev/null  # pip install y", [["pip", "install", "x"]]],
+        ["pip install a#b", [["pip", "install", "a#b"]]],
         [
-            "tests/assets/tiny_bash_eof.sh",
-            [
-                'echo "hello, world!"',
-                'cat << EOF >> /path/to/file Your "Name" is ${yourname} EOF',
-                'echo "goodbye"',
-            ],
+            'pip install "$(cat reqs | tr "\\n" " ")"',
+            [["pip", "install", '$(cat reqs | tr "\\n" " ")']],
         ],
+        ["if true; then pip install x; fi", [["true"], ["pip", "install", "x"]]],
+        ["for p in a b; do pip install $p; done", [["pip", "install", "$p"]]],
         [
-            "tests/assets/tiny_bash_dbl_quote_escape.sh",
-            [
-                'echo "hello, world!"',
-                'echo "Done multiline string"',
-                'echo "string with \\" escaped quote"',
-                'echo "goodbye"',
-            ],
+            "bash -c 'apt-get update && apt-get install -y git'",
+            [["apt-get", "update"], ["apt-get", "install", "-y", "git"]],
+        ],
+        [
+            "sh <<-EOF\n\tpip install x\n\tEOF\npip install y",
+            [["pip", "install", "x"], ["pip", "install", "y"]],
+        ],
+        [
+            "python3 <<'EOF'\nimport os\nEOF\n",
+            [["python3"]],
         ],
     ],
 )
-def test_multiline_parser(bashfile, expected):
-    with open(bashfile) as fh:
-        content = fh.readlines()
+def test_parse_script_snippets(script, expected):
+    assert [c.argv for c in parse_script(script)] == expected
 
-    commands = filter_input(content)
 
-    q = MultilineStringCommandParser()
-    output = q.process([" ".join(c) for c in commands])
-    assert output == expected
+def test_commands_from_script():
+    with open("tests/assets/example.sh") as fh:
+        commands = commands_from_script(fh.read())
+
+    assert [str(c) for c in commands] == [
+        "touch ${1}.txt",
+        "do_thing the first argument another argument",
+        "pip install numpy pandas==1.5.3",
+        "pip install -q -r requirements.txt",
+        "sudo apt-get update",
+        "apt-get install vim",
+        "cat",
+        "cat",
+        "apt install emacs",
+    ]
 
 
-def test_filter_output():
-    commands = [
-        "echo hello world",
-        "pip install some_stuff",
-        "echo pip install other_stuff",
-        "apt-get update && apt-get install -y vim cmake",
+def test_invoked_scripts(tmp_path):
+    for name in ["a.sh", "b.sh", "c.sh", "d.sh", "e.bash", "f.py", "sub/g.sh"]:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text("")
+
+    commands = parse_script(
+        "\n".join(
+            [
+                "source a.sh",
+                ". ./b.sh && bash -o pipefail c.sh arg",
+                "sudo sh -e d.sh",
+                "./e.bash",
+                "./f.py",
+                "bash -c 'echo x.sh'",
+                "source $DIR/a.sh",
+                "source /etc/profile",
+                "bash missing.sh",
+                "cd sub && ./sub/g.sh",
+                "source a.sh",
+            ]
+        )
+    )
+    assert invoked_scripts(tmp_path / "main.sh", commands) == [
+        (tmp_path / name).resolve()
+        for name in ["a.sh", "b.sh", "c.sh", "d.sh", "e.bash", "sub/g.sh"]
     ]
 
-    output = filter_output(commands)
 
-    assert len(output) == 3
-    assert output[0] == commands[1]
-    assert output[1] == "apt-get update"
-    assert output[2] == "apt-get install -y vim cmake"
+def test_bash_from_repo_follows_scripts(load_config, tmp_path, monkeypatch):
+    (tmp_path / "scripts").mkdir()
+    (tmp_path / "main.sh").write_text(
+        "source ./scripts/env.sh\npip install main-package\nbash scripts/deps.sh\n"
+    )
+    (tmp_path / "other.sh").write_text(". scripts/env.sh\npip install other-package\n")
+    (tmp_path / "scripts" / "env.sh").write_text("pip install env-package\n")
+    (tmp_path / "scripts" / "deps.sh").write_text(
+        "pip install deps-package\nsource ../main.sh\n"
+    )
+
+    calls = []
+
+    def mock_run_list_of_commands(path, commands, *args, **kwargs):
+        calls.append(path.name)
+        pip_direct = [
+            PipPackage(c.argv[-1], "1.0", "MIT", None, True)
+            for c in commands
+            if c.argv[0] == "pip"
+        ]
+        return ((pip_direct, []), []), []
+
+    monkeypatch.setattr(bash, "run_list_of_commands", mock_run_list_of_commands)
+
+    def names(script: str):
+        (pip_direct, _), _ = bash_from_repo(tmp_path / script, False, False)[0]
+        return sorted(p.name for p in pip_direct)
+
+    # deps.sh sources main.sh back, which is skipped rather than followed forever
+    assert names("main.sh") == ["deps-package", "env-package", "main-package"]
+    assert names("other.sh") == ["env-package", "other-package"]
+
+    # The shared env.sh is only resolved once
+    assert calls == ["main.sh", "env.sh", "deps.sh", "other.sh"]
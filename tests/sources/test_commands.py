@@ -0,0 +1,108 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import pytest
+
+from gc_licensing.sources.commands import (
+    APT_OPTIONS,
+    PIP_OPTIONS,
+    copy_source,
+    extract_installs,
+    parse_command,
+    parse_copy,
+    parse_options,
+)
+from gc_licensing.sources.shell import SimpleCommand
+
+
+@pytest.mark.parametrize(
+    "args, expected_options, expected_operands",
+    [
+        [["-qr", "reqs.txt", "numpy"], [("-q", None), ("-r", "reqs.txt")], ["numpy"]],
+        [["-rreqs.txt"], [("-r", "reqs.txt")], []],
+        [["--requirement=reqs.txt"], [("-r", "reqs.txt")], []],
+        [
+            ["--requirement", "reqs.txt", "-U", "x"],
+            [("-r", "reqs.txt"), ("-U", None)],
+            ["x"],
+        ],
+        [["--no-cache-dir", "x"], [("--no-cache-dir", None)], ["x"]],
+        [["--index-url", "https://a", "x"], [("--index-url", "https://a")], ["x"]],
+        [["--", "-x"], [], ["-x"]],
+    ],
+)
+def test_parse_options(args, expected_options, expected_operands):
+    assert parse_options(args, PIP_OPTIONS) == (expected_options, expected_operands)
+
+
+@pytest.mark.parametrize(
+    "argv, expected",
+    [
+        [["pip", "install", "x"], ("pip", "install", ["x"])],
+        [["pip3.8", "-q", "install", "x"], ("pip", "install", ["x"])],
+        [["/opt/venv/bin/pip", "install", "x"], ("pip", "install", ["x"])],
+        [["python3", "-u", "-m", "pip", "install", "x"], ("pip", "install", ["x"])],
+        [["{sys.executable}", "-m", "pip", "install", "x"], ("pip", "install", ["x"])],
+        [["uv", "pip", "install", "x"], ("pip", "install", ["x"])],
+        [
+            ["sudo", "-E", "-u", "root", "apt-get", "install", "vim"],
+            ("apt", "install", ["vim"]),
+        ],
+        [
+            ["env", "DEBIAN_FRONTEND=noninteractive", "apt", "install", "vim"],
+            ("apt", "install", ["vim"]),
+        ],
+        [
+            ["apt-get", "-o", "Acquire::Retries=3", "install", "vim"],
+            ("apt", "install", ["vim"]),
+        ],
+        [["python", "-m", "venv", "install"], None],
+        [["python", "script.py", "-m", "pip"], None],
+        [["echo", "pip", "install", "x"], None],
+    ],
+)
+def test_parse_command(argv, expected):
+    parsed = parse_command(argv)
+    if expected is None:
+        assert parsed is None
+    else:
+        assert (parsed.program, parsed.subcommand, parsed.operands) == expected
+
+
+def test_extract_installs():
+    installs = extract_installs(
+        [
+            "apt-get update && apt-get install -y --no-install-recommends git cmake",
+            "pip install -qr requirements.txt -c constraints.txt numpy",
+            SimpleCommand(["pip", "install", "pandas>=1.0, <2"]),
+            "pip download scipy",
+            "make install",
+        ]
+    )
+
+    assert installs.pip_packages == ["numpy", "pandas>=1.0, <2"]
+    assert installs.apt_packages == ["git", "cmake"]
+    assert installs.requirement_files == ["requirements.txt"]
+
+
+def test_extract_installs_long_command():
+    packages = [f"package-{i}" for i in range(20000)]
+    installs = extract_installs(["pip install " + " ".join(packages) + " -r"])
+
+    assert installs.pip_packages == packages
+    assert installs.requirement_files == []
+
+
+@pytest.mark.parametrize(
+    "path, copy_commands, expected",
+    [
+        ["new.txt", ["./reqs/requirements.txt new.txt"], "./reqs/requirements.txt"],
+        ["/app/requirements.txt", ["requirements.txt /app/"], "requirements.txt"],
+        ["/app/requirements.txt", ["a.txt requirements.txt /app/"], "requirements.txt"],
+        ["/app/sub/requirements.txt", [". /app"], "sub/requirements.txt"],
+        ["requirements.txt", ['["src/requirements.txt", "."]'], "src/requirements.txt"],
+        ["requirements.txt", ["a.txt b.txt /app/"], None],
+        ["/other/requirements.txt", [". /app"], None],
+    ],
+)
+def test_copy_source(path, copy_commands, expected):
+    assert copy_source(path, [parse_copy(c) for c in copy_commands]) == expected
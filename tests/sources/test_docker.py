@@ -1,6 +1,15 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
-from gc_licensing.sources.docker import extract_commands
+import io
+
+from gc_licensing.package import AptPackage, PipPackage
+from gc_licensing.sources import docker
+from gc_licensing.sources.docker import (
+    dockerfiles_from_repo,
+    extract_commands,
+    iter_instructions,
+)
+from gc_licensing.sources.utils import merge_combined_packages
 
 
 def test_extract_commands():
@@ -38,3 +47,165 @@ def test_extract_commands():
     assert len(copy_cmds) == len(expected_copy_cmds)
     for c, e in zip(copy_cmds, expected_copy_cmds):
         assert c == e
+
+
+def test_iter_instructions():
+    df = "\n".join(
+        [
+            "# escape=`",
+            "FROM ubuntu:20.04 AS base",
+            "# A comment",
+            "RUN --mount=type=cache,target=/var/cache/apt apt-get update && `",
+            "    # A comment inside a continuation",
+            "",
+            "    apt-get install -y `",
+            "        htop git",
+            'RUN ["pip", "install", "numpy"]',
+            'RUN ["/bin/sh", "-c", "pip install pandas && pip install scipy"]',
+            "COPY --from=base --chown=1000:1000 requirements.txt /app/",
+            "RUN <<EOF",
+            "apt-get install -y zip",
+            "pip install -r /app/requirements.txt",
+            "EOF",
+            "RUN python3 <<-'PY'",
+            "\timport os",
+            "\tPY",
+            "COPY <<EOF /etc/config",
+            "pip install nothing",
+            "EOF",
+            "RUN pip install `",
+        ]
+    )
+
+    instructions = list(iter_instructions(io.StringIO(df)))
+    assert [(i.instruction, i.line) for i in instructions] == [
+        ("FROM", 2),
+        ("RUN", 4),
+        ("RUN", 9),
+        ("RUN", 10),
+        ("COPY", 11),
+        ("RUN", 12),
+        ("RUN", 16),
+        ("COPY", 19),
+        ("RUN", 22),
+    ]
+    assert instructions[1].flags == {"mount": "type=cache,target=/var/cache/apt"}
+    assert instructions[1].value == "apt-get update && apt-get install -y htop git"
+    assert instructions[4].flags == {"from": "base", "chown": "1000:1000"}
+    assert instructions[6].heredocs == ["import os"]
+
+    cmds, copy_cmds = extract_commands(df)
+    assert cmds == [
+        "apt-get update",
+        "apt-get install -y htop git",
+        "pip install numpy",
+        "pip install pandas",
+        "pip install scipy",
+        "apt-get install -y zip",
+        "pip install -r /app/requirements.txt",
+        "python3",
+        "pip install",
+    ]
+    assert copy_cmds == ["requirements.txt /app/"]
+
+
+def test_iter_instructions_here_string():
+    df = "\n".join(
+        [
+            "FROM ubuntu:20.04",
+            "RUN cat <<<EOF",
+            "RUN apt-get install -y curl",
+            "COPY requirements.txt /app/",
+        ]
+    )
+
+    instructions = list(iter_instructions(io.StringIO(df)))
+    assert [(i.instruction, i.value) for i in instructions] == [
+        ("FROM", "ubuntu:20.04"),
+        ("RUN", "cat <<<EOF"),
+        ("RUN", "apt-get install -y curl"),
+        ("COPY", "requirements.txt /app/"),
+    ]
+    assert instructions[1].heredocs == []
+
+
+def test_dockerfiles_from_repo(load_config, tmp_path, monkeypatch):
+    (tmp_path / "base").mkdir()
+    (tmp_path / "base" / "Dockerfile").write_text(
+        "FROM ubuntu:20.04\nRUN pip install base-package\n"
+    )
+    (tmp_path / "Dockerfile").write_text(
+        "\n".join(
+            [
+                "ARG BASE=myorg/base:latest",
+                "FROM ${BASE} AS builder",
+                "RUN pip install builder-package",
+                "FROM builder AS tests",
+                "RUN pip install test-package",
+                "FROM python:3.8",
+                "COPY --from=builder /opt/venv /opt/venv",
+                "RUN pip install app-package",
+            ]
+        )
+    )
+    (tmp_path / "Dockerfile.other").write_text(
+        "FROM myorg/base\nRUN pip install other-package\n"
+    )
+
+    calls = []
+
+    def mock_run_list_of_commands(path, commands, *args):
+        calls.append(commands)
+        pip_direct = [
+            PipPackage(c.split()[-1], "1.0", "MIT", None, True) for c in commands
+        ]
+        return ((pip_direct, []), []), []
+
+    monkeypatch.setattr(docker, "run_list_of_commands", mock_run_list_of_commands)
+
+    dockerfiles = [tmp_path / "Dockerfile", tmp_path / "Dockerfile.other"]
+    output = dockerfiles_from_repo(
+        dockerfiles,
+        no_cache=False,
+        find_requirements=False,
+        image_map={"myorg/base": tmp_path / "base" / "Dockerfile"},
+    )
+
+    def names(result):
+        ((pip_direct, _), _), _ = result
+        return sorted(p.name for p in pip_direct)
+
+    assert names(output[dockerfiles[0]]) == [
+        "app-package",
+        "base-package",
+        "builder-package",
+        "test-package",
+    ]
+    assert names(output[dockerfiles[1]]) == ["base-package", "other-package"]
+
+    # Each stage is only resolved once
+    assert sorted(c[0] for c in calls) == [
+        "pip install app-package",
+        "pip install base-package",
+        "pip install builder-package",
+        "pip install other-package",
+        "pip install test-package",
+    ]
+
+
+def test_merge_combined_packages(load_config):
+    def pip(name: str, version: str = "1.0"):
+        return PipPackage(name, version, "MIT", None, True)
+
+    def apt(name: str, is_direct: bool):
+        return AptPackage(name, "1.0", "MIT", {}, "", is_direct)
+
+    (direct, transitive), apt_packages = merge_combined_packages(
+        [
+            (([pip("a")], [pip("b"), pip("c")]), [apt("x", False)]),
+            (([pip("b"), pip("a")], [pip("c", "2.0")]), [apt("x", True)]),
+        ]
+    )
+    assert [p.name for p in direct] == ["a", "b"]
+    assert [(p.name, p.version) for p in transitive] == [("c", "1.0"), ("c", "2.0")]
+    assert [(p.name, p.is_direct) for p in apt_packages] == [("x", True)]
@@ -0,0 +1,232 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+import pytest
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from gc_licensing.sources import image as image_source
+from gc_licensing.sources.image import (
+    LayerContents,
+    image_from_archive,
+    merge_layers,
+    read_layer,
+)
+
+
+SITE_PACKAGES = "usr/lib/python3/dist-packages"
+
+DPKG_STATUS = """Package: htop
+Status: install ok installed
+Section: utils
+Architecture: amd64
+Source: htop
+Version: 2.2.0-2build1
+Description: interactive processes viewer
+
+Package: libhtop-data
+Status: install ok installed
+Architecture: all
+Source: htop
+Version: 2.2.0-2build1
+
+Package: screen
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 4.8.0-1
+"""
+
+HTOP_COPYRIGHT = """Format: https://www.debian.org/doc/packaging-manuals/copyright-format/1.0/
+Upstream-Name: htop
+
+Files: *
+Copyright: 2004-2011 Hisham H. Muhammad
+License: GPL-2+
+
+Files: debian/*
+Copyright: 2020 Someone
+License: Expat
+"""
+
+
+def metadata(name: str, version: str, license: Optional[str], classifiers=()):
+    lines = [f"Metadata-Version: 2.1", f"Name: {name}", f"Version: {version}"]
+    if license:
+        lines.append(f"License: {license}")
+    lines += [f"Classifier: {c}" for c in classifiers]
+    return "\n".join(lines) + "\n\nLong description\n"
+
+
+def layer_tar(
+    files: Dict[str, str], links: Dict[str, str] = {}, compress: bool = False
+) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, text in files.items():
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        for name, target in links.items():
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+    data = buffer.getvalue()
+    return gzip.compress(data) if compress else data
+
+
+def layers() -> List[bytes]:
+    return [
+        layer_tar(
+            {
+                "var/lib/dpkg/status": DPKG_STATUS,
+                "usr/share/doc/htop/copyright": HTOP_COPYRIGHT,
+                "usr/share/doc/htop/README": "Not a license",
+                f"{SITE_PACKAGES}/numpy-1.24.2.dist-info/METADATA": metadata(
+                    "numpy",
+                    "1.24.2",
+                    "BSD",
+                    ["License :: OSI Approved :: BSD License"],
+                ),
+                f"{SITE_PACKAGES}/six-1.16.0.dist-info/METADATA": metadata(
+                    "six", "1.16.0", "MIT"
+                ),
+            },
+        ),
+        layer_tar(
+            {
+                f"{SITE_PACKAGES}/.wh.six-1.16.0.dist-info": "",
+                f"{SITE_PACKAGES}/mystery-0.1.dist-info/METADATA": metadata(
+                    "mystery", "0.1", None
+                ),
+                f"{SITE_PACKAGES}/mystery-0.1.dist-info/LICENSE": "Some text",
+            },
+            {"./usr/share/doc/libhtop-data": "htop"},
+            compress=True,
+        ),
+    ]
+
+
+def write_image(
+    path: Path, layer_data: List[bytes], oci: bool = False, compression: str = ""
+) -> Path:
+    def add(tar: tarfile.TarFile, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    digests = ["sha256:" + hashlib.sha256(l).hexdigest() for l in layer_data]
+    with tarfile.open(path, mode=f"w:{compression}") as tar:
+        if oci:
+            manifest = json.dumps({"layers": [{"digest": d} for d in digests]})
+            manifest_digest = "sha256:" + hashlib.sha256(manifest.encode()).hexdigest()
+            index = {"manifests": [{"digest": manifest_digest}]}
+            add(tar, "index.json", json.dumps(index).encode())
+            add(tar, f"blobs/{manifest_digest.replace(':', '/')}", manifest.encode())
+            for d, l in zip(digests, layer_data):
+                add(tar, f"blobs/{d.replace(':', '/')}", l)
+        else:
+            config = {"rootfs": {"diff_ids": digests}}
+            manifest = [
+                {
+                    "Config": "config.json",
+                    "Layers": [f"{i}/layer.tar" for i in range(len(layer_data))],
+                }
+            ]
+            add(tar, "manifest.json", json.dumps(manifest).encode())
+            add(tar, "config.json", json.dumps(config).encode())
+            for i, l in enumerate(layer_data):
+                add(tar, f"{i}/layer.tar", l)
+    return path
+
+
+@pytest.fixture
+def layer_cache(load_config, tmp_path, monkeypatch):
+    monkeypatch.setitem(load_config.app.apt, "cache_path", tmp_path / "cache")
+    monkeypatch.setattr(image_source, "_layer_stores", {})
+
+
+def test_read_layer():
+    contents = read_layer(io.BytesIO(layers()[1]))
+    assert contents.whiteouts == [f"{SITE_PACKAGES}/six-1.16.0.dist-info"]
+    assert contents.links == {"usr/share/doc/libhtop-data": "usr/share/doc/htop"}
+    assert sorted(contents.files) == [
+        f"{SITE_PACKAGES}/mystery-0.1.dist-info/LICENSE",
+        f"{SITE_PACKAGES}/mystery-0.1.dist-info/METADATA",
+    ]
+
+
+def test_merge_layers():
+    merged = merge_layers(
+        [
+            LayerContents(files={"a/b/c": "1", "a/d": "2", "e": "3"}),
+            LayerContents(files={"a/x": "4"}, opaque=["a"]),
+            LayerContents(files={"e": "5"}, whiteouts=["a/x"]),
+        ]
+    )
+    assert merged.files == {"e": "5"}
+
+
+@pytest.mark.parametrize("oci", [False, True])
+def test_image_from_archive(layer_cache, tmp_path: Path, oci: bool):
+    image_path = write_image(tmp_path / "image.tar", layers(), oci)
+
+    (pip_direct, pip_transitive), apt = image_from_archive(image_path)
+
+    assert [(p.name, p.version) for p in pip_direct] == [
+        ("mystery", "0.1"),
+        ("numpy", "1.24.2"),
+    ]
+    assert [l.name for l in pip_direct[1].licenses] == ["BSD License"]
+    assert [l.name for l in pip_direct[0].licenses] == ["UNKNOWN"]
+    assert pip_transitive == []
+
+    assert [(p.name, p.version) for p in apt] == [
+        ("htop", "2.2.0-2build1"),
+        ("libhtop-data", "2.2.0-2build1"),
+    ]
+    for p in apt:
+        assert [l.name for l in p.licenses] == ["GPL-2+"]
+        assert [l.name for l in p.transitive_licenses] == ["Expat"]
+        assert p.uri.endswith("/htop/htop_2.2.0-2build1/copyright")
+
+
+@pytest.mark.parametrize("compression", ["gz", "xz"])
+def test_image_from_compressed_archive(layer_cache, tmp_path: Path, compression: str):
+    image_path = write_image(
+        tmp_path / f"image.tar.{compression}", layers(), compression=compression
+    )
+
+    (pip_direct, _), apt = image_from_archive(image_path, no_cache=True)
+
+    assert [p.name for p in pip_direct] == ["mystery", "numpy"]
+    assert [p.name for p in apt] == ["htop", "libhtop-data"]
+
+
+def test_image_layer_cache(layer_cache, tmp_path: Path, monkeypatch):
+    layer_data = layers()
+    image_from_archive(write_image(tmp_path / "a.tar", layer_data))
+
+    # An image sharing the base layer only reads its new layer
+    read = []
+    real_read_layer = image_source.read_layer
+
+    def mock_read_layer(fileobj):
+        contents = real_read_layer(fileobj)
+        read.append(contents)
+        return contents
+
+    monkeypatch.setattr(image_source, "read_layer", mock_read_layer)
+    new_layer = layer_tar({"var/lib/dpkg/status": ""})
+    (pip_direct, _), apt = image_from_archive(
+        write_image(tmp_path / "b.tar", [layer_data[0], new_layer])
+    )
+
+    assert len(read) == 1
+    assert apt == []
+    assert [p.name for p in pip_direct] == ["numpy", "six"]
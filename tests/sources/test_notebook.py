@@ -1,9 +1,15 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+import io
+import json
 import pytest
 from typing import List
 from pathlib import Path
-from gc_licensing.sources.notebook import get_commands, notebook_from_repo
+from gc_licensing.sources.notebook import (
+    get_commands,
+    iter_code_cells,
+    notebook_from_repo,
+)
 
 
 ASSETS_PATH = Path(__file__).parent.parent / "assets"
@@ -14,18 +20,54 @@ def test_get_commands():
     cmds = get_commands(notebook_path)
 
     expected_commands = [
-        "import json",
-        'data = json.loads(\'{"key": "value"}\')',
-        "%pip install -qr nbk-requirements.txt",
-        "%pip install numpy==1.23.4",
-        "%pip install pandas",
-        "!pip install matplotlib",
-        "!apt-get update",
+        "pip install -qr nbk-requirements.txt",
+        "pip install numpy==1.23.4",
+        "pip install pandas",
+        "pip install matplotlib",
+        "apt-get update",
         "apt-get install -y cmake",
-        'print("Done")',
     ]
 
-    assert cmds == expected_commands
+    assert [str(c) for c in cmds] == expected_commands
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 16])
+def test_iter_code_cells(chunk_size: int):
+    notebook_path = ASSETS_PATH / "notebook" / "mock_notebook.ipynb"
+    with open(notebook_path) as fh:
+        notebook = json.load(fh)
+    expected = [
+        "".join(c["source"]) for c in notebook["cells"] if c["cell_type"] == "code"
+    ]
+
+    with open(notebook_path) as fh:
+        assert list(iter_code_cells(fh, chunk_size)) == expected
+
+
+def test_iter_code_cells_skips_outputs():
+    notebook = {
+        "metadata": {"kernelspec": {"name": "python3"}, "n": [1, 2.5e3, None, True]},
+        "cells": [
+            {
+                "cell_type": "code",
+                "source": '!pip install "numpy\\"s"',
+                "outputs": [
+                    {"data": {"image/png": "iVBOR" + "A" * 100000 + '\\"]}'}},
+                    {"text": ["}]", "[{"], "execution_count": 3},
+                ],
+                "execution_count": None,
+            },
+            {"cell_type": "markdown", "source": ["!apt-get install vim"]},
+            {"source": ["%pip install ", "pandas"], "cell_type": "code"},
+        ],
+        "nbformat": 4,
+    }
+
+    fh = io.StringIO(json.dumps(notebook))
+    assert list(iter_code_cells(fh, 1000)) == [
+        '!pip install "numpy\\"s"',
+        "%pip install pandas",
+    ]
 
 
 @pytest.mark.parametrize(
@@ -0,0 +1,51 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import pytest
+from pathlib import Path
+
+from gc_licensing.sources.parse import ParseStage, parse_source
+
+
+ASSETS_PATH = Path(__file__).parent.parent / "assets"
+
+SOURCES = [
+    ("dockerfile", ASSETS_PATH / "Dockerfile"),
+    ("bash", ASSETS_PATH / "example.sh"),
+    ("bash", ASSETS_PATH / "tiny_bash_eof.sh"),
+    ("notebook", ASSETS_PATH / "notebook" / "mock_notebook.ipynb"),
+]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parse_stage(workers: int):
+    with ParseStage(workers) as parse_stage:
+        for kind, path in SOURCES:
+            parse_stage.submit(kind, path)
+
+        for kind, path in SOURCES:
+            assert parse_stage.result(kind, path) == parse_source(kind, path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parse_stage_error(workers: int):
+    with ParseStage(workers) as parse_stage:
+        parse_stage.submit("bash", ASSETS_PATH / "does-not-exist.sh")
+        with pytest.raises(FileNotFoundError):
+            parse_stage.result("bash", ASSETS_PATH / "does-not-exist.sh")
+
+
+def test_parse_stage_shutdown_without_waiting(tmp_path):
+    scripts = []
+    for i in range(50):
+        scripts.append(tmp_path / f"{i}.sh")
+        scripts[-1].write_text("pip install numpy\n" * 100)
+
+    parse_stage = ParseStage(2)
+    for script in scripts:
+        parse_stage.submit("bash", script)
+    futures = list(parse_stage._parsed.values())
+    parse_stage.shutdown(wait=False)
+
+    # The scripts which weren't being parsed yet never will be
+    assert any(f.cancelled() for f in futures)
+    parse_stage.shutdown()
@@ -1,5 +1,6 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+import shutil
 import sys
 from typing import Optional, List
 import pytest
@@ -164,11 +165,13 @@ def test_pip_from_repo(load_config, tmp_path):
     check_set(transitive, transitive_expected, check_version=False)
 
 
-def test_pip_from_requirements(load_config):
-    reqs = ASSETS_PATH / "requirements-with-comment.txt"
+def test_pip_from_requirements(load_config, tmp_path):
+    # The CSVs are written next to the requirements, so scan a copy of them
+    reqs = tmp_path / "requirements-with-comment.txt"
+    shutil.copy(ASSETS_PATH / reqs.name, reqs)
     mock_requirements = parse_requirements_file(reqs)
 
-    direct, _ = pip_from_repo(ASSETS_PATH, reqs.name, mock_requirements)
+    direct, _ = pip_from_repo(tmp_path, reqs.name, mock_requirements)
 
     expected_packages = [
         "examples-utils",
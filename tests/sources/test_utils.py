@@ -1,9 +1,14 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
 
+import shutil
+import subprocess
+
 import pytest
 from pathlib import Path
 from typing import List
 from gc_licensing.sources.utils import (
+    discover_files,
+    glob_pattern,
     find_requirements_files,
     handle_copied_requirement_files,
     pip_packages_from_commands,
@@ -196,3 +201,102 @@ def test_apt_packages_from_commands():
     assert len(output) == len(expected_packages)
     for o in output:
         assert o in expected_packages
+
+
+@pytest.mark.parametrize(
+    "pattern, path, expected",
+    [
+        ["requirements.txt", "requirements.txt", True],
+        ["requirements.txt", "a/b/requirements.txt", True],
+        ["requirements.txt", "a/dev-requirements.txt", False],
+        ["test_repo/requirements.txt", "x/test_repo/requirements.txt", True],
+        ["test_repo/requirements.txt", "test_repo/x/requirements.txt", False],
+        ["**/*.ipynb", "a/b/c.ipynb", True],
+        ["*.ipynb", "c.ipynb", True],
+        ["*.ipynb", "a/c.ipynb.txt", False],
+        ["Dockerfile*", "docker/Dockerfile.dev", True],
+        ["requirements-[!d]*.txt", "requirements-dev.txt", False],
+        ["requirements-[!d]*.txt", "requirements-gpu.txt", True],
+    ],
+)
+def test_glob_pattern(pattern: str, path: str, expected: bool):
+    assert bool(glob_pattern(pattern).match(path)) == expected
+
+
+def test_discover_files(tmp_path):
+    for name in [
+        "requirements.txt",
+        "Dockerfile",
+        "app/requirements.txt",
+        "app/notebook.ipynb",
+        "app/docker/Dockerfile",
+        "venv/lib/requirements.txt",
+        "venv/lib/notebook.ipynb",
+        "tests/requirements.txt",
+    ]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+
+    found = discover_files(
+        tmp_path,
+        {
+            "pip": ["requirements.txt"],
+            "docker": ["Dockerfile"],
+            "notebook": ["**/*.ipynb", "*.ipynb"],
+        },
+        [tmp_path / "venv", tmp_path / "tests" / "requirements.txt"],
+    )
+
+    assert found == {
+        "pip": [Path("requirements.txt"), Path("app/requirements.txt")],
+        "docker": [Path("Dockerfile"), Path("app/docker/Dockerfile")],
+        "notebook": [Path("app/notebook.ipynb")],
+    }
+
+
+def test_discover_files_ignored_base(tmp_path):
+    (tmp_path / "requirements.txt").write_text("")
+    found = discover_files(tmp_path, {"pip": ["requirements.txt"]}, [tmp_path])
+    assert found == {"pip": []}
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_discover_files_git(tmp_path):
+    subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    (tmp_path / ".gitignore").write_text("build/\n")
+    for name in [
+        "requirements.txt",
+        "app/requirements.txt",
+        "app/deleted/requirements.txt",
+        "vendored/requirements.txt",
+        "build/requirements.txt",
+        "untracked/requirements.txt",
+    ]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+    subprocess.run(
+        ["git", "-C", str(tmp_path), "add", ".gitignore", "requirements.txt", "app"],
+        check=True,
+    )
+    subprocess.run(
+        ["git", "-C", str(tmp_path), "add", "vendored"],
+        check=True,
+    )
+    (tmp_path / "app" / "deleted" / "requirements.txt").unlink()
+
+    found = discover_files(
+        tmp_path, {"pip": ["requirements.txt"]}, [tmp_path / "vendored"], "git"
+    )
+    assert found == {
+        "pip": [Path("app/requirements.txt"), Path("requirements.txt")],
+    }
+
+    # Only the tracked files under the base path, relative to it
+    found = discover_files(tmp_path / "app", {"pip": ["requirements.txt"]}, [], "git")
+    assert found == {"pip": [Path("requirements.txt")]}
+
+
+def test_discover_files_git_fallback(tmp_path):
+    (tmp_path / "requirements.txt").write_text("")
+    found = discover_files(tmp_path, {"pip": ["requirements.txt"]}, [], "git")
+    assert found == {"pip": [Path("requirements.txt")]}
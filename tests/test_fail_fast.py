@@ -0,0 +1,66 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import threading
+
+import pytest
+
+from gc_licensing.fail_fast import FailFast, pip_package_list
+from gc_licensing.package import PipPackage
+from gc_licensing.scheduler import ScanStopped, Scheduler, completed
+
+
+def pip_packages(*licenses, is_direct=True):
+    return (
+        [
+            PipPackage(f"package_{i}", "1.0", license, None, is_direct)
+            for i, license in enumerate(licenses)
+        ],
+        [],
+    )
+
+
+def test_passing_files(load_config):
+    with Scheduler(network_workers=1, venv_workers=1) as scheduler:
+        fail_fast = FailFast(scheduler, fail_on_transitive=False)
+        checked = fail_fast.watch_all(
+            {
+                "requirements.txt": completed(pip_packages("MIT")),
+                # Transitive dependencies only fail with `fail_on_transitive`
+                "dev.txt": completed(pip_packages("GPL", is_direct=False)),
+            },
+            pip_package_list,
+        )
+        scheduler.wait(checked.values())
+    assert not scheduler.stopped.done()
+
+
+def test_stops_at_first_failure(load_config):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return pip_packages("MIT")
+
+    with Scheduler(network_workers=1, venv_workers=1) as scheduler:
+        fail_fast = FailFast(scheduler, fail_on_transitive=False)
+        slow_file = scheduler.submit("venv", slow)
+        started.wait(5)
+        queued = scheduler.submit("venv", pip_packages, "MIT")
+        checked = fail_fast.watch_all(
+            {
+                "slow.txt": slow_file,
+                "queued.txt": queued,
+                "requirements.txt": completed(pip_packages("MIT", "GPL")),
+            },
+            pip_package_list,
+        )
+
+        # The failing file is reported without waiting for the others
+        with pytest.raises(ScanStopped, match=r"package_1 \[1.0\] in requirements.txt"):
+            scheduler.wait(checked.values())
+        assert queued.cancelled()
+        assert checked["requirements.txt"].done()
+        assert not checked["slow.txt"].done()
+    release.set()
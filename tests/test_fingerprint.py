@@ -0,0 +1,94 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import json
+import pytest
+from pathlib import Path
+
+from gc_licensing import fingerprint as fingerprint_module
+from gc_licensing.fingerprint import (
+    FingerprintIndex,
+    build_fingerprint_index,
+    fingerprint,
+    license_texts_from_paths,
+)
+from gc_licensing.package import PipPackage
+from gc_licensing.sources.pip import pip_from_csv, parse_requirements_file
+from utils import create_pip_requirements_test_files
+
+
+LICENSES_PATH = Path(__file__).parent / "assets" / "licenses"
+
+MIT_TEXT = (LICENSES_PATH / "MIT.txt").read_text()
+
+
+@pytest.fixture
+def fingerprint_index_path(load_config, tmp_path, monkeypatch):
+    index_path = tmp_path / "license_fingerprints.idx"
+    build_fingerprint_index(license_texts_from_paths([LICENSES_PATH]), index_path)
+
+    monkeypatch.setitem(load_config.app.license, "fingerprint_index", index_path)
+    monkeypatch.setattr(fingerprint_module, "_fingerprint_indexes", {})
+    return index_path
+
+
+def test_fingerprint_normalization():
+    # Different copyright holders, no title and different wrapping
+    text = MIT_TEXT.replace("MIT License\n", "")
+    text = text.replace("<year> <copyright holders>", "2023 Graphcore Ltd")
+    text = text.replace("\n", "\n\n").replace("  ", " ").replace('"', "'")
+    assert fingerprint(text) == fingerprint(MIT_TEXT)
+
+    assert fingerprint(text.replace("MERCHANTABILITY", "")) != fingerprint(MIT_TEXT)
+
+
+def test_fingerprint_index(fingerprint_index_path: Path):
+    index = FingerprintIndex(fingerprint_index_path)
+    assert len(index) == 2
+
+    detected = index.detect(MIT_TEXT.upper())
+    assert detected.name == "MIT"
+    assert fingerprint(MIT_TEXT).hex()[:12] in detected.evidence
+
+    bsd = (LICENSES_PATH / "BSD-2-Clause.txt").read_text()
+    assert index.detect(bsd).name == "BSD-2-Clause"
+    assert index.detect(bsd[: len(bsd) // 2]) is None
+
+
+def test_fingerprint_index_invalid(tmp_path: Path):
+    path = tmp_path / "not_an_index"
+    path.write_bytes(b"\x00" * 64)
+    with pytest.raises(ValueError):
+        FingerprintIndex(path)
+
+
+@pytest.mark.parametrize(
+    "license_str, license_text, expected",
+    [
+        ["UNKNOWN", MIT_TEXT, "MIT"],
+        ["UNKNOWN", "Some proprietary license", "UNKNOWN"],
+        ["UNKNOWN", None, "UNKNOWN"],
+        ["BSD License", MIT_TEXT, "BSD License"],
+    ],
+)
+def test_pip_package_detected_license(
+    fingerprint_index_path, license_str, license_text, expected
+):
+    pkg = PipPackage("foo", "1.0", license_str, None, True, license_text)
+    assert [l.name for l in pkg.licenses] == [expected]
+    assert (pkg.license_evidence is not None) == (expected != license_str)
+
+
+def test_pip_from_csv_license_texts(fingerprint_index_path, tmp_path: Path):
+    before, after, reqs, _, _, _ = create_pip_requirements_test_files(tmp_path)
+    with open(after, "a") as fh:
+        fh.write('\n"mystery","0.1.0","UNKNOWN"')
+
+    license_texts = tmp_path / "license-texts.json"
+    with open(license_texts, "w") as fh:
+        json.dump([{"Name": "mystery", "LicenseText": MIT_TEXT}], fh)
+
+    _, transitive = pip_from_csv(
+        before, after, parse_requirements_file(reqs), license_texts
+    )
+    mystery = [p for p in transitive if p.name == "mystery"][0]
+    assert [l.name for l in mystery.licenses] == ["MIT"]
@@ -0,0 +1,222 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import pickle
+import shutil
+import subprocess
+
+import pytest
+from pathlib import Path
+
+from gc_licensing.incremental import ResultsStore
+from gc_licensing.package import AptPackage, PipPackage
+from gc_licensing.sources.pip import requirements_file_includes
+
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+
+def git(repo: Path, *args: str) -> str:
+    result = subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=test@test"]
+        + list(args),
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+
+def commit(repo: Path, files: dict) -> str:
+    for name, text in files.items():
+        (repo / name).parent.mkdir(parents=True, exist_ok=True)
+        (repo / name).write_text(text)
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "commit")
+    return git(repo, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def repo(tmp_path, load_config):
+    load_config.app.apt.cache_path = str(tmp_path / "cache")
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git(repo, "init", "-q")
+    (repo / ".gitignore").write_text("*.pyc\n")
+    return repo
+
+
+def record_pip(results: ResultsStore, repo: Path, name: str):
+    path = Path(name)
+    includes = requirements_file_includes(repo / path)
+    results.record(
+        "pip", path, includes, ([PipPackage(name, "1.0", "MIT", None, True)], [])
+    )
+
+
+def reused_pip(results: ResultsStore, name: str):
+    """
+    The name of the package recorded by `record_pip`, if it's reused.
+    """
+    packages = results.reuse("pip", Path(name))
+    return None if packages is None else packages[0][0].name
+
+
+def test_reuse_unchanged_files(repo):
+    base = commit(
+        repo,
+        {
+            "requirements.txt": "-r common/base.txt\nnumpy\n",
+            "common/base.txt": "requests\n",
+            "other/requirements.txt": "pandas\n",
+        },
+    )
+    results = ResultsStore(repo, "settings")
+    for name in ["requirements.txt", "other/requirements.txt"]:
+        record_pip(results, repo, name)
+
+    # Changing an included file re-resolves the file including it
+    commit(repo, {"common/base.txt": "requests\nurllib3\n"})
+    results = ResultsStore(repo, "settings", base)
+    assert reused_pip(results, "requirements.txt") is None
+    assert reused_pip(results, "other/requirements.txt") == "other/requirements.txt"
+    assert results.reused == 1
+
+    # Nothing was stored for other settings
+    results = ResultsStore(repo, "other settings", base)
+    assert reused_pip(results, "other/requirements.txt") is None
+
+    # Reused results are stored against the current commit too
+    head = git(repo, "rev-parse", "HEAD")
+    commit(repo, {"requirements.txt": "-r common/base.txt\nnumpy\nscipy\n"})
+    results = ResultsStore(repo, "settings", head)
+    assert reused_pip(results, "other/requirements.txt") == "other/requirements.txt"
+
+
+def test_uncommitted_changes_not_stored(repo):
+    commit(repo, {"a.txt": "numpy\n", "b.txt": "pandas\n"})
+    (repo / "a.txt").write_text("numpy\nscipy\n")
+    (repo / "c.txt").write_text("requests\n")
+
+    results = ResultsStore(repo, "settings")
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        record_pip(results, repo, name)
+
+    results = ResultsStore(repo, "settings", "HEAD")
+    assert reused_pip(results, "a.txt") is None
+    assert reused_pip(results, "b.txt") == "b.txt"
+    assert reused_pip(results, "c.txt") is None
+
+
+def test_reuse_source(repo):
+    base = commit(
+        repo,
+        {"Dockerfile": "COPY reqs.txt /reqs.txt\n", "reqs.txt": "numpy\n"},
+    )
+    packages = (([], []), [])
+    results = ResultsStore(repo, "settings")
+    results.record_source(
+        "docker", Path("Dockerfile"), [], packages, [repo / "reqs.txt"]
+    )
+
+    results = ResultsStore(repo, "settings", base)
+    assert results.reuse_source("docker", Path("Dockerfile")) == (
+        packages,
+        [repo.resolve() / "reqs.txt"],
+    )
+
+    # Changing a requirements file invalidates the Dockerfile installing it
+    (repo / "reqs.txt").write_text("numpy\nscipy\n")
+    results = ResultsStore(repo, "settings", base)
+    assert results.reuse_source("docker", Path("Dockerfile")) is None
+
+
+def test_not_a_git_repository(tmp_path, load_config):
+    load_config.app.apt.cache_path = str(tmp_path / "cache")
+    (tmp_path / "requirements.txt").write_text("numpy\n")
+
+    results = ResultsStore(tmp_path, "settings", "HEAD")
+    record_pip(results, tmp_path, "requirements.txt")
+    assert results.base is None
+    assert reused_pip(results, "requirements.txt") is None
+
+
+def test_resume_from_checkpoint(tmp_path, load_config):
+    # Checkpoints don't need a git repository
+    load_config.app.apt.cache_path = str(tmp_path / "cache")
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "requirements.txt").write_text("-r base.txt\nnumpy\n")
+    (repo / "base.txt").write_text("requests\n")
+    (repo / "other.txt").write_text("pandas\n")
+
+    # Only checkpointed when resuming
+    results = ResultsStore(repo, "settings")
+    record_pip(results, repo, "other.txt")
+    assert reused_pip(ResultsStore(repo, "settings", resume=True), "other.txt") is None
+
+    results = ResultsStore(repo, "settings", resume=True)
+    for name in ["requirements.txt", "other.txt"]:
+        record_pip(results, repo, name)
+
+    # Only reused when resuming
+    assert reused_pip(ResultsStore(repo, "settings"), "other.txt") is None
+
+    (repo / "base.txt").write_text("requests\nurllib3\n")
+    results = ResultsStore(repo, "settings", resume=True)
+    assert reused_pip(results, "other.txt") == "other.txt"
+    # Validated against the contents of the file and its includes
+    assert reused_pip(results, "requirements.txt") is None
+    assert results.resumed == 1
+    assert results.reused == 0
+
+    # Nothing was checkpointed for other settings
+    results = ResultsStore(repo, "other settings", resume=True)
+    assert reused_pip(results, "other.txt") is None
+
+
+def test_unknown_changes_not_stored(repo, monkeypatch):
+    commit(repo, {"a.txt": "numpy\n"})
+    # e.g. `git diff` failing after `git rev-parse HEAD` succeeded
+    monkeypatch.setattr(ResultsStore, "_changed_since", lambda self, commit: None)
+    results = ResultsStore(repo, "settings")
+    assert results.head is not None and results.dirty is None
+    record_pip(results, repo, "a.txt")
+
+    monkeypatch.undo()
+    assert reused_pip(ResultsStore(repo, "settings", "HEAD"), "a.txt") is None
+
+
+def test_results_round_trip(repo):
+    commit(repo, {"Dockerfile": "RUN apt-get install libfoo\n", "reqs.txt": "foo\n"})
+    pip = PipPackage("foo", "1.0", "UNKNOWN", None, True)
+    pip.license_evidence = "LICENSE.txt"
+    apt = AptPackage(
+        "libfoo", "2.0", "GPL-2+", {"BSD-3-Clause": ["src/*"]}, "https://foo", False
+    )
+    results = ResultsStore(repo, "settings")
+    results.record_source(
+        "docker", Path("Dockerfile"), [], (([pip], []), [apt]), [repo / "reqs.txt"]
+    )
+
+    results = ResultsStore(repo, "settings", "HEAD")
+    ((direct, transitive), apt_packages), req_files = results.reuse_source(
+        "docker", Path("Dockerfile")
+    )
+    assert req_files == [repo.resolve() / "reqs.txt"]
+    assert transitive == []
+    assert vars(direct[0]) == vars(pip)
+    assert vars(apt_packages[0]) == vars(apt)
+
+
+def test_results_are_data_only(repo):
+    commit(repo, {"a.txt": "numpy\n"})
+
+    class Poisoned:
+        def __reduce__(self):
+            return (exec, ("raise AssertionError('Ran code from the results')",))
+
+    results = ResultsStore(repo, "settings", "HEAD")
+    results.store.put(
+        results._key(results.head, "pip", Path("a.txt")), pickle.dumps(Poisoned())
+    )
+    assert results.reuse("pip", Path("a.txt")) is None
@@ -11,9 +11,12 @@ from gc_licensing.junit import (
     append_suites_combined,
     append_suites_pip,
     append_suites_apt,
+    append_suites_not_evaluated,
+    generate_junit_output,
     suite_for_file,
 )
 from gc_licensing.package import AptPackage, CombinedPackages, PipPackage
+from gc_licensing.problem_packages import NotEvaluated
 from gc_licensing.sources.pip import parse_requirements_file, pip_from_csv
 from utils import create_pip_requirements_test_files
 
@@ -470,3 +473,21 @@ def test_append_suites_combined(
     for s, e in zip(suites, expected):
         assert count_failures(s) == count_failures(e)
         assert name_set(e) == name_set(e)
+
+
+def test_append_suites_not_evaluated():
+    not_evaluated = NotEvaluated(
+        "the time budget ran out",
+        {"pip": ["requirements.txt"], "apt": [], "Docker": ["Dockerfile"]},
+    )
+    suites = []
+    append_suites_not_evaluated(suites, not_evaluated)
+
+    assert [s.name for s in suites] == ["requirements.txt", "Dockerfile"]
+    for s in suites:
+        (case,) = s.test_cases
+        assert case.is_error()
+        assert case.errors[0]["message"] == "Not evaluated, as the time budget ran out"
+
+    xml, _ = generate_junit_output(not_evaluated=not_evaluated)
+    assert 'errors="1"' in xml and "not evaluated" in xml
@@ -4,7 +4,7 @@ import pytest
 from typing import Optional
 
 from gc_licensing.config import Config
-from gc_licensing.license import License, in_license_list
+from gc_licensing.license import License, in_license_list, license_allowed
 
 
 def setup_config(cfg: Config):
@@ -157,3 +157,45 @@ def test_regex(license_list, licenses, expected_result):
     assert len(licenses) == len(expected_result)
     for l, e in zip(licenses, expected_result):
         assert in_license_list(l, license_list) == e
+
+
+@pytest.mark.parametrize(
+    "license_name, expected_ok",
+    [
+        ["Expat", True],
+        ["MIT/Expat", True],
+        ["Apache License, Version 2.0", True],
+        ["Apache-2", True],
+        ["Expat or GPL-2+", True],
+        ["Expat and GPL-2+", False],
+        ["GPL-2+", False],
+        ["Apache-1.1", False],
+    ],
+)
+def test_license_fuzzy_match(load_config, license_name: str, expected_ok: bool):
+    setup_config(load_config)
+    load_config.app.license.allowlist = ["MIT$", "Apache-2.0"]
+
+    assert License(license_name).ok == expected_ok
+
+
+@pytest.mark.parametrize(
+    "license_name, expected_ok",
+    [
+        ["Expat with advertising clause", False],
+        ["MIT with non-commercial restriction", False],
+        ["GPL-2+ with OpenSSL exception", False],
+        ["MIT", True],
+    ],
+)
+def test_license_with_clause(license_name: str, expected_ok: bool):
+    # Only allowed as a whole, not by the license the clause modifies
+    assert license_allowed(license_name, ("mit(?: license)?",), 0.85) == expected_ok
+
+
+def test_license_with_exception_allowed():
+    allowlist = ("GPL-2.0-or-later WITH OpenSSL-exception",)
+    assert license_allowed("GPL-2+ with OpenSSL exception", allowlist, 0.85)
+    assert not license_allowed(
+        "GPL-2+ with OpenSSL exception and more", allowlist, 0.85
+    )
@@ -0,0 +1,133 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import pytest
+
+from gc_licensing.license_index import (
+    KNOWN_LICENSES,
+    LicenseIndex,
+    classify_licenses,
+    license_tokens,
+    match_license,
+)
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    [
+        ["GPL-2.0+", "GPLv2+"],
+        ["GPL-2+", "GNU General Public License v2 or later"],
+        [
+            "LGPL-2.1+",
+            "GNU Lesser General Public License, version 2.1 or any later version",
+        ],
+        ["BSD-3-Clause", "3-clause BSD license"],
+        ["Apache-2.0", "Apache License 2"],
+    ],
+)
+def test_license_tokens(a: str, b: str):
+    assert license_tokens(a) == license_tokens(b)
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ["MIT", "MIT"],
+        ["Expat", "MIT"],
+        ["BSD-3-clause", "BSD-3-Clause"],
+        ["GPL-2+", "GPL-2.0-or-later"],
+        ["GPL-2", "GPL-2.0-only"],
+        ["LGPL-2.1+", "LGPL-2.1-or-later"],
+        ["Apache License, Version 2.0", "Apache-2.0"],
+        ["public-domain", "public-domain"],
+        ["Artistic or GPL-1+", "Artistic-1.0 OR GPL-1.0-or-later"],
+        ["BSD-3-clause and Expat", "BSD-3-Clause AND MIT"],
+        [
+            "GPL-2+ with OpenSSL exception",
+            "GPL-2.0-or-later WITH OpenSSL-exception",
+        ],
+        ["BSD-3-Clause~with-exception", "BSD-3-Clause WITH exception"],
+        ["Apache-2.0 with LLVM exception", "Apache-2.0 WITH LLVM-exception"],
+        [
+            "GPL-3+ with GCC runtime library exception",
+            "GPL-3.0-or-later WITH GCC-exception-3.1",
+        ],
+        ["GPL-2 with Linux-syscall-note", "GPL-2.0-only WITH Linux-syscall-note"],
+        ["GPL-2+ with foo~exception", "GPL-2.0-or-later WITH foo-exception"],
+    ],
+)
+def test_match_license_exact(name: str, expected: str):
+    match = match_license(name)
+    assert match.canonical == expected
+    assert match.confidence == 1.0
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ["BSD-3-Clauses", "BSD-3-Clause"],
+        ["BSD-2-Clauses", "BSD-2-Clause"],
+    ],
+)
+def test_match_license_fuzzy(name: str, expected: str):
+    match = match_license(name)
+    assert match.canonical == expected
+    assert 0.8 < match.confidence < 1.0
+
+
+@pytest.mark.parametrize("name", ["GPL", "UNKNOWN", "permissive"])
+def test_match_license_poor(name: str):
+    # Without a version, `GPL` must not be guessed as any particular GPL version.
+    match = match_license(name)
+    assert match is None or match.confidence < 0.5
+
+
+def test_fuzzy_match_keeps_version():
+    index = LicenseIndex({"GPL-2.0-only": ["GPL-2"], "GPL-3.0-only": ["GPL-3"]})
+    canonical, _ = index.match_single("GPLs v3")
+    assert canonical == "GPL-3.0-only"
+    canonical, _ = index.match_single("GPLv2+")
+    assert canonical is None
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "CC-BY-NC-SA-3.0",
+        "CC-BY-SA-NC-4.0",
+        "CC-BY-NC-3.0",
+        "CC-BY-ND-4.0",
+        "BSD-4-Clause-UC",
+        "BSD-3-Clause-No-Nuclear-License",
+        "BSD-2-clause-NetBSD",
+    ],
+)
+def test_fuzzy_match_keeps_restrictions(name: str):
+    # Each is a different license from the one it's closest to, and mustn't pass as it
+    assert match_license(name) is None
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "Expat with advertising clause",
+        "MIT with non-commercial restriction",
+        "BSD-3-Clause with no-nuclear clause",
+    ],
+)
+def test_match_license_with_restriction(name: str):
+    # Only exceptions are recognised, anything else may restrict the license
+    assert match_license(name) is None
+
+
+def test_classify_licenses():
+    matches = classify_licenses(["Expat", "GPL-2+", "Expat"])
+    assert {n: m.canonical for n, m in matches.items()} == {
+        "Expat": "MIT",
+        "GPL-2+": "GPL-2.0-or-later",
+    }
+
+
+def test_known_licenses_match_themselves():
+    for canonical, aliases in KNOWN_LICENSES.items():
+        for alias in [canonical] + aliases:
+            assert match_license(alias).canonical == canonical
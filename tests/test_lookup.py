@@ -0,0 +1,77 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gc_licensing.lookup import Lookups, lookups, shared_package
+from gc_licensing.package import PipPackage
+from gc_licensing.sources.pip import create_packages
+
+
+def test_lookups_computed_once():
+    table = Lookups()
+    calls = []
+    lock = threading.Lock()
+
+    def compute():
+        with lock:
+            calls.append(1)
+        time.sleep(0.05)
+        return "MIT"
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(
+            pool.map(lambda _: table.get(("pip", "a", "1"), compute), range(8))
+        )
+
+    assert results == ["MIT"] * 8
+    assert len(calls) == 1
+    assert len(table) == 1
+
+
+def test_lookups_failures_not_memoized():
+    table = Lookups()
+
+    def fail():
+        raise ValueError("lookup failed")
+
+    with pytest.raises(ValueError):
+        table.get("key", fail)
+    assert table.get("key", lambda: 1) == 1
+
+
+def test_lookups_peek():
+    table = Lookups()
+    assert table.peek("key") is None
+    assert table.get("key", lambda: 1) == 1
+    assert table.peek("key") == 1
+
+
+def test_shared_package(load_config):
+    def build():
+        built.append(1)
+        return PipPackage("numpy", "1.0", "BSD", None, True)
+
+    built = []
+    direct = shared_package("pip", "numpy", "1.0", build, True)
+    assert shared_package("pip", "numpy", "1.0", build, True) is direct
+
+    transitive = shared_package("pip", "numpy", "1.0", build, False)
+    assert not transitive.is_direct
+    assert direct.is_direct
+    assert transitive.licenses is direct.licenses
+    assert len(built) == 1
+
+
+def test_create_packages_shared(load_config):
+    rows = [["numpy", "1.0", "BSD"], ["six", "1.16", "MIT"]]
+    first = create_packages(rows)
+    second = create_packages(rows, is_direct=False)
+
+    assert [p.is_direct for p in second] == [False, False]
+    assert [p.licenses for p in first] == [p.licenses for p in second]
+    assert [id(p) for p in create_packages(rows)] == [id(p) for p in first]
+    assert len(lookups) == 2
@@ -0,0 +1,138 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import argparse
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from gc_licensing.__main__ import get_dockerfile
+from gc_licensing.fail_fast import FailFast, combined_package_list
+from gc_licensing.incremental import ResultsStore
+from gc_licensing.package import PipPackage
+from gc_licensing.scheduler import ScanStopped, Scheduler, unfinished
+from gc_licensing.sources import docker
+from gc_licensing.sources.parse import ParseStage
+
+
+FAST = Path("Dockerfile.fast")
+SLOW = Path("Dockerfile.slow")
+FAILING = Path("Dockerfile.failing")
+
+
+def docker_args(repository: Path, dockerfiles: List[Path]) -> argparse.Namespace:
+    return argparse.Namespace(
+        repository=repository,
+        dockerfiles=dockerfiles,
+        docker_image_map=[("myorg/base", Path("base/Dockerfile"))],
+        docker_no_follow_requirements_files=True,
+        apt_no_cache=False,
+        apt_follow_depends=False,
+    )
+
+
+@pytest.fixture
+def repo(tmp_path, load_config):
+    repo = tmp_path / "repo"
+    (repo / "base").mkdir(parents=True)
+    (repo / "base" / "Dockerfile").write_text(
+        "FROM ubuntu\nRUN pip install base-package\n"
+    )
+    for name in ["fast", "slow", "failing"]:
+        (repo / f"Dockerfile.{name}").write_text(
+            f"FROM myorg/base\nRUN pip install {name}-package\n"
+        )
+    return repo
+
+
+class Stages:
+    """
+    Resolves each stage to the pip packages it installs, with `slow-package` taking until
+    it's released.
+    """
+
+    def __init__(self):
+        self.calls: List[str] = []
+        self.release = threading.Event()
+
+    def run_list_of_commands(self, path, commands, *args):
+        names = [c.split()[-1] for c in commands]
+        self.calls += names
+        if "slow-package" in names:
+            self.release.wait(5)
+        licenses = ["GPL-3.0" if n == "failing-package" else "MIT" for n in names]
+        pip_direct = [
+            PipPackage(n, "1.0", l, None, True) for n, l in zip(names, licenses)
+        ]
+        return ((pip_direct, []), []), []
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    stages = Stages()
+    monkeypatch.setattr(docker, "run_list_of_commands", stages.run_list_of_commands)
+    yield stages
+    stages.release.set()
+
+
+def names(result) -> List[str]:
+    ((pip_direct, _), _), _ = result
+    return sorted(p.name for p in pip_direct)
+
+
+def test_dockerfiles_resolved_separately(repo, stages):
+    args = docker_args(repo, [FAST, SLOW])
+    with ParseStage(1) as parse_stage, Scheduler(1, 1) as scheduler:
+        results = ResultsStore(repo, "settings")
+        pending = get_dockerfile(args, parse_stage, scheduler, results)
+
+        # The fast Dockerfile doesn't wait for the slow one
+        assert names(pending[FAST].result(timeout=5)) == [
+            "base-package",
+            "fast-package",
+        ]
+        assert unfinished(pending[SLOW])
+
+        stages.release.set()
+        assert names(pending[SLOW].result(timeout=5)) == [
+            "base-package",
+            "slow-package",
+        ]
+
+    # The base stage they share is only resolved once
+    assert sorted(stages.calls) == ["base-package", "fast-package", "slow-package"]
+
+
+def test_dockerfile_past_deadline(repo, stages):
+    args = docker_args(repo, [FAST, SLOW])
+    with ParseStage(1) as parse_stage, Scheduler(
+        1, 1, deadline=time.monotonic() + 1
+    ) as scheduler:
+        results = ResultsStore(repo, "settings")
+        pending = get_dockerfile(args, parse_stage, scheduler, results)
+        with pytest.raises(ScanStopped, match="time budget"):
+            scheduler.wait(pending.values())
+
+    # Only the Dockerfile still being resolved isn't evaluated
+    assert not unfinished(pending[FAST])
+    assert names(pending[FAST].result()) == ["base-package", "fast-package"]
+    assert unfinished(pending[SLOW])
+
+
+def test_fail_fast_stops_at_first_dockerfile(repo, stages):
+    args = docker_args(repo, [FAILING, SLOW])
+    with ParseStage(1) as parse_stage, Scheduler(1, 1) as scheduler:
+        results = ResultsStore(repo, "settings")
+        pending = get_dockerfile(args, parse_stage, scheduler, results)
+        pending = FailFast(scheduler, fail_on_transitive=False).watch_all(
+            pending, lambda result: combined_package_list(result[0])
+        )
+        with pytest.raises(
+            ScanStopped, match=r"failing-package \[1.0\] in Dockerfile.failing"
+        ):
+            scheduler.wait(pending.values())
+
+        # The scan stops before the second Dockerfile is resolved
+        assert unfinished(pending[SLOW])
@@ -0,0 +1,152 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import argparse
+from pathlib import Path
+
+import pytest
+
+from gc_licensing.incremental import ResultsStore
+from gc_licensing.plan import (
+    format_duration,
+    format_plan,
+    plan_scan,
+    requirements_item,
+)
+from gc_licensing.scheduler import WorkItem, estimate_cost
+from gc_licensing.sources.parse import ParseStage
+from gc_licensing.timings import TimingHistory
+
+
+def scan_args(repository: Path, **kwargs) -> argparse.Namespace:
+    args = dict(
+        repository=repository,
+        pip_requirements_files=[],
+        apt_requirements_files=[],
+        dockerfiles=[],
+        bash_files=[],
+        notebook_files=[],
+        container_images=[],
+        docker_image_map=[],
+        docker_no_follow_requirements_files=False,
+        bash_no_follow_requirements_files=False,
+        notebook_no_follow_requirements_files=False,
+        apt_no_cache=False,
+        apt_follow_depends=False,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def plan_repo(args: argparse.Namespace):
+    results = ResultsStore(args.repository, "settings")
+    with ParseStage(1) as parse_stage:
+        for kind, files in [
+            ("dockerfile", args.dockerfiles),
+            ("bash", args.bash_files),
+            ("notebook", args.notebook_files),
+        ]:
+            for f in files:
+                parse_stage.submit(kind, args.repository / f)
+        return plan_scan(args, parse_stage, results)
+
+
+@pytest.fixture
+def repo(tmp_path, load_config):
+    load_config.app.apt.cache_path = str(tmp_path / "cache")
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "requirements.txt").write_text("requests\n")
+    (repo / "reqs.txt").write_text("numpy\n")
+    (repo / "Dockerfile").write_text(
+        "FROM ubuntu AS base\n"
+        "COPY reqs.txt /r.txt\n"
+        "RUN pip install -r /r.txt && pip install numpy six\n"
+        "FROM base\n"
+        "RUN pip install six numpy\n"
+    )
+    (repo / "run.sh").write_text("pip install numpy six\nsource ./env.sh\n")
+    (repo / "env.sh").write_text("pip install torch\n")
+    return repo
+
+
+def test_plan_scan(repo):
+    args = scan_args(
+        repo,
+        pip_requirements_files=[Path("requirements.txt")],
+        dockerfiles=[Path("Dockerfile")],
+        bash_files=[Path("run.sh")],
+    )
+    plan = plan_repo(args)
+
+    assert list(plan.pip_files) == [Path("requirements.txt")]
+    assert plan.dockerfiles[Path("Dockerfile")].detail == (
+        "3 commands installing 4 pip and 0 apt packages"
+    )
+    # The copied requirements file is resolved once, as a file of its own
+    assert list(plan.extra_pip_files) == [Path("reqs.txt")]
+    # However many times and in whatever order they're installed
+    assert list(plan.requirement_sets) == [("numpy", "six"), ("torch",)]
+    assert plan.pip_installs == 4
+    assert not any(item.cached for item in plan.items())
+
+
+def test_format_plan(repo):
+    args = scan_args(repo, bash_files=[Path("run.sh")])
+    plan = plan_repo(args)
+
+    history = TimingHistory(repo / "timings.json")
+    history.record("requirements:numpy six", 30.0)
+    text = format_plan(plan, history, {"venv": 2, "network": 8, "sources": 10})
+
+    assert "  numpy six  30s" in text
+    # Never timed, so estimated from the number of packages
+    assert "  torch  25s" in text
+    assert "Estimated venv time: 55s (28s over 2 workers)" in text
+    assert text.endswith("Estimated total: 28s")
+
+
+def test_estimate_cost(tmp_path):
+    history = TimingHistory(tmp_path / "timings.json")
+    item = WorkItem("pip", "requirements.txt", "venv", digest="a", size=4)
+    assert estimate_cost(item, history) == 40.0
+
+    history.record(item.key, 10.0, item.digest)
+    history.record(item.key, 20.0, item.digest)
+    assert estimate_cost(item, history) == 15.0
+    assert estimate_cost(WorkItem("pip", "a.txt", "venv", cached=True), history) == 0
+
+    # Dockerfiles cost nothing themselves
+    assert estimate_cost(WorkItem("docker", "Dockerfile", "sources"), history) == 0
+
+    history.save()
+    history = TimingHistory(tmp_path / "timings.json")
+    assert estimate_cost(item, history) == 15.0
+
+    # Once the file changes, it's estimated from its size until it's timed again
+    item.digest = "b"
+    assert estimate_cost(item, history) == 40.0
+    history.record(item.key, 30.0, item.digest)
+    assert estimate_cost(item, history) == 30.0
+
+
+def test_requirements_item(repo):
+    (repo / "requirements.txt").write_text(
+        "# The base\n-r base.txt\nnumpy  # pinned below\n\n-e ./local\n"
+    )
+    (repo / "base.txt").write_text("requests\nsix\n")
+    item = requirements_item("pip", repo, Path("requirements.txt"))
+    assert item.key == "pip:requirements.txt"
+    assert item.size == 4
+
+    # Editing an included file changes the digest
+    (repo / "base.txt").write_text("requests\n")
+    changed = requirements_item("pip", repo, Path("requirements.txt"))
+    assert changed.digest != item.digest
+    assert changed.size == 3
+
+
+def test_format_duration():
+    assert format_duration(2.5) == "2.5s"
+    assert format_duration(42) == "42s"
+    assert format_duration(125) == "2m 05s"
+    assert format_duration(3 * 3600 + 60) == "3h 01m"
@@ -0,0 +1,183 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import threading
+import time
+from concurrent.futures import CancelledError
+from pathlib import Path
+
+import pytest
+
+from gc_licensing import scheduler as scheduler_module
+from gc_licensing.scheduler import (
+    ScanStopped,
+    Scheduler,
+    WorkItem,
+    completed,
+    submit,
+    then,
+)
+from gc_licensing.timings import TimingHistory
+from gc_licensing.sources import utils
+
+
+def test_submit_without_scheduler():
+    thread = submit("venv", threading.current_thread).result()
+    assert thread is threading.current_thread()
+
+    with pytest.raises(ValueError):
+        submit("network", int, "not a number").result()
+
+
+def test_resources_overlap():
+    # Each waits for the other, so only finishes if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    with Scheduler(network_workers=1, venv_workers=1) as scheduler:
+        venv = scheduler.submit("venv", barrier.wait)
+        network = submit("network", barrier.wait)
+        assert {venv.result(), network.result()} == {0, 1}
+    assert scheduler_module._active is None
+
+
+def test_resource_limits():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    with Scheduler(network_workers=3, venv_workers=1) as scheduler:
+        for f in [scheduler.submit("venv", work) for _ in range(4)]:
+            f.result()
+        assert max(peak) == 1
+
+        peak.clear()
+        for f in [scheduler.submit("network", work) for _ in range(6)]:
+            f.result()
+        assert max(peak) <= 3
+
+
+def test_submit_to_own_pool():
+    with Scheduler(network_workers=1, venv_workers=1) as scheduler:
+        outer = scheduler.submit(
+            "venv", lambda: scheduler.submit("venv", lambda: "inner").result()
+        )
+        assert outer.result(timeout=5) == "inner"
+
+
+def test_longest_items_start_first(tmp_path):
+    history = TimingHistory(tmp_path / "timings.json")
+    history.record("requirements:torch", 300.0)
+    history.record("requirements:six", 5.0)
+    items = [
+        WorkItem("requirements", "six", "venv"),
+        # Never timed, so estimated from its size
+        WorkItem("requirements", "numpy pandas", "venv", size=2),
+        WorkItem("requirements", "torch", "venv"),
+    ]
+
+    started = []
+    with Scheduler(network_workers=1, venv_workers=1, history=history) as scheduler:
+        with scheduler.held():
+            futures = [
+                scheduler.submit_item(item, started.append, item.name) for item in items
+            ]
+            assert not started
+        for f in futures:
+            f.result()
+    assert started == ["torch", "numpy pandas", "six"]
+
+    # Every item was timed
+    assert history.estimate("requirements:torch") < 300.0
+
+
+def test_stop():
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+        return "finished"
+
+    with Scheduler(network_workers=1, venv_workers=1) as scheduler:
+        running = scheduler.submit("venv", block)
+        started.wait(5)
+        queued = scheduler.submit("venv", lambda: "never")
+
+        scheduler.stop("a package failed")
+        assert queued.cancelled()
+        assert scheduler.submit("network", lambda: "never").cancelled()
+        with pytest.raises(ScanStopped, match="a package failed"):
+            scheduler.wait([running, queued])
+
+        # Stopping again keeps the first reason
+        scheduler.stop("another package failed")
+        assert scheduler.stopped.result() == "a package failed"
+
+    # The work still running is abandoned rather than waited for
+    assert not running.done()
+    release.set()
+    assert running.result(timeout=5) == "finished"
+
+
+def test_deadline(tmp_path):
+    history = TimingHistory(tmp_path / "timings.json")
+    history.record("requirements:torch", 300.0)
+    release = threading.Event()
+
+    with Scheduler(
+        network_workers=1,
+        venv_workers=1,
+        history=history,
+        deadline=time.monotonic() + 1,
+    ) as scheduler:
+        # Work expected to run past the deadline isn't started
+        too_long = scheduler.submit_item(
+            WorkItem("requirements", "torch", "venv"), lambda: "torch"
+        )
+        with pytest.raises(CancelledError):
+            too_long.result(timeout=5)
+
+        # And the scan's stopped when it's reached
+        running = scheduler.submit("venv", release.wait, 5)
+        with pytest.raises(ScanStopped, match="time budget"):
+            scheduler.wait([running])
+    release.set()
+
+
+def test_then():
+    assert then(completed(2), lambda x: x * 3).result() == 6
+
+    failed = then(completed("x"), int)
+    with pytest.raises(ValueError):
+        failed.result()
+
+
+def test_run_list_of_commands_overlaps(monkeypatch):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def pip_licenses(packages):
+        barrier.wait()
+        return packages, []
+
+    def apt_licenses(packages, no_cache, follow_depends):
+        barrier.wait()
+        return packages
+
+    monkeypatch.setattr(utils, "pip_licenses_from_packages", pip_licenses)
+    monkeypatch.setattr(utils, "apt_licenses_from_packages", apt_licenses)
+
+    with Scheduler(network_workers=1, venv_workers=1):
+        packages, _ = utils.run_list_of_commands(
+            Path("Dockerfile"),
+            ["pip install numpy && apt-get install -y git"],
+            False,
+            False,
+        )
+    assert packages == ((["numpy"], []), ["git"])
@@ -0,0 +1,86 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+
+import multiprocessing
+from pathlib import Path
+
+from gc_licensing.store import INDEX_RECORD, PackStore
+
+
+def test_put_get(tmp_path):
+    store = PackStore(tmp_path, "test")
+    assert store.get("missing") is None
+    assert "missing" not in store
+
+    store.put_text("a", "some text")
+    store.put("b", b"\x00\x01binary")
+    assert store.get_text("a") == "some text"
+    assert store.get("b") == b"\x00\x01binary"
+    assert "a" in store
+
+    store.put_text("a", "updated text")
+    assert store.get_text("a") == "updated text"
+
+    # Stores opened later (e.g. the next run) see everything written so far
+    reopened = PackStore(tmp_path, "test")
+    assert reopened.get_text("a") == "updated text"
+    assert reopened.get("b") == b"\x00\x01binary"
+
+
+def test_deduplication(tmp_path):
+    store = PackStore(tmp_path, "test")
+    gpl = "GNU GENERAL PUBLIC LICENSE\n" * 1000
+
+    store.put_text("copyright/a", gpl)
+    pack_size = store.pack_path.stat().st_size
+    assert pack_size < len(gpl)
+
+    for i in range(10):
+        store.put_text(f"copyright/{i}", gpl)
+        assert store.get_text(f"copyright/{i}") == gpl
+    assert store.pack_path.stat().st_size == pack_size
+
+    # Writing the same content for the same key again is a no-op
+    index_size = store.index_path.stat().st_size
+    store.put_text("copyright/a", gpl)
+    assert store.index_path.stat().st_size == index_size
+
+
+def test_partial_index_record(tmp_path):
+    store = PackStore(tmp_path, "test")
+    store.put_text("a", "a")
+
+    # Simulate a writer that died part way through appending an index record
+    with open(store.index_path, "ab") as fh:
+        fh.write(b"\x00" * (INDEX_RECORD.size // 2))
+
+    store = PackStore(tmp_path, "test")
+    assert store.get_text("a") == "a"
+    store.put_text("b", "b")
+    assert store.index_path.stat().st_size == 2 * INDEX_RECORD.size
+    assert PackStore(tmp_path, "test").get_text("b") == "b"
+
+
+def _write_keys(path: Path, worker: int):
+    store = PackStore(path, "test")
+    for i in range(50):
+        store.put_text(f"{worker}/{i}", f"shared {i % 5}")
+        store.put_text(f"{worker}/unique/{i}", f"worker {worker} item {i}")
+
+
+def test_concurrent_writers(tmp_path):
+    workers = [
+        multiprocessing.Process(target=_write_keys, args=(tmp_path, w))
+        for w in range(4)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+
+    store = PackStore(tmp_path, "test")
+    for w in range(4):
+        for i in range(50):
+            assert store.get_text(f"{w}/{i}") == f"shared {i % 5}"
+            assert store.get_text(f"{w}/unique/{i}") == f"worker {w} item {i}"
+    assert store.index_path.stat().st_size == 4 * 100 * INDEX_RECORD.size